@@ -0,0 +1,194 @@
+"""
+
+Synthetic, scalable fixtures for the benchmark suite: everything is generated locally (or read
+from the data folder), so that benchmarks run offline on a single machine.
+
+"""
+
+import os
+import ast
+import sys
+import json
+import types
+import importlib.util
+import numpy as np
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TRAINING_FOLDER = os.path.join(REPO_ROOT, 'mlsys', 'training')
+PROJECT_FOLDER = os.path.join(REPO_ROOT, 'project')
+DATA_FOLDER = os.path.join(REPO_ROOT, 'data')
+NOTEBOOK_FOLDER = os.path.join(REPO_ROOT, 'notebooks')
+
+# words used to build finance-like sentences: slices used by the behavioral tests ('quarter', 'comptel') included
+FINANCE_WORDS = {
+    0: ['loss', 'decreased', 'fell', 'down', 'weak', 'layoffs', 'decline', 'lower', 'negative', 'cut'],
+    1: ['announced', 'company', 'board', 'meeting', 'agreement', 'office', 'located', 'products', 'services', 'new'],
+    2: ['profit', 'increased', 'rose', 'up', 'strong', 'growth', 'record', 'higher', 'positive', 'won']
+}
+COMMON_WORDS = ['the', 'quarter', 'comptel', 'nokia', 'eur', 'mn', 'sales', 'operating', 'period', 'year',
+                'finnish', 'group', 'net', 'said', 'million', 'market', 'share', 'first', 'third', 'orders']
+
+
+def add_to_path():
+    """
+        Make the modules of the training and project folders importable.
+    """
+    for folder in [TRAINING_FOLDER, PROJECT_FOLDER]:
+        if folder not in sys.path:
+            sys.path.insert(0, folder)
+
+    return
+
+
+def load_module(file_name: str, module_name: str):
+    """
+        Import a module from a path under a custom name (e.g. the two Lambda handlers are both called handler.py).
+    """
+    spec = importlib.util.spec_from_file_location(module_name, file_name)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def make_regression_file(file_name: str, n_rows: int, seed: int=42) -> str:
+    """
+        Same format as the output of create_fake_dataset.py: x <tab> y, one point per line.
+    """
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal(n_rows)
+    y = 16.7 * x + rng.normal(0, 10, n_rows)
+    with open(file_name, 'w') as f:
+        f.write(''.join('{}\t{}\n'.format(a, b) for a, b in zip(x.tolist(), y.tolist())))
+
+    return file_name
+
+
+def make_finance_sentences(n_sentences: int, seed: int=42) -> tuple:
+    """
+        Labelled, finance-like raw sentences (with upper case and punctuation, as in the HF dataset).
+    """
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, 3, n_sentences)
+    sentences = []
+    for label in labels.tolist():
+        words = list(rng.choice(FINANCE_WORDS[label], 3)) + list(rng.choice(COMMON_WORDS, int(rng.integers(5, 20))))
+        rng.shuffle(words)
+        sentences.append('{}, {}.'.format(' '.join(words[:3]).capitalize(), ' '.join(words[3:])))
+
+    return sentences, labels.tolist()
+
+
+def make_lm_corpus(n_sentences: int) -> list:
+    """
+        Tokenized sentences from data/graham.txt (split and cleaned as in the LM notebook), cycled to reach
+        the desired size.
+    """
+    import string
+
+    with open(os.path.join(DATA_FOLDER, 'graham.txt')) as f:
+        sentences = [_ for _ in [s.strip() for s in f.read().replace(';', '.').split('.')] if _]
+    # same cleaning as prepare_sentence in the notebook: lower case, no punctuation, split on white spaces
+    exclude = str.maketrans('', '', string.punctuation)
+    corpus = [s.lower().translate(exclude).split() for s in sentences]
+    corpus = [_ for _ in corpus if _]
+
+    return [corpus[i % len(corpus)] for i in range(n_sentences)]
+
+
+def make_spell_dictionary():
+    """
+        Word counts over the whole data/graham.txt corpus, i.e. WORDS in the spelling section of the LM notebook.
+    """
+    from collections import Counter
+
+    with open(os.path.join(DATA_FOLDER, 'graham.txt')) as f:
+        sentences = [_ for _ in [s.strip() for s in f.read().replace(';', '.').split('.')] if _]
+
+    return Counter(word for s in sentences for word in s.lower().split())
+
+
+def make_spell_tests() -> list:
+    """
+        (right, wrong) pairs from the spell test sets in the data folder.
+    """
+    pairs = []
+    for file_name in ['spell-testset1.txt', 'spell-testset2.txt']:
+        with open(os.path.join(DATA_FOLDER, file_name)) as f:
+            pairs.extend((right, wrong) for right, wrongs in (line.split(':') for line in f) for wrong in wrongs.split())
+
+    return pairs
+
+
+def load_notebook_functions(notebook: str, namespace: dict=None) -> dict:
+    """
+        Execute the function definitions, imports and constant assignments of a notebook into a namespace,
+        skipping everything else (data loading, plots, prints): this way benchmarks always run the current
+        notebook code. Imports of packages that are not installed are skipped too, as well as definitions
+        depending on notebook state that is not in the namespace (e.g. the default argument of P needs WORDS).
+    """
+    namespace = dict(namespace or {})
+    with open(os.path.join(NOTEBOOK_FOLDER, notebook)) as f:
+        cells = [''.join(c['source']) for c in json.load(f)['cells'] if c['cell_type'] == 'code']
+    for cell in cells:
+        # drop IPython magics and shell commands
+        source = '\n'.join(line for line in cell.split('\n') if not line.lstrip().startswith(('%', '!')))
+        try:
+            tree = ast.parse(source)
+        except SyntaxError:
+            continue
+        for node in tree.body:
+            is_constant = isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant)
+            if not isinstance(node, (ast.FunctionDef, ast.Import, ast.ImportFrom)) and not is_constant:
+                continue
+            try:
+                exec(compile(ast.Module(body=[node], type_ignores=[]), notebook, 'exec'), namespace)
+            except (ImportError, NameError):
+                pass
+
+    return namespace
+
+
+def write_serving_artifacts(folder: str, n_sentences: int=2000):
+    """
+        Train TF-IDF + naive bayes on synthetic sentences, and pickle them where my_app.py expects them.
+    """
+    import pickle
+    from flow_utils import pre_process_sentence, tf_idf_vectorizer, get_classification_model
+
+    sentences, labels = make_finance_sentences(n_sentences)
+    cleaned = [pre_process_sentence(_) for _ in sentences]
+    vectorizer, X_train, _ = tf_idf_vectorizer(cleaned, cleaned[:1])
+    model = get_classification_model().fit(X_train, labels)
+    with open(os.path.join(folder, 'vectorizer.pkl'), 'wb') as f:
+        pickle.dump(vectorizer, f)
+    with open(os.path.join(folder, 'model.pkl'), 'wb') as f:
+        pickle.dump(model, f)
+
+    return
+
+
+def install_boto3_stub(predictions: list=None):
+    """
+        Replace boto3 with a stub whose sagemaker-runtime client answers locally, so that the Sagemaker
+        Lambda handler can be benchmarked without AWS.
+    """
+    class _Body:
+        def __init__(self, payload: bytes):
+            self.payload = payload
+
+        def read(self):
+            return self.payload
+
+    class _SagemakerRuntime:
+        def invoke_endpoint(self, EndpointName: str, ContentType: str, Body: str):
+            Xs = json.loads(Body)
+            payload = predictions if predictions is not None else [16.7 * x[0] - 0.09 for x in Xs]
+            return {'Body': _Body(json.dumps(payload).encode())}
+
+    stub = types.ModuleType('boto3')
+    stub.client = lambda service_name, *args, **kwargs: _SagemakerRuntime()
+    sys.modules['boto3'] = stub
+
+    return stub
@@ -0,0 +1,113 @@
+"""
+
+Import-time benchmark for the entry points of the repo: each module is imported in a fresh interpreter
+(so nothing is cached in sys.modules), --repeat times, and we report the best in-process import time, the
+number of modules loaded and which heavy libraries (sklearn, scipy, matplotlib, ...) were pulled in.
+
+python import_time.py
+python import_time.py --filter flow_utils --budget flow_utils=50
+
+The budgets (in ms) make the script exit with 1 when an entry point gets slower to import, e.g. when a
+heavy import is added at the top of flow_utils.py, which serving processes import for the text cleaning.
+
+"""
+
+
+import os
+import sys
+import json
+import tempfile
+import subprocess
+import fixtures
+
+
+# entry point -> folder it is run from
+ENTRY_POINTS = {
+    'composable': fixtures.TRAINING_FOLDER,
+    'monolith': fixtures.TRAINING_FOLDER,
+    'create_fake_dataset': fixtures.TRAINING_FOLDER,
+    'small_flow': fixtures.TRAINING_FOLDER,
+    'flow_utils': fixtures.PROJECT_FOLDER,
+    'my_flow': fixtures.PROJECT_FOLDER,
+    'my_app': fixtures.PROJECT_FOLDER,
+    'serving_metrics': fixtures.PROJECT_FOLDER
+}
+HEAVY_LIBRARIES = ['numpy', 'scipy', 'sklearn', 'matplotlib', 'flask', 'metaflow', 'datasets', 'nltk', 'gensim']
+# default budgets, in ms: the text cleaning helpers should be importable in tens of milliseconds
+DEFAULT_BUDGETS = {'flow_utils': 50}
+
+_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'modules': list(sys.modules)}}))
+"""
+
+
+def measure_import(module: str, folder: str, cwd: str=None) -> dict:
+    """
+        Import the module in a new interpreter, with folder on the path: returns import seconds and the
+        names of the modules loaded (or the error, if the import fails).
+    """
+    env = dict(os.environ, PYTHONPATH=folder, MPLBACKEND='Agg')
+    completed = subprocess.run([sys.executable, '-c', _PROBE.format(module=module)], cwd=cwd or folder, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if completed.returncode != 0:
+        return {'error': completed.stderr.strip().splitlines()[-1]}
+
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run_import_benchmark(repeat: int=5, name_filter: str=None) -> dict:
+    """
+        Best import time over repeat fresh interpreters, per entry point.
+    """
+    fixtures.add_to_path()
+    results = {}
+    # my_app loads the serving pickles from the current folder at import time
+    with tempfile.TemporaryDirectory() as serving_folder:
+        fixtures.write_serving_artifacts(serving_folder)
+        for module, folder in ENTRY_POINTS.items():
+            if name_filter and name_filter not in module:
+                continue
+            runs = [measure_import(module, folder, cwd=serving_folder if module == 'my_app' else None)
+                    for _ in range(repeat)]
+            if 'error' in runs[0]:
+                results[module] = {'error': runs[0]['error']}
+            else:
+                loaded = set(m.split('.')[0] for m in runs[0]['modules'])
+                results[module] = {
+                    'ms': 1000 * min(r['seconds'] for r in runs),
+                    'modules': len(runs[0]['modules']),
+                    'heavy': [lib for lib in HEAVY_LIBRARIES if lib in loaded]
+                }
+            r = results[module]
+            if 'error' in r:
+                print("{:<22} {}".format(module, r['error']))
+            else:
+                print("{:<22} {:>9.1f} ms {:>6} modules   {}".format(module, r['ms'], r['modules'], ', '.join(r['heavy']) or '-'))
+
+    return results
+
+
+def check_budgets(results: dict, budgets: dict) -> list:
+    over = [(m, results[m]['ms'], b) for m, b in budgets.items() if m in results and results[m].get('ms', 0) > b]
+    for module, ms, budget in over:
+        print("!!! {} takes {:.1f} ms to import, budget is {} ms".format(module, ms, budget))
+
+    return over
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Import time of the entry points, in fresh interpreters')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', default=None, help='only measure entry points containing this string')
+    parser.add_argument('--budget', action='append', default=[], help='module=ms, can be repeated')
+    args = parser.parse_args()
+
+    budgets = dict(DEFAULT_BUDGETS, **{b.split('=')[0]: float(b.split('=')[1]) for b in args.budget})
+    if check_budgets(run_import_benchmark(repeat=args.repeat, name_filter=args.filter), budgets):
+        sys.exit(1)
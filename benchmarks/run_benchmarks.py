@@ -0,0 +1,325 @@
+"""
+
+End-to-end benchmark suite for the training and serving paths of the repo: the composable regression
+script, the flow_utils helpers used by FinanceNewsFlow, the LM / spelling functions of the Intro_to_LM
+notebook, the Flask app and the two Lambda handlers (with AWS stubbed out).
+
+Fixtures are synthetic and scale linearly with --scale, so the whole suite runs offline on a laptop:
+
+python run_benchmarks.py --scale 1.0
+
+Each case runs a few warm-up rounds and then --repeat timed rounds: we record min and median wall time.
+Results are appended to a JSON-lines history file (with git commit, scale and machine info), and compared
+with the last run with the same scale on the same machine: the script exits with 1 if any case got slower
+than --threshold (relative), so it can be used as a gate, e.g. before merging a change to flow_utils.
+
+"""
+
+
+import os
+import io
+import sys
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import statistics
+from contextlib import redirect_stdout
+import fixtures
+
+
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.jsonl')
+# registry of benchmark cases: name -> setup function
+CASES = {}
+
+
+def benchmark(name: str):
+    """
+        Register a case: the decorated function receives the scale and the working folder, does all the
+        setup (not timed) and returns the function to time plus the number of rows it processes.
+    """
+    def decorator(setup):
+        CASES[name] = setup
+        return setup
+
+    return decorator
+
+
+def scaled(n: int, scale: float) -> int:
+    return max(1, int(n * scale))
+
+
+@benchmark('composable.load_data')
+def setup_load_data(scale: float, folder: str):
+    from composable import load_data
+
+    n_rows = scaled(200000, scale)
+    file_name = fixtures.make_regression_file(os.path.join(folder, 'regression_{}.txt'.format(n_rows)), n_rows)
+
+    return lambda: load_data(file_name), n_rows
+
+
+@benchmark('composable.train_model')
+def setup_train_model(scale: float, folder: str):
+    from composable import load_data, prepare_train_and_test_dataset, train_model
+
+    n_rows = scaled(200000, scale)
+    file_name = fixtures.make_regression_file(os.path.join(folder, 'regression_{}.txt'.format(n_rows)), n_rows)
+    dataset = load_data(file_name)
+    splits = prepare_train_and_test_dataset(dataset)
+
+    return lambda: train_model(dataset, splits, is_debug=False), len(splits.train_index)
+
+
+@benchmark('composable.evaluate_model')
+def setup_evaluate_model(scale: float, folder: str):
+    from composable import load_data, prepare_train_and_test_dataset, train_model, evaluate_model
+
+    n_rows = scaled(200000, scale)
+    file_name = fixtures.make_regression_file(os.path.join(folder, 'regression_{}.txt'.format(n_rows)), n_rows)
+    dataset = load_data(file_name)
+    splits = prepare_train_and_test_dataset(dataset)
+    regression = train_model(dataset, splits, is_debug=False)
+
+    return lambda: evaluate_model(regression.model, dataset, splits, with_plot=False, is_debug=False), len(splits.test_index)
+
+
+@benchmark('flow_utils.pre_process_sentence')
+def setup_pre_process_sentence(scale: float, folder: str):
+    from flow_utils import pre_process_sentence
+
+    sentences, _ = fixtures.make_finance_sentences(scaled(50000, scale))
+
+    return lambda: [pre_process_sentence(s) for s in sentences], len(sentences)
+
+
+@benchmark('flow_utils.tf_idf_vectorizer')
+def setup_tf_idf_vectorizer(scale: float, folder: str):
+    from flow_utils import pre_process_sentence, tf_idf_vectorizer
+
+    sentences, _ = fixtures.make_finance_sentences(scaled(50000, scale))
+    cleaned = [pre_process_sentence(s) for s in sentences]
+    n_train = int(0.8 * len(cleaned))
+
+    return lambda: tf_idf_vectorizer(cleaned[:n_train], cleaned[n_train:] or cleaned[:1]), len(cleaned)
+
+
+@benchmark('flow_utils.report_metrics_on_subset')
+def setup_report_metrics_on_subset(scale: float, folder: str):
+    from flow_utils import pre_process_sentence, report_metrics_on_subset
+
+    sentences, labels = fixtures.make_finance_sentences(scaled(50000, scale))
+    cleaned = [pre_process_sentence(s) for s in sentences]
+    # a fake model, right two times out of three
+    predicted = [l if i % 3 else (l + 1) % 3 for i, l in enumerate(labels)]
+
+    return lambda: report_metrics_on_subset(cleaned, predicted, labels, lambda x: 'quarter' in x), len(cleaned)
+
+
+@benchmark('notebook.get_ngram_counter_for_lm')
+def setup_ngram_counter(scale: float, folder: str):
+    namespace = fixtures.load_notebook_functions('Intro_to_LM.ipynb')
+    # the notebook implementation is quadratic in the number of sentences, so we keep the corpus small
+    corpus = fixtures.make_lm_corpus(scaled(1000, scale))
+
+    return lambda: namespace['get_ngram_counter_for_lm'](corpus=corpus, k=2), len(corpus)
+
+
+@benchmark('notebook.calculate_sentence_probability')
+def setup_sentence_probability(scale: float, folder: str):
+    namespace = fixtures.load_notebook_functions('Intro_to_LM.ipynb')
+    corpus = fixtures.make_lm_corpus(scaled(1000, scale))
+    with redirect_stdout(io.StringIO()):
+        ngram_lm = namespace['get_ngram_counter_for_lm'](corpus=corpus, k=2)
+    # sentences from the corpus itself, so that all the n-grams are known
+    sentences = [' '.join(tokens) for tokens in corpus]
+    calculate = namespace['calculate_sentence_probability']
+
+    return lambda: [calculate(s, ngram_lm, n=2) for s in sentences], len(sentences)
+
+
+@benchmark('notebook.correction')
+def setup_correction(scale: float, folder: str):
+    # as in the notebook, the dictionary (WORDS) is built from the Paul Graham corpus
+    namespace = fixtures.load_notebook_functions('Intro_to_LM.ipynb', {'WORDS': fixtures.make_spell_dictionary()})
+    tests = fixtures.make_spell_tests()
+    tests = [tests[i % len(tests)] for i in range(scaled(100, scale))]
+    correction = namespace['correction']
+
+    return lambda: [correction(wrong) for _, wrong in tests], len(tests)
+
+
+@benchmark('serving.my_app')
+def setup_my_app(scale: float, folder: str):
+    # my_app loads the pickles from the current folder at import time
+    fixtures.write_serving_artifacts(folder)
+    import my_app
+
+    client = my_app.app.test_client()
+    sentences, _ = fixtures.make_finance_sentences(scaled(1000, scale), seed=7)
+
+    return lambda: [client.post('/', data={'sl': s}) for s in sentences], len(sentences)
+
+
+@benchmark('serving.serverless_101')
+def setup_serverless_101(scale: float, folder: str):
+    os.environ.setdefault('BETA', '16.7')
+    os.environ.setdefault('INTERCEPT', '-0.09')
+    handler = fixtures.load_module(os.path.join(fixtures.REPO_ROOT, 'mlsys', 'serverless_101', 'handler.py'),
+                                   'serverless_101_handler')
+    events = [{'queryStringParameters': {'x': ','.join(str(i + j) for j in range(10))}}
+              for i in range(scaled(5000, scale))]
+
+    return lambda: [handler.simple_regression(e, None) for e in events], len(events)
+
+
+@benchmark('serving.serverless_sagemaker')
+def setup_serverless_sagemaker(scale: float, folder: str):
+    fixtures.install_boto3_stub()
+    handler = fixtures.load_module(os.path.join(fixtures.REPO_ROOT, 'mlsys', 'serverless_sagemaker', 'handler.py'),
+                                   'serverless_sagemaker_handler')
+    events = [{'queryStringParameters': {'x': ','.join(str(i + j) for j in range(10))}}
+              for i in range(scaled(5000, scale))]
+
+    return lambda: [handler.sagemaker_regression(e, None) for e in events], len(events)
+
+
+def time_case(func, repeat: int, warmup: int) -> list:
+    """
+        Run func warmup + repeat times, and return the timings of the last repeat rounds. Whatever the
+        benchmarked code prints (debug messages, handler logs) is swallowed.
+    """
+    timings = []
+    with redirect_stdout(io.StringIO()):
+        for i in range(warmup + repeat):
+            start = time.perf_counter()
+            func()
+            if i >= warmup:
+                timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def get_machine_info() -> dict:
+    return {
+        'node': platform.node(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version()
+    }
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=fixtures.REPO_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def run_suite(scale: float=1.0, repeat: int=5, warmup: int=1, name_filter: str=None) -> dict:
+    """
+        Run all the registered cases (optionally only the ones containing name_filter) and return
+        name -> {min_seconds, median_seconds, rows, rows_per_second}.
+    """
+    fixtures.add_to_path()
+    # the suite measures the code as it runs in production, without the step instrumentation
+    os.environ.pop('INSTRUMENTATION_FOLDER', None)
+    results = {}
+    current_folder = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            for name, setup in CASES.items():
+                if name_filter and name_filter not in name:
+                    continue
+                with redirect_stdout(io.StringIO()):
+                    func, n_rows = setup(scale, folder)
+                timings = time_case(func, repeat=repeat, warmup=warmup)
+                results[name] = {
+                    'min_seconds': min(timings),
+                    'median_seconds': statistics.median(timings),
+                    'rows': n_rows,
+                    'rows_per_second': n_rows / max(min(timings), 1e-9)
+                }
+                print('{:<45} min {:>9.4f}s  median {:>9.4f}s  {:>12.0f} rows/s'.format(
+                    name, results[name]['min_seconds'], results[name]['median_seconds'],
+                    results[name]['rows_per_second']))
+        finally:
+            os.chdir(current_folder)
+
+    return results
+
+
+def load_history(history_file: str) -> list:
+    if not os.path.exists(history_file):
+        return []
+    with open(history_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_baseline(history: list, scale: float, machine: dict) -> dict:
+    """
+        Last run in the history with the same scale on the same machine: timings across machines
+        (or fixture sizes) are not comparable.
+    """
+    for entry in reversed(history):
+        if entry['scale'] == scale and entry['machine'] == machine:
+            return entry
+
+    return None
+
+
+def compare_with_baseline(results: dict, baseline: dict, threshold: float=0.2, min_seconds: float=0.005) -> list:
+    """
+        Return the cases whose min time grew more than threshold (relative) with respect to the baseline.
+        Cases faster than min_seconds are ignored, as they are mostly noise.
+    """
+    regressions = []
+    for name, result in results.items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        old_value, new_value = old['min_seconds'], result['min_seconds']
+        change = (new_value - old_value) / old_value if old_value else 0.0
+        if change > threshold and max(old_value, new_value) >= min_seconds:
+            regressions.append((name, old_value, new_value))
+            print("REGRESSION: {} went from {:.4f}s to {:.4f}s ({:+.0%})".format(name, old_value, new_value, change))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the benchmark suite')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier of the fixture sizes')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--filter', default=None, help='only run cases containing this string')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slow-down flagged as a regression')
+    parser.add_argument('--history', default=HISTORY_FILE)
+    parser.add_argument('--no-save', action='store_true', help='do not append this run to the history')
+    args = parser.parse_args()
+
+    machine = get_machine_info()
+    results = run_suite(scale=args.scale, repeat=args.repeat, warmup=args.warmup, name_filter=args.filter)
+    baseline = find_baseline(load_history(args.history), args.scale, machine)
+    regressions = compare_with_baseline(results, baseline, threshold=args.threshold) if baseline else []
+    if baseline is None:
+        print("No previous run with scale {} on this machine: nothing to compare with".format(args.scale))
+    if not args.no_save:
+        entry = {
+            'timestamp': time.time(),
+            'git_commit': get_git_commit(),
+            'scale': args.scale,
+            'repeat': args.repeat,
+            'machine': machine,
+            'results': results
+        }
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    if regressions:
+        sys.exit(1)
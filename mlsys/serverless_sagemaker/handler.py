@@ -29,6 +29,42 @@ def wrap_response(status_code: int,
         'body': json.dumps(body),
     }
 
+# requests that waited more than LATENCY_BUDGET_MS before reaching the function (e.g. a slow cold start
+# during a spike) are shed with a 503: the client has likely given up on them. So are requests with less
+# than MIN_REMAINING_MS left before the function times out when we are about to call the endpoint. The
+# concurrency of the function is capped in serverless.yml (reservedConcurrency). Counts are per container.
+LATENCY_BUDGET_MS = float(os.getenv('LATENCY_BUDGET_MS', 1000))
+MIN_REMAINING_MS = float(os.getenv('MIN_REMAINING_MS', 500))
+ADMISSION_COUNTS = {'served': 0, 'shed': 0}
+
+
+def should_shed(event) -> str:
+    """
+    Return the reason to shed the request, or None if it should be served.
+    :param event: API Gateway event, with the request time (epoch in millisec) in its requestContext
+    :return:
+    """
+    request_time = (event.get('requestContext') or {}).get('requestTimeEpoch')
+    if request_time is not None and time.time() * 1000 - request_time > LATENCY_BUDGET_MS:
+        return 'waited more than {} ms'.format(LATENCY_BUDGET_MS)
+
+    return None
+
+
+def shed_response(reason: str, start: float) -> Dict[str, Any]:
+    ADMISSION_COUNTS['shed'] += 1
+    print(json.dumps({'event': 'shed', 'reason': reason, 'counts': ADMISSION_COUNTS}))
+
+    return wrap_response(status_code=503, body={
+        'error': 'Request shed: {}'.format(reason),
+        'metadata': {
+            'serverTimestamp': round(time.time() * 1000),
+            'time': time.time() - start,
+            'admission': dict(ADMISSION_COUNTS)
+        }
+    })
+
+
 def get_response_from_sagemaker(model_input: list,
                                 endpoint_name: str,
                                 content_type: str = 'application/json') -> list:
@@ -64,11 +100,19 @@ def sagemaker_regression(event, context):
     start = time.time()
     # print this for debug
     print("Received event: {}".format(json.dumps(event)))
+    # fail fast if the answer would come too late anyway
+    reason = should_shed(event)
+    if reason is not None:
+        return shed_response(reason, start)
     # read parameters
     params = event.get('queryStringParameters', {})
     # get Xs as a list from a parameter called x
     Xs = [[float(x)] for x in params['x'].split(',')] if 'x' in params else None
+    # the endpoint call is the slow part: do not start it if it cannot finish before the timeout
+    if context is not None and context.get_remaining_time_in_millis() < MIN_REMAINING_MS:
+        return shed_response('less than {} ms left'.format(MIN_REMAINING_MS), start)
     predictions = run_regression(Xs)
+    ADMISSION_COUNTS['served'] += 1
     # be civilized: wrap the response around some useful data
     response_body = {
         'data': {
@@ -77,7 +121,8 @@ def sagemaker_regression(event, context):
         'metadata': {
             'eventId': str(uuid.uuid4()),
             'serverTimestamp': round(time.time() * 1000), # current epoch in millisec
-            "time": time.time() - start
+            "time": time.time() - start,
+            'admission': dict(ADMISSION_COUNTS)
         }
     }
 
@@ -9,20 +9,29 @@ Please refer to the slides and our discussion for further context.
 """
 
 
-import matplotlib.pyplot as plt
-from sklearn.model_selection import train_test_split
-from sklearn import linear_model, metrics
 from collections import namedtuple
 from datetime import datetime
+from data_validation import validate, warn_only, ExpectNotNull, ExpectBetween, ExpectDuplicateRateBelow
+from instrumentation import instrument
+from streaming_metrics import RegressionAccumulator, evaluate_in_chunks
+from plotting import save_plot
+from hash_split import hash_split_indices
+from lazy_imports import lazy_import
+import numpy as np
 
 
-# namedtuple to contain the dataset and splits
+# sklearn is imported on first use, not when the script is imported (see lazy_imports.py)
+linear_model = lazy_import('sklearn.linear_model')
+
+
+# namedtuple to contain the dataset (as arrays) and splits (as row indices in the dataset, not copies)
 Dataset = namedtuple('Dataset', 'Xs Ys')
-Splits = namedtuple('Splits', 'X_train, X_test, y_train, y_test')
+Splits = namedtuple('Splits', 'train_index test_index')
 Regression = namedtuple('Regression', 'model beta intercept')
 RegressionMetrics = namedtuple('RegressionMetrics', 'mse r2')
 
 
+@instrument(rows=lambda data, *args, **kwargs: len(data.Ys))
 def load_data(file_name: str, is_debug=False) -> Dataset: 
     """
     Load data from csv file
@@ -39,9 +48,10 @@ def load_data(file_name: str, is_debug=False) -> Dataset:
     if is_debug:
         print(len(Xs), len(Ys))
 
-    return Dataset(Xs, Ys)
+    return Dataset(np.array(Xs), np.array(Ys))
 
 
+@instrument(rows=lambda _, data: len(data.Ys))
 def check_dataset(data: Dataset) -> bool:
     """
     Mimic a quality check on the data, for example checking the Ys are within a certain range.
@@ -49,69 +59,81 @@ def check_dataset(data: Dataset) -> bool:
 
     We will discuss in class some of the tools of a modern data pipeline, e.g 
     (https://github.com/jacopotagliabue/you-dont-need-a-bigger-boat)
+
+    Expectations are declared once and all evaluated (see data_validation.py), so that the report
+    shows every problem in the data, not just the first one.
     """
-    assert(all(y < 100 and y > -100 for y in data.Ys))
+    expectations = [
+        ExpectNotNull('X'),
+        ExpectNotNull('Y'),
+        ExpectBetween('Y', min_value=-100, max_value=100),
+        # duplicated Xs are reported, not a reason to stop the run
+        warn_only(ExpectDuplicateRateBelow('X', max_rate=0.01))
+    ]
+    report = validate([{'X': data.Xs[:, 0], 'Y': data.Ys}], expectations)
+    print(report)
+    assert report.success
 
     return True
 
 
+@instrument(rows=lambda _, data, *args, **kwargs: len(data.Ys))
 def prepare_train_and_test_dataset(data: Dataset, test_size: float=0.20, seed: int=42) -> Splits:
     """
-    Split data into train and test
+    Split data into train and test: each (x, y) row is assigned from a hash of its content, salted with
+    the seed (see hash_split.py), so the split does not depend on the order or chunking of the rows.
+    We keep the indices of the train and test rows, not copies of them
     """
-    X_train, X_test, y_train, y_test = train_test_split(
-        data.Xs, 
-        data.Ys, 
-        test_size=test_size, 
-        random_state=seed
-        )
+    train_index, test_index = hash_split_indices(zip(data.Xs, data.Ys), test_size=test_size, salt=str(seed))
 
-    return Splits(X_train, X_test, y_train, y_test)
+    return Splits(train_index, test_index)
 
 
-def train_model(splits: Splits, is_debug: bool=True) -> Regression:
+@instrument(rows=lambda _, data, splits, *args, **kwargs: len(splits.train_index))
+def train_model(data: Dataset, splits: Splits, is_debug: bool=True) -> Regression:
     """
     Train a linear regression model and return the scikit object, coeff and intercept
     """
     reg = linear_model.LinearRegression()
-    reg.fit(splits.X_train, splits.y_train)
+    reg.fit(data.Xs[splits.train_index], data.Ys[splits.train_index])
     if is_debug:
         print("Coefficient {}, intercept {}".format(reg.coef_[0], reg.intercept_))
 
     return Regression(reg, reg.coef_[0], reg.intercept_)
 
 
-def plot_points(y_predicted: list, y_test: list, plot_name: str) -> None:
+def plot_points(y_predicted: list, y_test: list, plot_name: str, mode: str='auto') -> None:
     """
-    Plot actual vs predicted and save the figure to disk
+    Plot actual vs predicted and save the figure to disk: large test sets are plotted as a density image
+    (see plotting.py), and the figure is rendered by a background process, not blocking the script
     """
-    fig, ax = plt.subplots()
-    ax.scatter(y_predicted, y_test, edgecolors=(0, 0, 1))
-    ax.plot([min(y_test), max(y_test)], [min(y_test), max(y_test)], 'r--', lw=3)
-    ax.set_xlabel('Predicted')
-    ax.set_ylabel('Actual')
-    plt.savefig(plot_name, bbox_inches='tight')
+    save_plot(y_predicted, y_test, plot_name, mode=mode, with_diagonal=True, xlabel='Predicted', ylabel='Actual')
 
     return
 
 
-def evaluate_model(model: linear_model, splits: Splits,  with_plot: bool=True, is_debug: bool=True) -> RegressionMetrics:
+@instrument(rows=lambda _, model, data, splits, *args, **kwargs: len(splits.test_index))
+def evaluate_model(model: linear_model, data: Dataset, splits: Splits,  with_plot: bool=True, is_debug: bool=True, chunk_size: int=10000) -> RegressionMetrics:
     """
-    Predict unseeen values and evaluate the model with standard regression metrics
+    Predict unseeen values and evaluate the model with standard regression metrics: predictions are made
+    chunk by chunk and folded into running sums (see streaming_metrics.py), so that memory is bounded by
+    chunk_size (all predictions are kept only if we need to plot them).
     """
-    y_predicted = model.predict(splits.X_test)
-    mse = metrics.mean_squared_error(splits.y_test, y_predicted)
-    r2 = metrics.r2_score(splits.y_test, y_predicted)
+    accumulator, y_predicted = evaluate_in_chunks(model, data.Xs, data.Ys, RegressionAccumulator(), chunk_size=chunk_size,
+                                                  keep_predictions=with_plot, index=splits.test_index)
+    mse = accumulator.mse
+    r2 = accumulator.r2
 
     if is_debug:
         print('MSE is {}, R2 score is {}'.format(mse, r2))
 
     if with_plot:
-        plot_points(y_predicted, splits.y_test, 'composable_regression_analysis.png')
+        plot_points(y_predicted, data.Ys[splits.test_index], 'composable_regression_analysis.png')
 
     return RegressionMetrics(mse, r2)
 
 
+@instrument()
 def composable_script(file_name: str, test_size: float=0.20):
     # starting up!
     print("Starting up at {}".format(datetime.utcnow()))
@@ -122,9 +144,9 @@ def composable_script(file_name: str, test_size: float=0.20):
     # split the data 
     splits = prepare_train_and_test_dataset(dataset, test_size=test_size)
     # train the model
-    regression = train_model(splits, is_debug=True)
+    regression = train_model(dataset, splits, is_debug=True)
     # evaluate model
-    model_metrics = evaluate_model(regression.model, splits, with_plot=True)
+    model_metrics = evaluate_model(regression.model, dataset, splits, with_plot=True)
     # all done
     print("All done at {}!\n See you, space cowboys!".format(datetime.utcnow()))
 
@@ -5,14 +5,17 @@ to train a regression model later on.
 
 """
 
-from sklearn import datasets
-import matplotlib.pyplot as plt
+from plotting import save_plot
+from lazy_imports import lazy_import
+
+
+# sklearn is imported on first use, not when the script is imported (see lazy_imports.py)
+datasets = lazy_import('sklearn.datasets')
 
 
 def plot_scatter(x: list, y: list):
-    plt.title('X Vs. Y')
-    plt.plot(x, y, '.', label='dataset')
-    plt.savefig('regression.png', bbox_inches='tight')
+    # large datasets are plotted as a density image, rendered in a background process (see plotting.py)
+    save_plot(x, y, 'regression.png', title='X Vs. Y')
 
     return
 
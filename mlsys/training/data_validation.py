@@ -0,0 +1,312 @@
+"""
+
+Simple, declarative data validation: we declare our expectations on the data once (value ranges,
+nulls / NaN, label cardinality, string lengths, duplicates), and evaluate them vectorized with NumPy,
+chunk by chunk, so that datasets larger than memory can be validated while they are streamed in.
+
+Instead of failing at the first problem (as an assert would), we collect a structured report with
+the outcome of every expectation. Expectations wrapped in `warn_only` are reported, but do not make
+the validation fail: use them for data quality issues the pipeline already handles (e.g. short
+sentences that are filtered out), and keep failures for real schema violations. Tools like
+https://greatexpectations.io/ do this (and much more) in a production setting.
+
+"""
+
+
+from collections import namedtuple
+import numpy as np
+
+
+# outcome of one expectation: observed values are a dictionary of summary statistics,
+# and examples a few (global) row indices failing the expectation
+ExpectationResult = namedtuple('ExpectationResult', 'name column success observed examples warn_only',
+                               defaults=(False,))
+
+
+class Expectation(object):
+    """
+    Base class: an expectation is updated chunk by chunk with the values of one column,
+    and produces an ExpectationResult at the end. As in Great Expectations, `mostly` is the
+    fraction of rows that must pass for the expectation to succeed.
+    """
+
+    max_examples = 5
+    # set by warn_only(): a failure is reported, but does not fail the validation
+    warn_only = False
+
+    def __init__(self, column: str, mostly: float=1.0):
+        self.column = column
+        self.mostly = mostly
+        self.n_rows = 0
+        self.n_failing = 0
+        self.examples = []
+
+        return
+
+    @property
+    def name(self) -> str:
+        return self.__class__.__name__
+
+    def failing_rows(self, values):
+        """
+            Return a boolean mask of the failing rows in the chunk.
+        """
+        raise NotImplementedError
+
+    def update(self, values, row_offset: int):
+        failing = self.failing_rows(values)
+        self.n_rows += len(failing)
+        self.n_failing += int(failing.sum())
+        if len(self.examples) < self.max_examples:
+            self.examples.extend((np.flatnonzero(failing)[:self.max_examples - len(self.examples)] + row_offset).tolist())
+
+        return
+
+    def result(self) -> ExpectationResult:
+        success = self.n_failing <= (1.0 - self.mostly) * self.n_rows
+
+        return ExpectationResult(self.name, self.column, success,
+                                 {'rows': self.n_rows, 'failing_rows': self.n_failing}, self.examples)
+
+
+class ExpectNotNull(Expectation):
+    """
+    No None / NaN values.
+    """
+
+    def failing_rows(self, values):
+        values = np.asarray(values)
+        if values.dtype.kind == 'f':
+            return np.isnan(values)
+        if values.dtype.kind == 'O':
+            return np.array([v is None or v != v for v in values], dtype=bool)
+
+        return np.zeros(len(values), dtype=bool)
+
+
+class ExpectBetween(Expectation):
+    """
+    Values strictly between min_value and max_value (NaN values fail too).
+    """
+
+    def __init__(self, column: str, min_value: float=None, max_value: float=None, mostly: float=1.0):
+        super().__init__(column, mostly)
+        self.min_value = min_value
+        self.max_value = max_value
+        self.observed_min = np.inf
+        self.observed_max = -np.inf
+
+        return
+
+    def failing_rows(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        ok = ~np.isnan(values)
+        if ok.any():
+            self.observed_min = min(self.observed_min, float(values[ok].min()))
+            self.observed_max = max(self.observed_max, float(values[ok].max()))
+        if self.min_value is not None:
+            ok &= values > self.min_value
+        if self.max_value is not None:
+            ok &= values < self.max_value
+
+        return ~ok
+
+    def result(self) -> ExpectationResult:
+        result = super().result()
+        result.observed.update({'min': self.observed_min, 'max': self.observed_max})
+
+        return result
+
+
+class ExpectLengthBetween(ExpectBetween):
+    """
+    String lengths between min_length and max_length (inclusive). The column can be a sequence of strings,
+    or any object with a vectorized `sentence_lengths` method (e.g. the TextView in project/columnar.py).
+    """
+
+    def __init__(self, column: str, min_length: int=None, max_length: int=None, mostly: float=1.0):
+        super().__init__(column,
+                         min_length - 1 if min_length is not None else None,
+                         max_length + 1 if max_length is not None else None,
+                         mostly)
+
+        return
+
+    def failing_rows(self, values):
+        if hasattr(values, 'sentence_lengths'):
+            lengths = values.sentence_lengths()
+        else:
+            lengths = np.char.str_len(np.asarray(list(values), dtype=str)) if len(values) else np.zeros(0)
+
+        return super().failing_rows(lengths)
+
+
+class ExpectCardinality(Expectation):
+    """
+    Number of distinct values (e.g. target classes) equal to n_values and / or within allowed_values.
+    """
+
+    def __init__(self, column: str, n_values: int=None, allowed_values: list=None):
+        super().__init__(column)
+        self.n_values = n_values
+        self.allowed_values = allowed_values
+        self.seen_values = set()
+
+        return
+
+    def failing_rows(self, values):
+        values = np.asarray(values)
+        self.seen_values.update(np.unique(values).tolist())
+        if self.allowed_values is None:
+            return np.zeros(len(values), dtype=bool)
+
+        return ~np.isin(values, self.allowed_values)
+
+    def result(self) -> ExpectationResult:
+        result = super().result()
+        success = result.success and (self.n_values is None or len(self.seen_values) == self.n_values)
+        observed = dict(result.observed, distinct_values=sorted(self.seen_values))
+
+        return result._replace(success=success, observed=observed)
+
+
+def _mix64(x):
+    """
+        splitmix64 finalizer, on a uint64 array (overflows wrap around, as intended).
+    """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+
+    return x ^ (x >> np.uint64(31))
+
+
+def hash_strings(values) -> np.ndarray:
+    """
+        64-bit hash of each string, vectorized: strings become a fixed-width array of code points, read as
+        64-bit words (two code points each), and the hash is the product of the (rows x words) matrix with
+        one odd key per word position, mixed. Padding code points are 0, so the hash of a string does not
+        depend on the width of its chunk.
+    """
+    strings = np.asarray(list(values), dtype=str)
+    width = strings.dtype.itemsize // 4
+    if not len(strings) or not width:
+        return np.zeros(len(strings), dtype=np.uint64)
+    if width % 2:
+        width += 1
+        strings = strings.astype('<U{}'.format(width))
+    words = strings.view(np.uint64).reshape(len(strings), width // 2)
+    keys = _mix64(np.arange(1, width // 2 + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)) | np.uint64(1)
+
+    return _mix64(words @ keys)
+
+
+class ExpectDuplicateRateBelow(Expectation):
+    """
+    Fraction of duplicated values (rows identical to a previous row) at most max_rate. To stream through
+    large datasets, we only keep a 64-bit hash of each value (see hash_strings for text), and count
+    duplicates at the end.
+    """
+
+    def __init__(self, column: str, max_rate: float=0.0):
+        super().__init__(column)
+        self.max_rate = max_rate
+        self.hashes = []
+
+        return
+
+    def update(self, values, row_offset: int):
+        values = values if isinstance(values, np.ndarray) and values.dtype.kind in 'iufb' else list(values)
+        if isinstance(values, np.ndarray):
+            hashes = values.astype(np.float64).view(np.uint64) if values.dtype.kind == 'f' else values.astype(np.uint64)
+        else:
+            hashes = hash_strings(values)
+        self.hashes.append(hashes)
+        self.n_rows += len(hashes)
+
+        return
+
+    def result(self) -> ExpectationResult:
+        all_hashes = np.sort(np.concatenate(self.hashes)) if self.hashes else np.zeros(0, dtype=np.uint64)
+        # after sorting, a duplicate is a value equal to the previous one
+        n_duplicates = int((all_hashes[1:] == all_hashes[:-1]).sum())
+        rate = n_duplicates / max(len(all_hashes), 1)
+
+        return ExpectationResult(self.name, self.column, rate <= self.max_rate,
+                                 {'rows': self.n_rows, 'duplicate_rows': n_duplicates, 'duplicate_rate': rate}, [])
+
+
+def warn_only(expectation: Expectation) -> Expectation:
+    """
+        Mark an expectation as a warning: its failures are reported, but the validation still succeeds.
+    """
+    expectation.warn_only = True
+
+    return expectation
+
+
+class ValidationReport(object):
+    """
+    Collection of the expectation results, with a readable string representation.
+    """
+
+    def __init__(self, results: list, n_rows: int):
+        self.results = results
+        self.n_rows = n_rows
+
+        return
+
+    @property
+    def success(self) -> bool:
+        return not self.failures
+
+    @property
+    def failures(self) -> list:
+        return [r for r in self.results if not r.success and not r.warn_only]
+
+    @property
+    def warnings(self) -> list:
+        return [r for r in self.results if not r.success and r.warn_only]
+
+    def __str__(self):
+        lines = ["Validation {} on {} rows{}".format('PASSED' if self.success else 'FAILED', self.n_rows,
+                                                    ', {} warning(s)'.format(len(self.warnings)) if self.warnings else '')]
+        for r in self.results:
+            lines.append("  [{}] {}({}): {}{}".format(
+                'ok' if r.success else ('warn' if r.warn_only else 'KO'), r.name, r.column, r.observed,
+                ', e.g. rows {}'.format(r.examples) if r.examples else ''))
+
+        return '\n'.join(lines)
+
+
+def validate(chunks, expectations: list) -> ValidationReport:
+    """
+        Evaluate the expectations over an iterable of chunks, where each chunk is a dictionary
+        column name -> values (NumPy arrays, lists or columnar containers). Every expectation sees
+        every chunk, so the report covers all the problems in the data, not just the first one.
+    """
+    n_rows = 0
+    for chunk in chunks:
+        chunk_size = None
+        for expectation in expectations:
+            values = chunk[expectation.column]
+            expectation.update(values, n_rows)
+            chunk_size = len(values)
+        n_rows += chunk_size or 0
+
+    return ValidationReport([e.result()._replace(warn_only=e.warn_only) for e in expectations], n_rows)
+
+
+def read_tsv_in_chunks(file_name: str, columns: list, chunk_size: int=1000000):
+    """
+        Stream a tab-separated file of numbers (e.g. regression_dataset.txt) as chunks of float64 arrays,
+        one per column, parsing each chunk in one go.
+    """
+    from itertools import islice
+
+    with open(file_name) as f:
+        while True:
+            lines = list(islice(f, chunk_size))
+            if not lines:
+                break
+            values = np.array(''.join(lines).split(), dtype=np.float64).reshape(len(lines), len(columns))
+            yield {c: values[:, i] for i, c in enumerate(columns)}
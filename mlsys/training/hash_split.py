@@ -0,0 +1,126 @@
+"""
+
+Deterministic train / test splits from a hash of each row: instead of shuffling the full dataset in
+memory (as `train_test_split` does), each row is assigned to the test set if the hash of its content
+(or id), mapped to [0, 1), is below test_size. The assignment of a row depends only on the row itself
+(and a salt), so:
+
+* the same row always goes to the same split, whatever the order of the rows and however the data is
+  chunked or sharded: splits can be computed row by row over a stream, or in parallel over shards;
+* duplicated rows end up in the same split, so they cannot leak from train into test;
+* when new rows are added, old rows do not move from one split to the other.
+
+Functions return boolean masks (or index arrays), not copies of the data. The test share is test_size
+on expectation, not exactly as with `train_test_split`.
+
+"""
+
+
+import zlib
+import hashlib
+import numpy as np
+
+
+def row_key(row) -> bytes:
+    """
+        Stable byte representation of a row: strings, bytes, numbers (floats by value, so 1 and 1.0 are
+        the same) and lists / tuples of them.
+    """
+    if isinstance(row, bytes):
+        return row
+    if isinstance(row, str):
+        return row.encode('utf-8')
+    if isinstance(row, (list, tuple, np.ndarray)):
+        return b'\t'.join(row_key(_) for _ in row)
+    if isinstance(row, (int, float, np.integer, np.floating)) and not isinstance(row, bool):
+        return repr(float(row)).encode('ascii')
+
+    return str(row).encode('utf-8')
+
+
+def hash_fraction(key: bytes, salt: bytes=b'', hash_function: str='blake2b') -> float:
+    """
+        Map a key to [0, 1): blake2b (default) is well mixed even for very similar keys; crc32 is faster,
+        but only 32 bits and linear.
+    """
+    if hash_function == 'crc32':
+        return zlib.crc32(key, zlib.crc32(salt)) / 2 ** 32
+    if hash_function == 'blake2b':
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8, salt=salt[:16]).digest(), 'little') / 2 ** 64
+
+    raise ValueError("Unknown hash function: {}, use blake2b or crc32".format(hash_function))
+
+
+def hash_split_mask(rows, test_size: float=0.2, salt: str='', hash_function: str='blake2b', key=None) -> np.ndarray:
+    """
+        Boolean mask (True for test rows) over any iterable of rows, e.g. a generator reading a file.
+        key, if given, maps a row to what is hashed (e.g. an id column); by default, the whole row.
+    """
+    salt = salt.encode('utf-8')
+    key = key or (lambda row: row)
+
+    return np.fromiter((hash_fraction(row_key(key(row)), salt, hash_function) < test_size for row in rows), dtype=bool)
+
+
+def hash_split_indices(rows, index=None, test_size: float=0.2, salt: str='', hash_function: str='blake2b',
+                       key=None) -> tuple:
+    """
+        (train_index, test_index), as train_test_split on the indices: index defaults to 0..n-1, and can be
+        any array of row ids aligned with rows (e.g. the valid rows of a dataset).
+    """
+    mask = hash_split_mask(rows, test_size=test_size, salt=salt, hash_function=hash_function, key=key)
+    index = np.arange(len(mask)) if index is None else np.asarray(index)
+
+    return index[~mask], index[mask]
+
+
+def _mask_shard(args) -> np.ndarray:
+    return hash_split_mask(*args)
+
+
+def hash_split_mask_parallel(rows: list, test_size: float=0.2, salt: str='', hash_function: str='blake2b',
+                             n_jobs: int=2) -> np.ndarray:
+    """
+        Same mask as hash_split_mask, computed over n_jobs contiguous shards in parallel processes.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    bounds = np.linspace(0, len(rows), n_jobs + 1).astype(int)
+    shards = [(rows[start:end], test_size, salt, hash_function) for start, end in zip(bounds[:-1], bounds[1:])]
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return np.concatenate(list(executor.map(_mask_shard, shards)))
+
+
+def benchmark_hash_split(n_rows: int=200000, test_size: float=0.2) -> dict:
+    """
+        Check that the split does not depend on order and chunking (and matches in parallel), and compare
+        the time with train_test_split on the row indices.
+    """
+    import time
+    from sklearn.model_selection import train_test_split
+
+    rng = np.random.default_rng(42)
+    rows = ['sentence {} with words {}'.format(i, rng.integers(1000)) for i in range(n_rows)]
+    results = {}
+    for hash_function in ['blake2b', 'crc32']:
+        start = time.time()
+        mask = hash_split_mask(rows, test_size=test_size, hash_function=hash_function)
+        results['{}_seconds'.format(hash_function)] = time.time() - start
+        results['{}_test_share'.format(hash_function)] = float(mask.mean())
+        # shuffled rows, in chunks of random size, one at a time: same assignment for every row
+        order = rng.permutation(n_rows)
+        chunks = np.split(order, np.sort(rng.choice(n_rows, size=10, replace=False)))
+        shuffled = np.concatenate([hash_split_mask((rows[i] for i in c), test_size=test_size,
+                                                   hash_function=hash_function) for c in chunks])
+        assert np.array_equal(shuffled, mask[order])
+        assert np.array_equal(hash_split_mask_parallel(rows, test_size=test_size, hash_function=hash_function), mask)
+    start = time.time()
+    train_test_split(np.arange(n_rows), test_size=test_size, random_state=42)
+    results['train_test_split_seconds'] = time.time() - start
+    print(results)
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_hash_split()
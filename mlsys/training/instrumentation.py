@@ -0,0 +1,204 @@
+"""
+
+Lightweight instrumentation for scripts and flows: wall time, CPU time, peak memory (RSS), rows
+processed and artifact sizes, for every decorated function or Metaflow step.
+
+Instrumentation is off by default, and the decorator then returns the function untouched: set the
+INSTRUMENTATION_FOLDER env variable (before the script starts) to turn it on, e.g.
+
+INSTRUMENTATION_FOLDER=runs python composable.py
+
+Each run is stored as a JSON-lines file in that folder (one record per step), named after the Metaflow
+run id when running inside a flow, or after INSTRUMENTATION_RUN_ID / the start time otherwise. Two runs can
+then be compared from the command line, flagging regressions:
+
+python instrumentation.py compare runs/1.jsonl runs/2.jsonl --threshold 0.2
+
+"""
+
+
+import os
+import sys
+import json
+import time
+import functools
+from contextlib import contextmanager
+
+
+INSTRUMENTATION_FOLDER = os.environ.get('INSTRUMENTATION_FOLDER')
+_DEFAULT_RUN_ID = os.environ.get('INSTRUMENTATION_RUN_ID') or time.strftime('%Y%m%d-%H%M%S')
+
+
+def is_enabled() -> bool:
+    return INSTRUMENTATION_FOLDER is not None
+
+
+def _get_run_id() -> str:
+    """
+        Inside a Metaflow run, all the steps (i.e. processes) share the run id.
+    """
+    if 'metaflow' in sys.modules:
+        try:
+            from metaflow import current
+            if current.run_id:
+                return '{}-{}'.format(current.flow_name, current.run_id)
+        except Exception:
+            pass
+
+    return _DEFAULT_RUN_ID
+
+
+def _peak_rss_mb() -> float:
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _artifact_bytes(obj) -> int:
+    import pickle
+
+    try:
+        return len(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return -1
+
+
+def save_record(record: dict):
+    """
+        Append a record to the file of the current run.
+    """
+    if record.get('rows'):
+        record['rows_per_second'] = record['rows'] / max(record['wall_seconds'], 1e-9)
+    record['timestamp'] = time.time()
+    os.makedirs(INSTRUMENTATION_FOLDER, exist_ok=True)
+    with open(os.path.join(INSTRUMENTATION_FOLDER, '{}.jsonl'.format(_get_run_id())), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+    return
+
+
+def _start_timers() -> tuple:
+    return time.time(), time.process_time(), _peak_rss_mb()
+
+
+def _stop_timers(record: dict, timers: tuple):
+    wall_start, cpu_start, peak_before = timers
+    record['wall_seconds'] = time.time() - wall_start
+    record['cpu_seconds'] = time.process_time() - cpu_start
+    record['peak_rss_mb'] = _peak_rss_mb()
+    record['peak_rss_increase_mb'] = record['peak_rss_mb'] - peak_before
+
+    return
+
+
+@contextmanager
+def measure(name: str):
+    """
+        Context manager measuring the enclosed block: the yielded record can be enriched by the caller,
+        e.g. record['rows'] = len(data). Nothing is measured (or saved) when instrumentation is disabled.
+    """
+    record = {'name': name}
+    if not is_enabled():
+        yield record
+        return
+    timers = _start_timers()
+    yield record
+    _stop_timers(record, timers)
+    save_record(record)
+
+    return
+
+
+def instrument(rows=None, artifacts: list=None, name: str=None):
+    """
+        Decorator measuring a function or a Metaflow step (put it below @step).
+
+        rows is an optional function receiving the result and the arguments of the decorated function,
+        and returning the number of rows processed. artifacts is an optional list of attribute names of the
+        first argument (i.e. self, for a flow step) whose pickled size is recorded after the call.
+    """
+    def decorator(func):
+        # when disabled, we return the function itself: no overhead at all
+        if not is_enabled():
+            return func
+        record_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            timers = _start_timers()
+            result = func(*args, **kwargs)
+            record = {'name': record_name}
+            _stop_timers(record, timers)
+            # rows and artifacts are measured after the timers are stopped, so they do not count towards the step time
+            if rows is not None:
+                record['rows'] = rows(result, *args, **kwargs)
+            if artifacts and args:
+                record['artifact_bytes'] = {a: _artifact_bytes(getattr(args[0], a)) for a in artifacts if hasattr(args[0], a)}
+            save_record(record)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def load_run(run_file: str) -> dict:
+    """
+        Load a run file as a dictionary step name -> record (if a step ran more than once, e.g. in a foreach,
+        times are summed up and memory is the max).
+    """
+    steps = {}
+    with open(run_file) as f:
+        for line in f:
+            record = json.loads(line)
+            previous = steps.get(record['name'])
+            if previous is not None:
+                for key in ['wall_seconds', 'cpu_seconds', 'rows']:
+                    if key in record:
+                        record[key] += previous.get(key, 0)
+                record['peak_rss_mb'] = max(record['peak_rss_mb'], previous['peak_rss_mb'])
+            steps[record['name']] = record
+
+    return steps
+
+
+def compare_runs(base_file: str, new_file: str, threshold: float=0.2, min_seconds: float=0.05) -> list:
+    """
+        Compare two runs step by step, and return the regressions: metrics growing more than threshold
+        (relative). Time differences on steps faster than min_seconds are ignored, as they are mostly noise.
+    """
+    base, new = load_run(base_file), load_run(new_file)
+    regressions = []
+    print('{:<40} {:>28} {:>28} {:>28}'.format('step', 'wall_seconds', 'cpu_seconds', 'peak_rss_mb'))
+    for step_name in [_ for _ in new if _ in base]:
+        cells = []
+        for metric in ['wall_seconds', 'cpu_seconds', 'peak_rss_mb']:
+            old_value, new_value = base[step_name][metric], new[step_name][metric]
+            change = (new_value - old_value) / old_value if old_value else 0.0
+            is_noise = metric != 'peak_rss_mb' and max(old_value, new_value) < min_seconds
+            flag = change > threshold and not is_noise
+            if flag:
+                regressions.append((step_name, metric, old_value, new_value))
+            cells.append('{:.3f} -> {:.3f} ({:+.0%}){}'.format(old_value, new_value, change, ' !' if flag else ''))
+        print('{:<40} {:>28} {:>28} {:>28}'.format(step_name, *cells))
+    for step_name, metric, old_value, new_value in regressions:
+        print("REGRESSION: {} {} went from {:.3f} to {:.3f}".format(step_name, metric, old_value, new_value))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare two instrumented runs')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    compare_parser = subparsers.add_parser('compare')
+    compare_parser.add_argument('base_run')
+    compare_parser.add_argument('new_run')
+    compare_parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+    if compare_runs(args.base_run, args.new_run, threshold=args.threshold):
+        sys.exit(1)
@@ -0,0 +1,47 @@
+"""
+
+Lazy module imports: `lazy_import('sklearn.linear_model')` returns a placeholder which imports the real
+module the first time one of its attributes is used. Scripts can keep their module-level names (e.g.
+`linear_model.LinearRegression()`), but importing the script (for a helper, or to run a single step)
+no longer pays for sklearn or matplotlib up front: the cost moves to the first call that needs them.
+
+Measure the import time of each entry point with benchmarks/import_time.py.
+
+"""
+
+
+import importlib
+
+
+class LazyModule(object):
+    """
+    Placeholder for a module, imported (once) on first attribute access.
+    """
+
+    def __init__(self, name: str):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self.__dict__['_module'] is None:
+            self.__dict__['_module'] = importlib.import_module(self.__dict__['_name'])
+
+        return self.__dict__['_module']
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr: str, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded'
+
+        return "<lazy module '{}' ({})>".format(self.__dict__['_name'], state)
+
+
+def lazy_import(name: str) -> LazyModule:
+    return LazyModule(name)
@@ -9,9 +9,14 @@ Please refer to the slides and our discussion for further context.
 """
 
 
-import matplotlib.pyplot as plt
-from sklearn.model_selection import train_test_split
-from sklearn import linear_model, metrics
+from plotting import save_plot
+from lazy_imports import lazy_import
+
+
+# sklearn is imported on first use, not when the script is imported (see lazy_imports.py)
+model_selection = lazy_import('sklearn.model_selection')
+linear_model = lazy_import('sklearn.linear_model')
+metrics = lazy_import('sklearn.metrics')
 
 
 def monolith():
@@ -26,7 +31,7 @@ def monolith():
             x, y = line.split('\t')
             Xs.append([float(x)])
             Ys.append(float(y))
-    X_train, X_test, y_train, y_test = train_test_split(Xs, Ys, test_size=0.20, random_state=42)
+    X_train, X_test, y_train, y_test = model_selection.train_test_split(Xs, Ys, test_size=0.20, random_state=42)
     print(len(X_train), len(X_test))
     # train a regression model
     reg = linear_model.LinearRegression()
@@ -34,12 +39,8 @@ def monolith():
     print("Coefficient {}, intercept {}".format(reg.coef_, reg.intercept_))
     # predict unseeen values and evaluate the model
     y_predicted = reg.predict(X_test)
-    fig, ax = plt.subplots()
-    ax.scatter(y_predicted, y_test, edgecolors=(0, 0, 1))
-    ax.plot([min(y_test), max(y_test)], [min(y_test), max(y_test)], 'r--', lw=3)
-    ax.set_xlabel('Predicted')
-    ax.set_ylabel('Actual')
-    plt.savefig('monolith_regression_analysis.png', bbox_inches='tight')
+    # plot actual vs predicted (as a density image for large test sets), in a background process
+    save_plot(y_predicted, y_test, 'monolith_regression_analysis.png', with_diagonal=True, xlabel='Predicted', ylabel='Actual')
     mse = metrics.mean_squared_error(y_test, y_predicted)
     r2 = metrics.r2_score(y_test, y_predicted)
     print('MSE is {}, R2 score is {}'.format(mse, r2))
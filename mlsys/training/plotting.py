@@ -0,0 +1,193 @@
+"""
+
+Plotting for large evaluation sets: scattering every point with matplotlib is fine for a few thousands
+points, but at millions of points rendering dominates the runtime of the whole script. Here, points are
+first reduced with vectorized NumPy to something of bounded size, whatever the data size:
+
+* 'density': a 2D histogram (bins x bins counts), rendered as an image with a log color scale;
+* 'hexbin': same idea, with hexagonal bins: points are first counted on a fine square grid, and
+  matplotlib sums the counts of the grid cells falling in each hexagon;
+* 'sample': a uniform sample of max_points points (reservoir sampling, so it also works on streams);
+* 'scatter': all the points, as before (used by 'auto' for small datasets). This is the only mode whose
+  size is not bounded: use it explicitly on large datasets only if you really want every point.
+
+The reduced data is then rendered and written to disk by a background process, so that the training
+path does not wait for matplotlib. Only the reduced data is handed to that process (and pickled, when
+processes are spawned, as on macOS), so its cost is bounded too, except for 'scatter'.
+
+"""
+
+
+import numpy as np
+
+
+# hexagons along the x axis, and square cells per hexagon (per axis) of the grid points are counted on
+HEXBIN_GRIDSIZE = 100
+HEXBIN_OVERSAMPLING = 4
+
+
+class ReservoirSample(object):
+    """
+    Uniform sample of at most max_points (x, y) pairs from a stream of chunks (Algorithm R, vectorized
+    over each chunk): memory is bounded by max_points, whatever the length of the stream.
+    """
+
+    def __init__(self, max_points: int=10000, seed: int=42):
+        self.max_points = max_points
+        self.rng = np.random.default_rng(seed)
+        self.x = np.zeros(0)
+        self.y = np.zeros(0)
+        self.n_seen = 0
+
+        return
+
+    def update(self, x, y):
+        x = np.asarray(x, dtype=np.float64).ravel()
+        y = np.asarray(y, dtype=np.float64).ravel()
+        # fill the reservoir first
+        n_fill = min(max(self.max_points - len(self.x), 0), len(x))
+        self.x = np.concatenate([self.x, x[:n_fill]])
+        self.y = np.concatenate([self.y, y[:n_fill]])
+        # then, the i-th item of the stream replaces a random slot with probability max_points / (i + 1)
+        positions = self.n_seen + np.arange(n_fill, len(x))
+        slots = (self.rng.random(len(positions)) * (positions + 1)).astype(np.int64)
+        keep = slots < self.max_points
+        # with repeated slots, the last assignment wins, as in the sequential algorithm
+        self.x[slots[keep]] = x[n_fill:][keep]
+        self.y[slots[keep]] = y[n_fill:][keep]
+        self.n_seen += len(x)
+
+        return self
+
+
+def density_2d(x, y, bins: int=200) -> tuple:
+    """
+        2D histogram of the points: counts (bins x bins) and bin edges on the two axes.
+    """
+    x, y = np.asarray(x, dtype=np.float64).ravel(), np.asarray(y, dtype=np.float64).ravel()
+
+    return np.histogram2d(x, y, bins=bins)
+
+
+def reduce_points(x, y, mode: str='auto', max_points: int=10000, bins: int=200, seed: int=42) -> dict:
+    """
+        Reduce the points to a plot-ready dictionary of bounded size (except for 'scatter'). 'auto' is
+        'scatter' for at most max_points points, 'density' otherwise. Without points, any mode gives an
+        empty 'scatter', with no limits: there is nothing to bin.
+    """
+    x, y = np.asarray(x, dtype=np.float64).ravel(), np.asarray(y, dtype=np.float64).ravel()
+    if len(x) == 0:
+        return {'mode': 'scatter', 'n_points': 0, 'x_limits': None, 'y_limits': None, 'x': x, 'y': y}
+    if mode == 'auto':
+        mode = 'scatter' if len(x) <= max_points else 'density'
+    # limits are computed once here, vectorized, on all the points (not on the sample)
+    plot_data = {'mode': mode, 'n_points': len(x),
+                 'x_limits': (float(np.min(x)), float(np.max(x))), 'y_limits': (float(np.min(y)), float(np.max(y)))}
+    if mode == 'density':
+        counts, x_edges, y_edges = density_2d(x, y, bins=bins)
+        plot_data.update(counts=counts, x_edges=x_edges, y_edges=y_edges)
+    elif mode == 'sample':
+        sample = ReservoirSample(max_points=max_points, seed=seed).update(x, y)
+        plot_data.update(x=sample.x, y=sample.y)
+    elif mode == 'hexbin':
+        # at most (gridsize * oversampling) ** 2 weighted cell centers, whatever the number of points
+        counts, x_edges, y_edges = density_2d(x, y, bins=HEXBIN_GRIDSIZE * HEXBIN_OVERSAMPLING)
+        i, j = np.nonzero(counts)
+        plot_data.update(x=(x_edges[i] + x_edges[i + 1]) / 2, y=(y_edges[j] + y_edges[j + 1]) / 2, weights=counts[i, j])
+    elif mode == 'scatter':
+        plot_data.update(x=x, y=y)
+    else:
+        raise ValueError("Unknown plotting mode: {}".format(mode))
+
+    return plot_data
+
+
+def render_plot(plot_data: dict, plot_name: str, xlabel: str=None, ylabel: str=None, title: str=None,
+                with_diagonal: bool=False):
+    """
+        Render the reduced points and save the figure to disk.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LogNorm
+
+    fig, ax = plt.subplots()
+    mode = plot_data['mode']
+    if mode == 'density':
+        x_edges, y_edges = plot_data['x_edges'], plot_data['y_edges']
+        counts = np.ma.masked_equal(plot_data['counts'].T, 0)
+        image = ax.imshow(counts, origin='lower', aspect='auto', norm=LogNorm(), cmap='Blues',
+                          extent=[x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]])
+        fig.colorbar(image, ax=ax, label='points')
+    elif mode == 'hexbin':
+        image = ax.hexbin(plot_data['x'], plot_data['y'], C=plot_data['weights'], reduce_C_function=np.sum,
+                          gridsize=HEXBIN_GRIDSIZE, bins='log', cmap='Blues', mincnt=1,
+                          extent=plot_data['x_limits'] + plot_data['y_limits'])
+        fig.colorbar(image, ax=ax, label='points')
+    else:
+        ax.scatter(plot_data['x'], plot_data['y'], edgecolors=(0, 0, 1))
+    if with_diagonal and plot_data['y_limits'] is not None:
+        low, high = plot_data['y_limits']
+        ax.plot([low, high], [low, high], 'r--', lw=3)
+    if xlabel:
+        ax.set_xlabel(xlabel)
+    if ylabel:
+        ax.set_ylabel(ylabel)
+    if title:
+        ax.set_title(title)
+    fig.savefig(plot_name, bbox_inches='tight')
+    plt.close(fig)
+
+    return
+
+
+def save_plot(x, y, plot_name: str, mode: str='auto', max_points: int=10000, bins: int=200,
+              background: bool=True, **render_args):
+    """
+        Reduce the points in the current process, then render and save the plot in a background process
+        (returned, so the caller can join it if needed; the interpreter waits for it at exit anyway).
+        With background=False, the plot is rendered in the current process and None is returned.
+    """
+    plot_data = reduce_points(x, y, mode=mode, max_points=max_points, bins=bins)
+    if not background:
+        render_plot(plot_data, plot_name, **render_args)
+        return None
+    from multiprocessing import Process
+
+    process = Process(target=render_plot, args=(plot_data, plot_name), kwargs=render_args)
+    process.start()
+
+    return process
+
+
+def benchmark_plotting(n_points: int=1000000, seed: int=42) -> dict:
+    """
+        Time to produce the actual vs predicted plot, with all the points scattered vs the density image
+        (reduction in the foreground, rendering in the background, as in the scripts).
+    """
+    import os
+    import time
+    import tempfile
+
+    rng = np.random.default_rng(seed)
+    y_test = rng.standard_normal(n_points) * 30
+    y_predicted = y_test + rng.normal(0, 10, n_points)
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for mode in ['scatter', 'density', 'hexbin', 'sample']:
+            start = time.time()
+            process = save_plot(y_predicted, y_test, os.path.join(folder, '{}.png'.format(mode)), mode=mode,
+                                with_diagonal=True, xlabel='Predicted', ylabel='Actual')
+            results['{}_blocking_seconds'.format(mode)] = time.time() - start
+            process.join()
+            results['{}_total_seconds'.format(mode)] = time.time() - start
+    print(results)
+
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+
+    benchmark_plotting(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
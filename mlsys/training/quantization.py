@@ -0,0 +1,279 @@
+"""
+
+Reduced precision export of the served models: the artifacts we dump for serving store scikit internals
+as float64 arrays (TF-IDF weights, naive bayes `feature_log_prob_`, linear coefficients), even if serving
+does not need that precision. Here we quantize them, row by row:
+
+* 'float16': a plain cast (4x smaller than float64);
+* 'int8': an affine code per row (per class, for model weights), x ~ (q + 128) * scale + offset, with
+  scale and offset (float32) chosen so that the 256 codes span the row min-max range (8x smaller). Log probabilities are all negative and
+  IDF weights all above one, so the affine code does not waste half of the range on the sign.
+
+The quantized objects keep the API of the original ones (`transform` for vectorizers, `predict` for
+models), so the Flask app and the SageMaker endpoint can use them as they are. At prediction time, only
+the columns (words) actually in the request are de-quantized to float32, and the dot product runs in
+float32: the weights stay compact in memory, and a request touches a few small rows instead of the
+whole float64 matrix. Weights are stored as (words x classes), so that each word is one contiguous row.
+
+`parity_report` compares quantized and float64 models on the test split: accuracy (or MSE and R2),
+agreement of the predictions and size of the pickled artifacts.
+
+"""
+
+
+import pickle
+import numpy as np
+
+
+QUANTIZATION_DTYPES = ['float16', 'int8']
+
+
+def quantize_array(a, dtype: str='int8', axis: int=-1) -> dict:
+    """
+        Quantize an array. For int8, scale and offset are computed along axis: with the default, one per row
+        of a 2-D array (a single one for a 1-D array); with axis=0, one per column. Returns a dictionary of
+        numpy arrays, so that it can be stored without this module.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    if dtype == 'float16':
+        return {'dtype': dtype, 'data': a.astype(np.float16)}
+    if dtype != 'int8':
+        raise ValueError("Unknown quantization dtype: {}, use one of {}".format(dtype, QUANTIZATION_DTYPES))
+    offsets = a.min(axis=axis, keepdims=True)
+    scales = (a.max(axis=axis, keepdims=True) - offsets) / 255
+    # constant rows: any scale works, as long as it is not zero
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint((a - offsets) / scales) - 128, -128, 127).astype(np.int8)
+
+    return {'dtype': dtype, 'data': codes, 'scales': scales.astype(np.float32), 'offsets': offsets.astype(np.float32)}
+
+
+def dequantize_array(q: dict, index=None) -> np.ndarray:
+    """
+        Back to float32: the whole array, or only the given rows (a slice or an array of indices).
+    """
+    data = q['data'] if index is None else q['data'][index]
+    if q['dtype'] == 'float16':
+        return data.astype(np.float32)
+    scales, offsets = q['scales'], q['offsets']
+    # scales and offsets broadcast against the data, unless there is one per row
+    if index is not None and scales.shape[0] > 1:
+        scales, offsets = scales[index], offsets[index]
+
+    return (data.astype(np.float32) + 128) * scales + offsets
+
+
+def quantized_nbytes(q: dict) -> int:
+    return sum(v.nbytes for v in q.values() if isinstance(v, np.ndarray))
+
+
+def _sparse_dot(X, weights: dict) -> np.ndarray:
+    """
+        X @ W, with X a (n, words) CSR matrix and W the quantized (words, k) weights: only the rows of W for
+        the words in X are de-quantized.
+    """
+    from scipy.sparse import csr_matrix
+
+    X = csr_matrix(X)
+    columns, remapped = np.unique(X.indices, return_inverse=True)
+    X_columns = csr_matrix((X.data.astype(np.float32), remapped.ravel(), X.indptr), shape=(X.shape[0], len(columns)))
+
+    return np.asarray(X_columns @ dequantize_array(weights, columns))
+
+
+class QuantizedTfidfVectorizer(object):
+    """
+    Same output as a fitted TfidfVectorizer, with the idf weights quantized. The vocabulary is stored as a
+    list of words (smaller to pickle than the dict), and the tokenizer is re-built on first use.
+    """
+
+    def __init__(self, vectorizer, dtype: str='int8'):
+        self.params = {k: v for k, v in vectorizer.get_params().items() if k not in ['vocabulary', 'dtype']}
+        vocabulary = vectorizer.vocabulary_
+        self.terms = sorted(vocabulary, key=vocabulary.get)
+        # as a column, so that de-quantizing a subset of words is the same as for the model weights
+        self.idf = quantize_array(vectorizer.idf_.reshape(-1, 1), dtype, axis=0) if self.params['use_idf'] else None
+        self._counter = None
+
+        return
+
+    def __getstate__(self):
+        return dict(self.__dict__, _counter=None)
+
+    def _get_counter(self):
+        if self._counter is None:
+            from sklearn.feature_extraction.text import CountVectorizer
+            params = {k: v for k, v in self.params.items() if k not in ['norm', 'use_idf', 'smooth_idf', 'sublinear_tf']}
+            self._counter = CountVectorizer(**dict(params, vocabulary={t: i for i, t in enumerate(self.terms)}))
+
+        return self._counter
+
+    def transform(self, raw_documents):
+        from sklearn.preprocessing import normalize
+
+        X = self._get_counter().transform(raw_documents).astype(np.float32)
+        if self.params['sublinear_tf']:
+            np.log(X.data, X.data)
+            X.data += 1
+        if self.idf is not None:
+            X.data *= dequantize_array(self.idf, X.indices).ravel()
+        if self.params['norm']:
+            X = normalize(X, norm=self.params['norm'], copy=False)
+
+        return X
+
+    @property
+    def nbytes(self) -> int:
+        return quantized_nbytes(self.idf) if self.idf is not None else 0
+
+
+class QuantizedLinearModel(object):
+    """
+    Prediction with quantized weights for models scoring X @ W + b: MultinomialNB (feature_log_prob_ and
+    class_log_prior_), and linear classifiers or regressors (coef_ and intercept_).
+    """
+
+    def __init__(self, model, dtype: str='int8'):
+        if hasattr(model, 'feature_log_prob_'):
+            weights, bias = model.feature_log_prob_, model.class_log_prior_
+        elif hasattr(model, 'coef_'):
+            weights, bias = np.atleast_2d(model.coef_), model.intercept_
+        else:
+            raise ValueError("Cannot quantize {}: no feature_log_prob_ or coef_".format(type(model).__name__))
+        self.is_classifier = hasattr(model, 'classes_')
+        self.classes_ = getattr(model, 'classes_', None)
+        # stored as one row per word, with a scale and offset per class (i.e. per row of the original matrix)
+        self.weights = quantize_array(np.asarray(weights).T, dtype, axis=0)
+        self.bias = np.atleast_1d(np.asarray(bias, dtype=np.float32))
+        self.is_1d_coef = not self.is_classifier and np.ndim(model.coef_) == 1
+
+        return
+
+    @property
+    def nbytes(self) -> int:
+        return quantized_nbytes(self.weights) + self.bias.nbytes
+
+    def decision_function(self, X) -> np.ndarray:
+        from scipy.sparse import issparse
+
+        if issparse(X):
+            scores = _sparse_dot(X, self.weights)
+        else:
+            scores = np.asarray(X, dtype=np.float32) @ dequantize_array(self.weights)
+
+        return scores + self.bias
+
+    def predict(self, X) -> np.ndarray:
+        scores = self.decision_function(X)
+        if not self.is_classifier:
+            return scores.ravel() if self.is_1d_coef else scores
+        if scores.shape[1] == 1:
+            # binary linear classifiers have a single column of scores
+            return self.classes_[(scores.ravel() > 0).astype(int)]
+
+        return self.classes_[scores.argmax(axis=1)]
+
+
+def can_quantize(model) -> bool:
+    """
+        Whether QuantizedLinearModel supports the model, fitted or not: naive bayes and the scikit linear
+        models, but not e.g. the Perceptron of linear_models.py, which stores its weights differently.
+    """
+    if hasattr(model, 'feature_log_prob_') or hasattr(model, 'coef_'):
+        return True
+    module = type(model).__module__
+
+    return module.startswith('sklearn.naive_bayes') or module.startswith('sklearn.linear_model')
+
+
+def quantize_for_serving(vectorizer, model, dtype: str='int8') -> tuple:
+    """
+        Quantized (vectorizer, model) pair for the Flask app. Hashing vectorizers have no weights, and are
+        returned as they are.
+    """
+    if hasattr(vectorizer, 'idf_'):
+        vectorizer = QuantizedTfidfVectorizer(vectorizer, dtype)
+
+    return vectorizer, QuantizedLinearModel(model, dtype)
+
+
+def quantize_regression(model, dtype: str='int8') -> dict:
+    """
+        A linear regression as a dictionary of numpy arrays, so that the SageMaker entrypoint can load it
+        without this module (see sagemaker_entrypoint_script.py).
+    """
+    return {'format': 'quantized_linear_regression', 'coef': quantize_array(np.atleast_2d(model.coef_), dtype),
+            'intercept': np.atleast_1d(np.asarray(model.intercept_, dtype=np.float64)),
+            'coef_ndim': np.ndim(model.coef_)}
+
+
+def parity_report(reference_model, quantized_model, X_test, y_test, reference_vectorizer=None,
+                  quantized_vectorizer=None) -> dict:
+    """
+        Compare the float64 and the quantized pipelines on the test split. With vectorizers, X_test is the
+        raw text; without, the features. Classifiers report accuracy and agreement, regressors MSE and R2
+        and the max absolute difference of the predictions.
+    """
+    from sklearn.metrics import accuracy_score, mean_squared_error, r2_score
+
+    X_reference = reference_vectorizer.transform(X_test) if reference_vectorizer is not None else X_test
+    X_quantized = quantized_vectorizer.transform(X_test) if quantized_vectorizer is not None else X_test
+    reference = reference_model.predict(X_reference)
+    quantized = quantized_model.predict(X_quantized)
+    objects = [o for o in [reference_vectorizer, reference_model] if o is not None]
+    quantized_objects = [o for o in [quantized_vectorizer, quantized_model] if o is not None]
+    report = {
+        'reference_bytes': sum(len(pickle.dumps(o, protocol=pickle.HIGHEST_PROTOCOL)) for o in objects),
+        'quantized_bytes': sum(len(pickle.dumps(o, protocol=pickle.HIGHEST_PROTOCOL)) for o in quantized_objects)
+    }
+    if getattr(quantized_model, 'is_classifier', True):
+        report.update({'reference_accuracy': accuracy_score(y_test, reference),
+                       'quantized_accuracy': accuracy_score(y_test, quantized),
+                       'agreement': float(np.mean(reference == quantized))})
+    else:
+        report.update({'reference_mse': mean_squared_error(y_test, reference),
+                       'quantized_mse': mean_squared_error(y_test, quantized),
+                       'reference_r2': r2_score(y_test, reference), 'quantized_r2': r2_score(y_test, quantized),
+                       'max_abs_diff': float(np.max(np.abs(np.asarray(reference) - quantized)))})
+    print("Quantization parity: {}".format(report))
+
+    return report
+
+
+def benchmark_quantization(n_sentences: int=40000, vocabulary_size: int=50000) -> list:
+    """
+        Parity, size and latency (one sentence at a time, as in the app) of float64, float16 and int8
+        TF-IDF + naive bayes, on a synthetic corpus with a large vocabulary.
+    """
+    import time
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.naive_bayes import MultinomialNB
+
+    rng = np.random.default_rng(42)
+    ranks = rng.zipf(1.2, size=(n_sentences, 20)) % vocabulary_size
+    sentences = [' '.join('w{}'.format(r) for r in row) for row in ranks]
+    # labels depend on mid-frequency words, so that the model has something to learn
+    labels = [int(np.bincount([r % 3 for r in row if 10 <= r < 5000], minlength=3).argmax()) for row in ranks]
+    split = int(0.8 * n_sentences)
+    vectorizer = TfidfVectorizer()
+    model = MultinomialNB().fit(vectorizer.fit_transform(sentences[:split]), labels[:split])
+    results = []
+    for dtype in [None] + QUANTIZATION_DTYPES:
+        v, m = (vectorizer, model) if dtype is None else quantize_for_serving(vectorizer, model, dtype)
+        report = parity_report(model, m, sentences[split:], labels[split:], vectorizer, v)
+        start = time.perf_counter()
+        latency_sample = sentences[split:split + 1000]
+        for s in latency_sample:
+            m.predict(v.transform([s]))
+        report.update({'dtype': dtype or 'float64',
+                       'latency_ms': 1000 * (time.perf_counter() - start) / len(latency_sample)})
+        results.append(report)
+    for r in results:
+        print("{:>8}: accuracy {:.4f}, agreement {:.4f}, {:>9} bytes, {:.3f} ms / sentence".format(
+            r['dtype'], r['quantized_accuracy'], r['agreement'], r['quantized_bytes'], r['latency_ms']))
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_quantization()
@@ -1,9 +1,31 @@
 import argparse
 import joblib
 import os
+import numpy as np
 
 
-def model_fn(model_dir):
-    return joblib.load(os.path.join(model_dir, "model/model.joblib"))
+def dequantize_linear_regression(artifact: dict):
+    """
+    Re-build a LinearRegression from the dict written by quantization.quantize_regression: the endpoint
+    only receives this script, so it cannot import the quantization module.
+    """
+    from sklearn.linear_model import LinearRegression
+
+    coef = artifact['coef']
+    if coef['dtype'] == 'float16':
+        values = coef['data'].astype(np.float64)
+    else:
+        values = (coef['data'].astype(np.float64) + 128) * coef['scales'] + coef['offsets']
+    model = LinearRegression()
+    model.coef_ = values.ravel() if artifact['coef_ndim'] == 1 else values
+    model.intercept_ = artifact['intercept'][0] if artifact['coef_ndim'] == 1 else artifact['intercept']
+
+    return model
 
 
+def model_fn(model_dir):
+    model = joblib.load(os.path.join(model_dir, "model/model.joblib"))
+    if isinstance(model, dict) and model.get('format') == 'quantized_linear_regression':
+        model = dequantize_linear_regression(model)
+
+    return model
@@ -14,6 +14,7 @@ MAKE SURE TO RUN THIS WITH METAFLOW S3 DATASTORE, so that we can upload the arti
 from metaflow import FlowSpec, step, Parameter, IncludeFile, current, S3
 from datetime import datetime
 import os
+from instrumentation import instrument
 
 
 # make sure we are running Metaflow with S3 for this script
@@ -39,7 +40,15 @@ class SampleRegressionFlowDeploy(FlowSpec):
         default=0.20
     )
 
+    # 'float16' or 'int8' deploy the coefficients in reduced precision (see quantization.py)
+    QUANTIZE = Parameter(
+        name='quantize',
+        help='Precision of the deployed coefficients: none, float16 or int8',
+        default='none'
+    )
+
     @step
+    @instrument()
     def start(self):
         """
         Start up and print out some info to make sure everything is ok metaflow-side
@@ -48,45 +57,68 @@ class SampleRegressionFlowDeploy(FlowSpec):
         print("flow name: %s" % current.flow_name)
         print("run id: %s" % current.run_id)
         print("username: %s" % current.username)
+        # check --quantize now, not after training and testing: the model is quantized when deployed
+        from quantization import QUANTIZATION_DTYPES
+
+        assert self.QUANTIZE in ['none'] + QUANTIZATION_DTYPES, \
+            "--quantize must be one of {}, got {}".format(['none'] + QUANTIZATION_DTYPES, self.QUANTIZE)
         self.next(self.load_data)
 
     @step
+    @instrument(rows=lambda _, flow: len(flow.Ys), artifacts=['dataset', 'Xs', 'Ys'])
     def load_data(self): 
         """
         Read the data in from the static file
         """
         from io import StringIO
+        import numpy as np
 
         raw_data = StringIO(self.DATA_FILE).readlines()
         print("Total of {} rows in the dataset!".format(len(raw_data)))
         self.dataset = [[float(_) for _ in d.strip().split('\t')] for d in raw_data]
         print("Raw data: {}, cleaned data: {}".format(raw_data[0].strip(), self.dataset[0]))
-        self.Xs = [[_[0]] for _ in self.dataset]
-        self.Ys =  [_[1] for _ in self.dataset]
+        self.Xs = np.array([[_[0]] for _ in self.dataset])
+        self.Ys = np.array([_[1] for _ in self.dataset])
         self.next(self.check_dataset)
 
     @step
+    @instrument(rows=lambda _, flow: len(flow.Ys), artifacts=['validation_report'])
     def check_dataset(self):
         """
-        Check data is ok before training starts
+        Check data is ok before training starts: all the expectations are evaluated
+        and stored in a report, before failing the step if any of them is not met
         """
-        assert(all(y < 100 and y > -100 for y in self.Ys))
+        from data_validation import validate, warn_only, ExpectNotNull, ExpectBetween, ExpectDuplicateRateBelow
+
+        expectations = [
+            ExpectNotNull('X'),
+            ExpectNotNull('Y'),
+            ExpectBetween('Y', min_value=-100, max_value=100),
+            # duplicated Xs are reported, not a reason to stop the run
+            warn_only(ExpectDuplicateRateBelow('X', max_rate=0.01))
+        ]
+        self.validation_report = validate([{'X': self.Xs[:, 0], 'Y': self.Ys}], expectations)
+        print(self.validation_report)
+        assert self.validation_report.success
         self.next(self.prepare_train_and_test_dataset)
 
     @step
+    @instrument(rows=lambda _, flow: len(flow.Ys), artifacts=['train_index', 'test_index'])
     def prepare_train_and_test_dataset(self):
-        from sklearn.model_selection import train_test_split
+        """
+        Assign each (x, y) row to train or test from a hash of its content (see hash_split.py): the
+        split does not depend on the order of the rows, and can be computed row by row. We store the
+        indices of the train and test rows, not copies of the data: steps index Xs and Ys when needed
+        """
+        from hash_split import hash_split_indices
 
-        self.X_train, self.X_test, self.y_train, self.y_test = train_test_split(
-            self.Xs, 
-            self.Ys, 
-            test_size=self.TEST_SPLIT, 
-            random_state=42
-            )
+        self.train_index, self.test_index = hash_split_indices(zip(self.Xs, self.Ys),
+                                                               test_size=float(self.TEST_SPLIT), salt='42')
 
         self.next(self.train_model)
 
     @step
+    @instrument(rows=lambda _, flow: len(flow.train_index), artifacts=['model'])
     def train_model(self):
         """
         Train a regression on the training set
@@ -94,28 +126,32 @@ class SampleRegressionFlowDeploy(FlowSpec):
         from sklearn import linear_model
 
         reg = linear_model.LinearRegression()
-        reg.fit(self.X_train, self.y_train)
+        reg.fit(self.Xs[self.train_index], self.Ys[self.train_index])
         print("Coefficient {}, intercept {}".format(reg.coef_[0], reg.intercept_))
         # now, make sure the model is available downstream
         self.model = reg
         self.next(self.test_model)
 
     @step 
+    @instrument(rows=lambda _, flow: len(flow.test_index), artifacts=['y_predicted'])
     def test_model(self):
         """
         Test the model on the hold out sample
         """
-        from sklearn import metrics
+        from streaming_metrics import RegressionAccumulator, evaluate_in_chunks
 
-        self.y_predicted = self.model.predict(self.X_test)
-        self.mse = metrics.mean_squared_error(self.y_test, self.y_predicted)
-        self.r2 = metrics.r2_score(self.y_test, self.y_predicted)
+        # predict chunk by chunk, folding each chunk into running sums for MSE and R2
+        accumulator, self.y_predicted = evaluate_in_chunks(self.model, self.Xs, self.Ys, RegressionAccumulator(),
+                                                           keep_predictions=True, index=self.test_index)
+        self.mse = accumulator.mse
+        self.r2 = accumulator.r2
         print('MSE is {}, R2 score is {}'.format(self.mse, self.r2))
         test_predictions = self.model.predict([[10]])
         print("Test prediction is {}".format(test_predictions))
         self.next(self.deploy_model_to_sagemaker)
 
     @step
+    @instrument(artifacts=['model_s3_path'])
     def deploy_model_to_sagemaker(self):
         """
         Deploy trained model on SageMaker
@@ -126,14 +162,21 @@ class SampleRegressionFlowDeploy(FlowSpec):
         import shutil
         import tarfile
         from sagemaker.sklearn import SKLearnModel
+        from quantization import QuantizedLinearModel, quantize_regression, parity_report
 
 
         model_name = "model"
         local_tar_name = "model.tar.gz"
 
         os.makedirs(model_name, exist_ok=True)
-        # save model to local folder
-        joblib.dump(self.model, "{}/{}.joblib".format(model_name, model_name))
+        # save model to local folder: quantized models are saved as a dict of arrays, which the
+        # entrypoint script turns back into a LinearRegression (see model_fn)
+        artifact = self.model
+        if self.QUANTIZE != 'none':
+            self.quantization_report = parity_report(self.model, QuantizedLinearModel(self.model, self.QUANTIZE),
+                                                     self.Xs[self.test_index], self.Ys[self.test_index])
+            artifact = quantize_regression(self.model, self.QUANTIZE)
+        joblib.dump(artifact, "{}/{}.joblib".format(model_name, model_name))
         # save model as tar.gz
         with tarfile.open(local_tar_name, mode="w:gz") as _tar:
             _tar.add(model_name, recursive=True)
@@ -165,6 +208,7 @@ class SampleRegressionFlowDeploy(FlowSpec):
         self.next(self.end)
 
     @step
+    @instrument()
     def end(self):
         print("All done at {}!\n See you, space cowboys!".format(datetime.utcnow()))
 
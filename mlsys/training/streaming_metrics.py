@@ -0,0 +1,211 @@
+"""
+
+Streaming, bounded-memory evaluation metrics: instead of predicting the entire test split in one call
+and handing the full arrays to scikit metrics, we predict chunk by chunk and update small accumulators:
+
+* a running confusion matrix for classification, from which we re-compute precision, recall, f1 and
+  the same report as sklearn's classification_report;
+* running count, mean, sum of squared deviations (Welford / Chan et al.) and sum of squared errors
+  for regression, giving MSE and R2.
+
+Accumulators computed on different shards (e.g. in different processes) can be merged, so evaluation
+can also run in parallel. Results are the same as the scikit metrics, up to floating point rounding
+in the last digits for the regression sums.
+
+"""
+
+
+import numpy as np
+
+
+class RegressionAccumulator(object):
+    """
+    Running MSE and R2: the state is just four numbers, whatever the size of the test set.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        # sum of squared deviations of y_true from its (running) mean
+        self.m2 = 0.0
+        # sum of squared errors
+        self.sse = 0.0
+
+        return
+
+    def _combine(self, count: int, mean: float, m2: float, sse: float):
+        """
+            Chan et al. pairwise update: merge the statistics of another batch into the current ones.
+        """
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.mean += delta * count / total
+        self.sse += sse
+        self.count = total
+
+        return
+
+    def update(self, y_true, y_pred):
+        y_true = np.asarray(y_true, dtype=np.float64).ravel()
+        y_pred = np.asarray(y_pred, dtype=np.float64).ravel()
+        if len(y_true) == 0:
+            return self
+        batch_mean = float(y_true.mean())
+        self._combine(len(y_true), batch_mean, float(((y_true - batch_mean) ** 2).sum()),
+                      float(((y_true - y_pred) ** 2).sum()))
+
+        return self
+
+    def merge(self, other):
+        self._combine(other.count, other.mean, other.m2, other.sse)
+
+        return self
+
+    @property
+    def mse(self) -> float:
+        return self.sse / self.count
+
+    @property
+    def r2(self) -> float:
+        # as in sklearn.metrics.r2_score, a constant y_true gives 1.0 for perfect predictions, 0.0 otherwise
+        if self.m2 == 0:
+            return 1.0 if self.sse == 0 else 0.0
+
+        return 1.0 - self.sse / self.m2
+
+
+class ConfusionMatrixAccumulator(object):
+    """
+    Running confusion matrix for integer class labels in [0, n_classes): rows are true labels,
+    columns predicted labels.
+    """
+
+    def __init__(self, n_classes: int):
+        self.n_classes = n_classes
+        self.matrix = np.zeros((n_classes, n_classes), dtype=np.int64)
+
+        return
+
+    def update(self, y_true, y_pred):
+        y_true = np.asarray(y_true, dtype=np.int64).ravel()
+        y_pred = np.asarray(y_pred, dtype=np.int64).ravel()
+        # one bincount over the flattened (true, predicted) cell index
+        cells = np.bincount(y_true * self.n_classes + y_pred, minlength=self.n_classes ** 2)
+        self.matrix += cells.reshape(self.n_classes, self.n_classes)
+
+        return self
+
+    def merge(self, other):
+        self.matrix += other.matrix
+
+        return self
+
+    @property
+    def count(self) -> int:
+        return int(self.matrix.sum())
+
+    @property
+    def accuracy(self) -> float:
+        return np.trace(self.matrix) / max(self.count, 1)
+
+    @property
+    def labels(self) -> list:
+        """
+            As in sklearn, the labels in the report are the ones seen either as true or as predicted values.
+        """
+        return np.flatnonzero(self.matrix.sum(axis=0) + self.matrix.sum(axis=1)).tolist()
+
+    def precision_recall_f1_support(self) -> tuple:
+        """
+            Per-label precision, recall, f1 and support (labels as in self.labels); 0 where undefined.
+        """
+        matrix = self.matrix[np.ix_(self.labels, self.labels)].astype(np.float64)
+        true_positives = np.diag(matrix)
+        predicted, support = matrix.sum(axis=0), matrix.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.where(predicted > 0, true_positives / predicted, 0.0)
+            recall = np.where(support > 0, true_positives / support, 0.0)
+            f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+
+        return precision, recall, f1, support.astype(np.int64)
+
+    def classification_report(self, digits: int=2) -> str:
+        """
+            Same text as sklearn.metrics.classification_report(y_true, y_pred), from the matrix alone.
+        """
+        precision, recall, f1, support = self.precision_recall_f1_support()
+        names = [str(_) for _ in self.labels]
+        total = int(support.sum())
+        width = max(max(len(_) for _ in names), len('weighted avg'), digits)
+        headers = ['precision', 'recall', 'f1-score', 'support']
+        row_format = '{:>{width}s} ' + ' {:>9.{digits}f}' * 3 + ' {:>9}\n'
+        report = ('{:>{width}s} ' + ' {:>9}' * len(headers)).format('', *headers, width=width) + '\n\n'
+        for row in zip(names, precision, recall, f1, support):
+            report += row_format.format(*row, width=width, digits=digits)
+        report += '\n'
+        report += ('{:>{width}s} ' + ' {:>9.{digits}}' * 2 + ' {:>9.{digits}f}' + ' {:>9}\n').format(
+            'accuracy', '', '', self.accuracy, total, width=width, digits=digits)
+        report += row_format.format('macro avg', precision.mean(), recall.mean(), f1.mean(), total,
+                                    width=width, digits=digits)
+        weights = support / max(total, 1)
+        report += row_format.format('weighted avg', (precision * weights).sum(), (recall * weights).sum(),
+                                    (f1 * weights).sum(), total, width=width, digits=digits)
+
+        return report
+
+
+def predict_in_chunks(model, X, chunk_size: int=10000, index=None):
+    """
+        Yield (start, end, predictions) for consecutive chunks of rows of X (a list, an array
+        or a sparse matrix), so that only one chunk of predictions is in memory at a time. With an
+        index array (e.g. the test rows of a split), the chunks are X[index[start:end]]: the rows
+        are gathered one chunk at a time, and never copied as a whole.
+    """
+    n_rows = len(index) if index is not None else (X.shape[0] if hasattr(X, 'shape') else len(X))
+    for start in range(0, n_rows, chunk_size):
+        end = min(start + chunk_size, n_rows)
+        yield start, end, model.predict(X[start:end] if index is None else X[index[start:end]])
+
+
+def evaluate_in_chunks(model, X, y, accumulator, chunk_size: int=10000, keep_predictions: bool=False,
+                       index=None):
+    """
+        Predict X chunk by chunk, updating the accumulator with the true values in y. If keep_predictions
+        is True, also return all the predictions (e.g. for plots or slice-based tests), else None.
+        index restricts the evaluation to some rows of X and y (arrays), as in predict_in_chunks.
+    """
+    predictions = []
+    for start, end, y_predicted in predict_in_chunks(model, X, chunk_size, index=index):
+        accumulator.update(y[start:end] if index is None else y[index[start:end]], y_predicted)
+        if keep_predictions:
+            predictions.append(y_predicted)
+
+    return accumulator, np.concatenate(predictions) if keep_predictions and predictions else None
+
+
+def _evaluate_shard(args):
+    model, X, y, accumulator, chunk_size = args
+
+    return evaluate_in_chunks(model, X, y, accumulator, chunk_size)[0]
+
+
+def evaluate_in_parallel(model, X, y, make_accumulator, n_jobs: int=2, chunk_size: int=10000):
+    """
+        Split the rows in n_jobs shards, evaluate each shard in a separate process, and merge the
+        partial accumulators. make_accumulator returns a new, empty accumulator.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    n_rows = X.shape[0] if hasattr(X, 'shape') else len(X)
+    bounds = np.linspace(0, n_rows, n_jobs + 1).astype(int)
+    shards = [(model, X[start:end], y[start:end], make_accumulator(), chunk_size)
+              for start, end in zip(bounds[:-1], bounds[1:])]
+    accumulator = make_accumulator()
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        for partial in executor.map(_evaluate_shard, shards):
+            accumulator.merge(partial)
+
+    return accumulator
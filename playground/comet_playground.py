@@ -29,10 +29,9 @@ print("Running experiment for project: {}".format(os.environ['MY_PROJECT_NAME'])
 from comet_ml import Experiment
 import numpy as np
 from sklearn.datasets import load_breast_cancer
-from sklearn.model_selection import train_test_split, GridSearchCV
-from sklearn.linear_model import LogisticRegression
-from sklearn.preprocessing import StandardScaler
+from sklearn.model_selection import train_test_split
 from sklearn.metrics import f1_score, precision_score, recall_score, confusion_matrix
+from model_selection import ResultStore, run_model_selection
 
 
 def main():
@@ -54,22 +53,22 @@ def main():
         stratify=cancer.target,
         random_state=random_state)
 
-    scaler = StandardScaler()
-    X_train_scaled = scaler.fit_transform(X_train)
-    X_test_scaled = scaler.transform(X_test)
-
-    logreg = LogisticRegression()
+    # results are stored locally first, and sent to Comet in the background
+    store = ResultStore('comet_results.jsonl', tracker=exp)
 
     param_grid = {'C':[0.001,0.01,0.1,1,5,10,20,50,100]}
 
-    clf = GridSearchCV(logreg,
-                        param_grid=param_grid,
-                        cv=10,
-                        n_jobs=-1)
-
-    clf.fit(X_train_scaled, y_train)
+    # cross-validation with cached folds / scalers and warm starts, see model_selection.py
+    selection = run_model_selection(X_train,
+                                    y_train,
+                                    c_values=param_grid['C'],
+                                    cv=10,
+                                    n_jobs=-1,
+                                    store=store)
+    # the model is a pipeline (scaler + logistic regression), so we feed it the raw features
+    clf = selection['model']
 
-    y_pred = clf.predict(X_test_scaled)
+    y_pred = clf.predict(X_test)
 
     print("\nResults\nConfusion matrix \n {}".format(confusion_matrix(y_test, y_pred)))
 
@@ -94,9 +93,11 @@ def main():
     "precision":precision
     }
 
-    exp.log_dataset_hash(X_train_scaled)
-    exp.log_parameters(params)
-    exp.log_metrics(metrics)
+    exp.log_dataset_hash(X_train)
+    store.append('parameters', params)
+    store.append('metrics', metrics)
+    # make sure everything reached Comet before exiting
+    store.close()
 
     return
 
@@ -0,0 +1,240 @@
+"""
+
+Model selection runner for the Comet playground: it does the same job as GridSearchCV over the C values
+of a logistic regression, but avoids re-doing work across grid points:
+
+* fold splits are computed once, and the StandardScaler of each fold is fitted once and cached;
+* for each fold, the C values are visited in increasing order, warm-starting each model from the
+  previous solution along the regularization path;
+* folds run in parallel;
+* every result is appended to a local JSONL file first, and flushed to the experiment tracker (e.g. a
+  Comet Experiment) in batches by a background thread, so that logging never blocks training.
+
+LocalTracker is a stand-in for the Comet Experiment, which records calls in memory and can be used
+to run everything offline. From the command line you can compare the runner with the current script:
+
+python model_selection.py
+
+"""
+
+import json
+import os
+import logging
+import threading
+import time
+import numpy as np
+
+
+class LocalTracker:
+    """
+    Local stand-in for a Comet Experiment: same logging methods, calls are kept in memory.
+    """
+
+    def __init__(self, latency: float=0.0):
+        # optionally simulate the network round-trip of a remote tracker
+        self.latency = latency
+        self.metrics = []
+        self.parameters = []
+
+    def log_metrics(self, metrics: dict, step: int=None):
+        time.sleep(self.latency)
+        self.metrics.append((step, dict(metrics)))
+
+    def log_parameters(self, parameters: dict, step: int=None):
+        time.sleep(self.latency)
+        self.parameters.append((step, dict(parameters)))
+
+
+class ResultStore:
+    """
+    Append-only local store (one json record per line) that flushes records to a tracker
+    asynchronously, in batches, from a background thread. Records the tracker fails to take are
+    kept, in order, and sent again at the next flush; they are always in the local file anyway.
+    """
+
+    def __init__(self, path: str, tracker=None, batch_size: int=50, flush_interval: float=1.0):
+        self.path = path
+        self.tracker = tracker
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._lock = threading.Lock()
+        # one flush at a time (background thread or close), so records reach the tracker in order
+        self._flush_lock = threading.Lock()
+        self._wake_up = threading.Event()
+        self._stopped = False
+        self._file = open(path, 'a')
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+
+    def append(self, kind: str, payload: dict, step: int=None):
+        """
+            Store a record locally (cheap), and queue it for the tracker. kind is 'metrics' or 'parameters'.
+        """
+        record = {'kind': kind, 'step': step, 'payload': payload, 'ts': time.time()}
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+            self._pending.append(record)
+            if len(self._pending) >= self.batch_size:
+                self._wake_up.set()
+
+    def _flush_loop(self):
+        while not self._stopped:
+            self._wake_up.wait(self.flush_interval)
+            self._wake_up.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """
+            Send the pending records to the tracker, in order, stopping at the first error: the records
+            not sent go back to the front of the queue. Returns the number of records left to send.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._file.flush()
+            if self.tracker is None:
+                return 0
+            for i, record in enumerate(batch):
+                try:
+                    if record['kind'] == 'metrics':
+                        self.tracker.log_metrics(record['payload'], step=record['step'])
+                    else:
+                        self.tracker.log_parameters(record['payload'], step=record['step'])
+                except Exception as e:
+                    logging.getLogger('model_selection').warning(
+                        "Tracker error, {} records will be sent again: {!r}".format(len(batch) - i, e))
+                    with self._lock:
+                        self._pending = batch[i:] + self._pending
+                    break
+            with self._lock:
+                return len(self._pending)
+
+    def close(self):
+        """
+            Stop the background thread and flush whatever is left.
+        """
+        self._stopped = True
+        self._wake_up.set()
+        self._thread.join()
+        left = self.flush()
+        if left:
+            logging.getLogger('model_selection').error(
+                "{} records were not sent to the tracker, they are in {}".format(left, self.path))
+        self._file.close()
+
+
+def get_cached_folds(X, y, cv: int=10, seed: int=42) -> list:
+    """
+        Compute the stratified fold splits once, and fit a StandardScaler on the training part
+        of each fold: the scaled arrays are re-used for every point of the grid.
+    """
+    from sklearn.model_selection import StratifiedKFold
+    from sklearn.preprocessing import StandardScaler
+
+    folds = []
+    for train_idx, val_idx in StratifiedKFold(n_splits=cv, shuffle=True, random_state=seed).split(X, y):
+        scaler = StandardScaler().fit(X[train_idx])
+        folds.append((scaler.transform(X[train_idx]), y[train_idx], scaler.transform(X[val_idx]), y[val_idx]))
+
+    return folds
+
+
+def _regularization_path(fold: tuple, c_values: list, max_iter: int) -> list:
+    """
+        Fit a logistic regression for each C (in increasing order) on one fold, warm-starting
+        from the previous solution, and return the validation accuracy for each C.
+    """
+    from sklearn.linear_model import LogisticRegression
+
+    X_train, y_train, X_val, y_val = fold
+    model = LogisticRegression(warm_start=True, max_iter=max_iter)
+    scores = []
+    for c in c_values:
+        model.set_params(C=c)
+        model.fit(X_train, y_train)
+        scores.append(model.score(X_val, y_val))
+
+    return scores
+
+
+def run_model_selection(X, y, c_values: list, cv: int=10, n_jobs: int=-1, store: ResultStore=None,
+                        max_iter: int=100, seed: int=42) -> dict:
+    """
+        Cross-validated grid search over C: returns the best C, the mean validation score per C,
+        and the final model (scaler + logistic regression) refitted on all the data.
+    """
+    from joblib import Parallel, delayed
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    c_values = sorted(c_values)
+    folds = get_cached_folds(X, y, cv=cv, seed=seed)
+    # folds are independent, while the C values of a fold are visited sequentially to warm start
+    fold_scores = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(_regularization_path)(fold, c_values, max_iter) for fold in folds)
+    mean_scores = np.mean(fold_scores, axis=0)
+    best_c = c_values[int(np.argmax(mean_scores))]
+    if store is not None:
+        for step, (c, score) in enumerate(zip(c_values, mean_scores)):
+            store.append('metrics', {'C': c, 'mean_cv_accuracy': float(score)}, step=step)
+        store.append('parameters', {'best_C': best_c, 'cv': cv})
+    model = make_pipeline(StandardScaler(), LogisticRegression(C=best_c, max_iter=max_iter)).fit(X, y)
+
+    return {'best_C': best_c, 'mean_scores': dict(zip(c_values, mean_scores.tolist())), 'model': model}
+
+
+def benchmark_against_grid_search(repeats: int=3, latency: float=0.05) -> dict:
+    """
+        Compare wall-clock time with the current playground script (StandardScaler + GridSearchCV with cv=10,
+        plus synchronous logging to a tracker), using LocalTracker with a simulated network latency per call.
+        Compute (the search alone) and end-to-end (search + logging) times are reported separately: most of
+        the end-to-end gain comes from not waiting for the tracker, and depends on the simulated latency.
+    """
+    import tempfile
+    from sklearn.datasets import load_breast_cancer
+    from sklearn.model_selection import train_test_split, GridSearchCV
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.preprocessing import StandardScaler
+
+    cancer = load_breast_cancer()
+    X_train, _, y_train, _ = train_test_split(cancer.data, cancer.target, stratify=cancer.target, random_state=42)
+    c_values = [0.001, 0.01, 0.1, 1, 5, 10, 20, 50, 100]
+
+    baseline_compute, baseline_total = 0.0, 0.0
+    for _ in range(repeats):
+        tracker = LocalTracker(latency=latency)
+        start = time.time()
+        X_scaled = StandardScaler().fit_transform(X_train)
+        clf = GridSearchCV(LogisticRegression(), param_grid={'C': c_values}, cv=10, n_jobs=-1).fit(X_scaled, y_train)
+        baseline_compute += (time.time() - start) / repeats
+        for step, (c, score) in enumerate(zip(c_values, clf.cv_results_['mean_test_score'])):
+            tracker.log_metrics({'C': c, 'mean_cv_accuracy': score}, step=step)
+        baseline_total += (time.time() - start) / repeats
+
+    runner_compute, runner_total = 0.0, 0.0
+    with tempfile.TemporaryDirectory() as folder:
+        for _ in range(repeats):
+            start = time.time()
+            run_model_selection(X_train, y_train, c_values, cv=10)
+            runner_compute += (time.time() - start) / repeats
+            store = ResultStore(os.path.join(folder, 'results.jsonl'), tracker=LocalTracker(latency=latency))
+            start = time.time()
+            run_model_selection(X_train, y_train, c_values, cv=10, store=store)
+            # the time until results are available, not the time to flush them in the background
+            runner_total += (time.time() - start) / repeats
+            store.close()
+
+    results = {'grid_search_compute_seconds': baseline_compute, 'runner_compute_seconds': runner_compute,
+               'compute_speedup': baseline_compute / runner_compute,
+               'grid_search_with_logging_seconds': baseline_total, 'runner_with_logging_seconds': runner_total,
+               'end_to_end_speedup': baseline_total / runner_total,
+               'simulated_tracker_latency_seconds': latency}
+    print(results)
+
+    return results
+
+
+if __name__ == "__main__":
+    benchmark_against_grid_search()
@@ -0,0 +1,97 @@
+"""
+
+Tests for model_selection.py, run offline with LocalTracker standing in for the Comet experiment:
+
+python -m pytest test_model_selection.py
+
+"""
+
+import json
+import os
+import time
+import numpy as np
+from model_selection import LocalTracker, ResultStore, run_model_selection
+
+
+class FlakyTracker(LocalTracker):
+    """
+    LocalTracker failing the calls whose (1-based) number is in fail_on, as a remote tracker may.
+    """
+
+    def __init__(self, fail_on: tuple=()):
+        super().__init__()
+        self.fail_on = fail_on
+        self.calls = 0
+
+    def log_metrics(self, metrics: dict, step: int=None):
+        self.calls += 1
+        if self.calls in self.fail_on:
+            raise ConnectionError('tracker unavailable')
+        super().log_metrics(metrics, step=step)
+
+
+def _make_dataset(n_rows: int=200, seed: int=42):
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((n_rows, 5))
+    y = (X[:, 0] + 0.5 * X[:, 1] + rng.normal(0, 0.5, n_rows) > 0).astype(int)
+
+    return X, y
+
+
+def test_store_sends_records_in_order_on_close(tmp_path):
+    tracker = LocalTracker()
+    # large batch and interval: nothing is sent before close
+    store = ResultStore(os.path.join(tmp_path, 'results.jsonl'), tracker=tracker, batch_size=1000,
+                        flush_interval=60)
+    for step in range(20):
+        store.append('metrics', {'value': step}, step=step)
+    store.append('parameters', {'best': 3})
+    store.close()
+    assert [step for step, _ in tracker.metrics] == list(range(20))
+    assert [m['value'] for _, m in tracker.metrics] == list(range(20))
+    assert tracker.parameters == [(None, {'best': 3})]
+    with open(os.path.join(tmp_path, 'results.jsonl')) as f:
+        records = [json.loads(line) for line in f]
+    assert [r['kind'] for r in records] == ['metrics'] * 20 + ['parameters']
+
+
+def test_store_flushes_full_batches_in_background(tmp_path):
+    tracker = LocalTracker()
+    store = ResultStore(os.path.join(tmp_path, 'results.jsonl'), tracker=tracker, batch_size=5, flush_interval=60)
+    for step in range(5):
+        store.append('metrics', {'value': step}, step=step)
+    # the full batch wakes the background thread up, long before flush_interval
+    deadline = time.time() + 5
+    while len(tracker.metrics) < 5 and time.time() < deadline:
+        time.sleep(0.01)
+    assert [step for step, _ in tracker.metrics] == list(range(5))
+    store.close()
+
+
+def test_store_resends_records_after_tracker_errors(tmp_path):
+    tracker = FlakyTracker(fail_on=(3, 4))
+    store = ResultStore(os.path.join(tmp_path, 'results.jsonl'), tracker=tracker, batch_size=1000,
+                        flush_interval=60)
+    for step in range(6):
+        store.append('metrics', {'value': step}, step=step)
+    # the third and fourth calls fail: the records from step 2 on stay queued, the thread keeps running
+    assert store.flush() == 4
+    assert store._thread.is_alive()
+    assert store.flush() == 4
+    store.close()
+    assert [step for step, _ in tracker.metrics] == list(range(6))
+
+
+def test_run_model_selection_logs_every_c_in_order(tmp_path):
+    X, y = _make_dataset()
+    tracker = LocalTracker()
+    store = ResultStore(os.path.join(tmp_path, 'results.jsonl'), tracker=tracker)
+    c_values = [10, 0.01, 1, 0.1]
+    result = run_model_selection(X, y, c_values, cv=3, n_jobs=2, store=store)
+    store.close()
+    assert list(result['mean_scores']) == sorted(c_values)
+    assert result['best_C'] == max(result['mean_scores'], key=result['mean_scores'].get)
+    assert [m['C'] for _, m in tracker.metrics] == sorted(c_values)
+    assert [step for step, _ in tracker.metrics] == list(range(len(c_values)))
+    assert tracker.parameters == [(None, {'best_C': result['best_C'], 'cv': 3})]
+    assert (result['model'].predict(X) == y).mean() > 0.8
@@ -0,0 +1,253 @@
+"""
+
+    This script collects an admission control layer for the Flask app (my_app.py).
+
+    Without it, every request is accepted: under a traffic spike requests pile up behind the busy
+    workers, and latency grows without bound for everyone. Here each request has to be admitted first:
+
+    * at most max_concurrency requests do the work at the same time (a semaphore);
+    * at most max_queue requests wait for a slot, and each waits until its deadline at most;
+    * a request is turned away immediately if the queue is full, or if the expected wait (queue length
+      times the running average service time, over the concurrency) is above the latency budget.
+
+    A request turned away gets a degraded answer when a fallback is given (e.g. the cached prediction
+    for the same sentence, or the majority class, see `DegradedPredictor`), or is rejected (503 in the
+    app). Served, degraded and rejected requests are counted, and exposed on /metrics.
+
+    Run the load test (a simulated 10 ms service at 1x to 5x its sustainable rate, with and without
+    admission control) with:
+
+    python admission_control.py
+
+"""
+
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class Overloaded(Exception):
+    """
+    The request was not admitted, and there is no fallback.
+    """
+    pass
+
+
+class AdmissionController(object):
+    """
+    Concurrency limit + bounded queue + deadlines. Use `run(work, fallback, deadline)`.
+    """
+
+    def __init__(self, max_concurrency: int=4, max_queue: int=16, latency_budget_seconds: float=0.1,
+                 registry=None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.latency_budget_seconds = latency_budget_seconds
+        self._slots = threading.Semaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self.waiting = 0
+        # running (exponentially weighted) average of the service time, to estimate the queue wait
+        self.service_seconds = None
+        self.counts = {'served': 0, 'degraded': 0, 'rejected': 0}
+        # optional serving_metrics.MetricsRegistry, to expose the counts
+        self._counters = None
+        if registry is not None:
+            self._counters = {k: registry.counter('admission_total', 'Requests by admission outcome', labels={'outcome': k})
+                              for k in self.counts}
+
+        return
+
+    def _count(self, outcome: str):
+        with self._lock:
+            self.counts[outcome] += 1
+        if self._counters is not None:
+            self._counters[outcome].inc()
+
+        return
+
+    def expected_wait(self) -> float:
+        """
+            Expected queueing time for a new request, from the current queue length.
+        """
+        if self.service_seconds is None:
+            return 0.0
+
+        return self.waiting * self.service_seconds / self.max_concurrency
+
+    def _admit(self, deadline: float) -> bool:
+        with self._lock:
+            if self.waiting >= self.max_queue or self.expected_wait() > self.latency_budget_seconds:
+                return False
+            self.waiting += 1
+        remaining = deadline - time.monotonic()
+        try:
+            # no deadline (inf): wait as long as it takes
+            return self._slots.acquire(timeout=None if remaining == float('inf') else max(remaining, 0))
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def run(self, work, fallback=None, deadline: float=None) -> tuple:
+        """
+            Run work() if the request is admitted before its deadline (time.monotonic() value, defaults to
+            now + latency budget), otherwise fallback() if given, or raise Overloaded.
+            Returns (result, outcome), outcome being 'served' or 'degraded'.
+        """
+        deadline = deadline if deadline is not None else time.monotonic() + self.latency_budget_seconds
+        if not self._admit(deadline):
+            if fallback is None:
+                self._count('rejected')
+                raise Overloaded("Request not admitted: {} waiting, expected wait {:.3f}s".format(
+                    self.waiting, self.expected_wait()))
+            try:
+                result = fallback()
+            except Overloaded:
+                self._count('rejected')
+                raise
+            self._count('degraded')
+            return result, 'degraded'
+        start = time.monotonic()
+        try:
+            result = work()
+        finally:
+            self._slots.release()
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self.service_seconds = elapsed if self.service_seconds is None else 0.9 * self.service_seconds + 0.1 * elapsed
+        self._count('served')
+
+        return result, 'served'
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counts, waiting=self.waiting, expected_wait=self.expected_wait())
+
+
+class DegradedPredictor(object):
+    """
+    Cheap answers for the requests we cannot serve: the last prediction for the same (normalized)
+    sentence, if it is in a small LRU cache, or else the majority class of the training data.
+    """
+
+    def __init__(self, majority_label, max_size: int=10000):
+        self.majority_label = majority_label
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        return
+
+    @staticmethod
+    def majority_label_of(model, default=None):
+        """
+            Majority class from the class counts (naive bayes) or priors, when the model has them.
+        """
+        import numpy as np
+
+        for attribute in ['class_count_', 'class_prior_']:
+            if hasattr(model, attribute) and hasattr(model, 'classes_'):
+                return model.classes_[int(np.argmax(getattr(model, attribute)))]
+
+        return default
+
+    def remember(self, sentence: str, label):
+        with self._lock:
+            self._cache[sentence] = label
+            self._cache.move_to_end(sentence)
+            if len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+        return
+
+    def predict(self, sentence: str) -> tuple:
+        """
+            (label, source), source being 'cache' or 'majority'. Raises Overloaded if there is no answer
+            (not cached, and no majority class known).
+        """
+        with self._lock:
+            label = self._cache.get(sentence)
+        if label is not None:
+            return label, 'cache'
+        if self.majority_label is None:
+            raise Overloaded("No degraded answer available")
+
+        return self.majority_label, 'majority'
+
+
+def _percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def load_test(controller, rate: float, duration_seconds: float=2.0, service_seconds: float=0.01, seed: int=42) -> dict:
+    """
+        Open-loop load test: requests arrive as a Poisson process at rate per second, each in its own thread,
+        and the work is a sleep of service_seconds (like waiting on I/O or on code releasing the GIL).
+        Latency is measured from arrival to answer.
+    """
+    import random
+
+    rng = random.Random(seed)
+    latencies, outcomes = [], []
+    results_lock = threading.Lock()
+
+    def request(arrival: float):
+        try:
+            _, outcome = controller.run(lambda: time.sleep(service_seconds), fallback=lambda: None)
+        except Overloaded:
+            outcome = 'rejected'
+        with results_lock:
+            latencies.append(time.monotonic() - arrival)
+            outcomes.append(outcome)
+
+    threads = []
+    start = time.monotonic()
+    next_arrival = start
+    while next_arrival < start + duration_seconds:
+        time.sleep(max(next_arrival - time.monotonic(), 0))
+        t = threading.Thread(target=request, args=(next_arrival,))
+        t.start()
+        threads.append(t)
+        next_arrival += rng.expovariate(rate)
+    for t in threads:
+        t.join()
+    served = [l for l, o in zip(latencies, outcomes) if o == 'served']
+
+    return {
+        'requests': len(latencies),
+        'served': len(served),
+        'shed': len(latencies) - len(served),
+        'p50_ms': 1000 * _percentile(latencies, 0.5),
+        'p99_ms': 1000 * _percentile(latencies, 0.99),
+        'served_p99_ms': 1000 * _percentile(served, 0.99)
+    }
+
+
+def benchmark_admission_control(max_concurrency: int=4, service_seconds: float=0.01, duration_seconds: float=2.0) -> list:
+    """
+        p99 latency at 1x to 5x the sustainable rate (max_concurrency / service_seconds), with a latency
+        budget of 5x the service time, and without admission control (no queue limit, no budget).
+    """
+    sustainable_rate = max_concurrency / service_seconds
+    results = []
+    for multiplier in [1, 2, 3, 5]:
+        for name, controller in [
+            ('admission control', AdmissionController(max_concurrency, max_queue=4 * max_concurrency,
+                                                      latency_budget_seconds=5 * service_seconds)),
+            ('unbounded queue', AdmissionController(max_concurrency, max_queue=10 ** 9, latency_budget_seconds=float('inf')))
+        ]:
+            result = load_test(controller, multiplier * sustainable_rate, duration_seconds, service_seconds)
+            result.update({'load': '{}x'.format(multiplier), 'mode': name})
+            results.append(result)
+            print("{:>3} {:<18} requests {:>5}  served {:>5}  shed {:>5}  p50 {:>8.1f} ms  p99 {:>8.1f} ms".format(
+                result['load'], name, result['requests'], result['served'], result['shed'], result['p50_ms'], result['p99_ms']))
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_admission_control()
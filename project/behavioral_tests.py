@@ -0,0 +1,272 @@
+"""
+
+    This script collects the behavioral tests of the sentiment model as independent test units.
+
+    Each unit is a small, picklable dictionary (name, kind, parameters and pass threshold), and is run by
+    `run_test_unit` against a shared test context: vectorizer, model, test sentences, labels and predictions.
+    There are two kinds of units:
+
+    * 'slice': accuracy on the test sentences containing a keyword (e.g. quarterly news, a company),
+      which should not be much worse than the accuracy on the whole test set;
+    * 'perturbation': the share of sampled test sentences whose predicted label does not change after
+      a perturbation (back-translation, typos, ...), which should stay above a threshold.
+
+    A unit ends up in one of four states: 'passed', 'failed', 'skipped' (support below the min_support of
+    the unit: a handful of sentences cannot tell a regression from noise) or 'errored' (an optional service
+    is not available: the BackTranslation package or the network for back-translation). Only 'failed' units
+    can fail the run; any other exception in a unit is a bug in the test, and the unit fails. Back-translation
+    needs the network, so it is off by default.
+
+    In FinanceNewsFlow, units run as Metaflow foreach branches: branches read model and test set from the
+    datastore, where they are stored once by the parent step, so nothing is re-pickled per branch. Outside
+    Metaflow, `run_test_units_locally` uses a process pool, which receives the context once per worker
+    (through the pool initializer), not once per unit.
+
+    You can compare sequential and parallel execution on synthetic data with:
+
+    python behavioral_tests.py
+
+"""
+
+
+import time
+import numpy as np
+
+
+# max accuracy drop on a slice with respect to the whole test set
+DEFAULT_SLICE_TOLERANCE = 0.15
+# below this many sentences, a unit is skipped: one or two mistakes would move the score by more than the tolerance
+DEFAULT_MIN_SUPPORT = 30
+
+
+class BehavioralRegression(Exception):
+    """
+    Some behavioral test units failed.
+    """
+    pass
+
+
+class ServiceUnavailable(Exception):
+    """
+    An optional service needed by a unit (e.g. back-translation) cannot be used here.
+    """
+    pass
+
+
+def get_test_units(back_translation: bool=False) -> list:
+    """
+        The behavioral test suite: add new slices and perturbation families here. Back-translation calls
+        an online service, so it is only included on request.
+    """
+    units = [
+        {'name': 'slice_quarterly_news', 'kind': 'slice', 'keyword': 'quarter', 'tolerance': DEFAULT_SLICE_TOLERANCE,
+         'min_support': DEFAULT_MIN_SUPPORT},
+        # https://en.wikipedia.org/wiki/Comptel
+        {'name': 'slice_company_comptel', 'kind': 'slice', 'keyword': 'comptel', 'tolerance': DEFAULT_SLICE_TOLERANCE,
+         'min_support': DEFAULT_MIN_SUPPORT},
+        {'name': 'perturbation_typos', 'kind': 'perturbation', 'perturbation': 'typos', 'n_samples': 200,
+         'min_agreement': 0.8, 'min_support': DEFAULT_MIN_SUPPORT}
+    ]
+    if back_translation:
+        units.append({'name': 'perturbation_back_translation', 'kind': 'perturbation', 'perturbation': 'back_translation',
+                      'n_samples': 100, 'min_agreement': 0.7, 'min_support': DEFAULT_MIN_SUPPORT})
+
+    return units
+
+
+def get_test_context(vectorizer, model, X_test, y_test, predicted) -> dict:
+    """
+        Everything a test unit needs, in plain picklable containers.
+    """
+    return {
+        'vectorizer': vectorizer,
+        'model': model,
+        'X_test': list(X_test),
+        'y_test': np.asarray(y_test),
+        'predicted': np.asarray(predicted)
+    }
+
+
+def add_typos(sentences: list, seed: int=42) -> list:
+    """
+        Swap two adjacent characters in a random word (of at least 4 characters) of each sentence.
+    """
+    rng = np.random.default_rng(seed)
+    perturbed = []
+    for sentence in sentences:
+        words = sentence.split()
+        candidates = [i for i, w in enumerate(words) if len(w) >= 4]
+        if candidates:
+            i = candidates[rng.integers(len(candidates))]
+            j = int(rng.integers(len(words[i]) - 1))
+            w = words[i]
+            words[i] = w[:j] + w[j + 1] + w[j] + w[j + 2:]
+        perturbed.append(' '.join(words))
+
+    return perturbed
+
+
+def perturb(sentences: list, perturbation: str, seed: int=42) -> list:
+    if perturbation == 'typos':
+        return add_typos(sentences, seed=seed)
+    if perturbation == 'back_translation':
+        from flow_utils import create_perturbated_sentences
+        try:
+            return create_perturbated_sentences(sentences)
+        except (ImportError, OSError) as e:
+            # package not installed, or no network (requests / socket errors are OSErrors)
+            raise ServiceUnavailable("Back-translation is not available: {}".format(repr(e)))
+
+    raise ValueError("Unknown perturbation: {}".format(perturbation))
+
+
+def _status(score, threshold: float, support: int, unit: dict) -> str:
+    # too few sentences (e.g. an empty slice) cannot tell a regression from noise: we report, but skip the unit
+    if support < unit.get('min_support', DEFAULT_MIN_SUPPORT):
+        return 'skipped'
+
+    return 'passed' if score >= threshold else 'failed'
+
+
+def _run_slice(unit: dict, context: dict) -> dict:
+    from flow_utils import report_metrics_on_subset
+
+    X_test, y_test, predicted = context['X_test'], context['y_test'], context['predicted']
+    in_slice = np.array([unit['keyword'] in x for x in X_test], dtype=bool)
+    overall_accuracy = float((y_test == predicted).mean())
+    support = int(in_slice.sum())
+    score = float((y_test[in_slice] == predicted[in_slice]).mean()) if support else None
+    threshold = overall_accuracy - unit['tolerance']
+
+    return {
+        'score': score,
+        'threshold': threshold,
+        'support': support,
+        'status': _status(score, threshold, support, unit),
+        'report': report_metrics_on_subset(X_test, predicted, y_test, lambda x: unit['keyword'] in x) if support else ''
+    }
+
+
+def _run_perturbation(unit: dict, context: dict) -> dict:
+    X_test, predicted = context['X_test'], context['predicted']
+    rng = np.random.default_rng(unit.get('seed', 42))
+    sample = rng.choice(len(X_test), size=min(unit['n_samples'], len(X_test)), replace=False)
+    sentences = [X_test[_] for _ in sample]
+    perturbed = perturb(sentences, unit['perturbation'], seed=unit.get('seed', 42))
+    new_predicted = context['model'].predict(context['vectorizer'].transform(perturbed))
+    changed = new_predicted != predicted[sample]
+    examples = ["'{}' -> '{}': {} -> {}".format(o, p, a, b)
+                for o, p, a, b, c in zip(sentences, perturbed, predicted[sample], new_predicted, changed) if c]
+
+    score = float(1.0 - changed.mean()) if len(sample) else None
+
+    return {
+        'score': score,
+        'threshold': unit['min_agreement'],
+        'support': len(sample),
+        'status': _status(score, unit['min_agreement'], len(sample), unit),
+        'report': '\n'.join(examples[:5])
+    }
+
+
+def run_test_unit(unit: dict, context: dict) -> dict:
+    """
+        Run one unit and return its result: name, kind, status (passed, failed, skipped or errored), score,
+        threshold, support, seconds and a textual report. A missing optional service (ServiceUnavailable)
+        is reported as 'errored', as it says nothing about the model; any other exception is a bug in the
+        unit, and must not pass silently: the unit fails, with the traceback in the report.
+    """
+    import traceback
+
+    start = time.time()
+    try:
+        outcome = _run_slice(unit, context) if unit['kind'] == 'slice' else _run_perturbation(unit, context)
+    except ServiceUnavailable as e:
+        outcome = {'score': None, 'threshold': None, 'support': 0, 'status': 'errored',
+                   'report': 'ERROR: {}'.format(e)}
+    except Exception:
+        outcome = {'score': None, 'threshold': None, 'support': 0, 'status': 'failed',
+                   'report': 'EXCEPTION:\n{}'.format(traceback.format_exc())}
+
+    return dict(outcome, name=unit['name'], kind=unit['kind'], seconds=time.time() - start)
+
+
+# the test context of the current worker process, set once by the pool initializer
+_worker_context = None
+
+
+def _init_worker(context: dict):
+    global _worker_context
+    _worker_context = context
+
+    return
+
+
+def _run_in_worker(unit: dict) -> dict:
+    return run_test_unit(unit, _worker_context)
+
+
+def run_test_units_locally(units: list, context: dict, n_jobs: int=4) -> list:
+    """
+        Run the units in a process pool (or sequentially, with n_jobs=1), keeping the order of the units.
+    """
+    if n_jobs == 1:
+        return [run_test_unit(unit, context) for unit in units]
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(context,)) as executor:
+        return list(executor.map(_run_in_worker, units))
+
+
+def failed_units(results: list) -> list:
+    """
+        Names of the units which ran on enough data and did not meet their threshold.
+    """
+    return [r['name'] for r in results if r['status'] == 'failed']
+
+
+def summarize_results(results: list) -> str:
+    """
+        One line per unit, with outcome, score vs threshold, support and time, followed by the details
+        of each unit (slice reports, changed predictions, errors).
+    """
+    lines = ["{:<35} {:>7} {:>8} {:>10} {:>8} {:>9}".format('unit', 'result', 'score', 'threshold', 'support', 'seconds')]
+    for r in results:
+        lines.append("{:<35} {:>7} {:>8} {:>10} {:>8} {:>9.3f}".format(
+            r['name'], r['status'].upper(),
+            '-' if r['score'] is None else '{:.3f}'.format(r['score']),
+            '-' if r['threshold'] is None else '{:.3f}'.format(r['threshold']),
+            r['support'], r['seconds']))
+    for r in results:
+        if r['status'] != 'passed' or r['report']:
+            lines.append("\n$$$ {} $$$\n{}".format(r['name'], r['report']))
+
+    return '\n'.join(lines)
+
+
+def benchmark_local_pool(n_sentences: int=40000, n_units: int=8, n_jobs: int=4) -> dict:
+    """
+        Sequential vs process pool execution of the (offline) units on synthetic data.
+    """
+    from flow_utils import tf_idf_vectorizer, get_classification_model
+    from similarity_index import make_synthetic_corpus
+
+    sentences = make_synthetic_corpus(n_sentences, vocabulary_size=20000)
+    labels = [len(s) % 3 for s in sentences]
+    vectorizer, X_train, X_test = tf_idf_vectorizer(sentences[:n_sentences // 2], sentences[n_sentences // 2:])
+    model = get_classification_model().fit(X_train, labels[:n_sentences // 2])
+    context = get_test_context(vectorizer, model, sentences[n_sentences // 2:], labels[n_sentences // 2:], model.predict(X_test))
+    units = [{'name': 'perturbation_typos_{}'.format(i), 'kind': 'perturbation', 'perturbation': 'typos',
+              'n_samples': 20000, 'min_agreement': 0.5, 'seed': i} for i in range(n_units)]
+    results = {}
+    for jobs in [1, n_jobs]:
+        start = time.time()
+        run_test_units_locally(units, context, n_jobs=jobs)
+        results['n_jobs_{}_seconds'.format(jobs)] = time.time() - start
+    print(results)
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_local_pool()
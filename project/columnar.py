@@ -0,0 +1,189 @@
+"""
+
+    This script collects a compact, columnar container for a labelled text dataset, used by the
+    FinanceNewsFlow steps.
+
+    Metaflow pickles every artifact we store with self: if we keep the data as Python lists of strings,
+    and re-copy it in each step (raw data, cleaned data, train / test splits), we pay for it with
+    datastore size and start-up time of each step. Instead, we store:
+
+    * all the text as a single utf-8 byte buffer, plus an int64 offsets array (Arrow-style), so that
+      sentence i is buffer[offsets[i]:offsets[i + 1]];
+    * the labels as an int8 array.
+
+    Filters and splits are just int64 index arrays over the same base dataset: the flow stores the
+    dataset once, and then only indices.
+
+    You can run the benchmark from the command line, e.g.:
+
+    python columnar.py
+
+"""
+
+
+import numpy as np
+
+
+class TextView(object):
+    """
+    Read-only sequence of strings over a (buffer, offsets) pair, optionally restricted to some indices.
+    It can be passed wherever a list of sentences is expected, e.g. to scikit vectorizers.
+    """
+
+    def __init__(self, buffer, offsets, index=None):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.index = index
+
+        return
+
+    def __len__(self):
+        return len(self.offsets) - 1 if self.index is None else len(self.index)
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Sentence index out of range: {}".format(i))
+        row = i if self.index is None else self.index[i]
+
+        return self.buffer[self.offsets[row]:self.offsets[row + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def sentence_lengths(self):
+        """
+            Length in characters of each sentence, computed without decoding the strings: we count the
+            bytes that are not utf-8 continuation bytes (0b10xxxxxx).
+        """
+        is_char_start = np.concatenate([[0], np.cumsum((self.buffer & 0xC0) != 0x80)])
+        starts, ends = self.offsets[:-1], self.offsets[1:]
+        if self.index is not None:
+            starts, ends = starts[self.index], ends[self.index]
+
+        return is_char_start[ends] - is_char_start[starts]
+
+
+class CompactDataset(object):
+    """
+    Sentences (one utf-8 buffer + offsets) and int8 labels, optionally restricted to some rows
+    of the base data through an index array.
+    """
+
+    def __init__(self, buffer, offsets, labels, index=None):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.all_labels = labels
+        self.index = index
+
+        return
+
+    @classmethod
+    def from_lists(cls, sentences: list, labels: list):
+        """
+            Build the dataset from parallel lists of sentences and (integer) labels.
+        """
+        encoded = [s.encode('utf-8') for s in sentences]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(_) for _ in encoded], out=offsets[1:])
+        buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+        return cls(buffer, offsets, np.asarray(labels, dtype=np.int8))
+
+    @classmethod
+    def from_pairs(cls, pairs: list):
+        """
+            Build the dataset from [sentence, label] pairs, i.e. the output of `get_finance_sentences`.
+        """
+        return cls.from_lists([_[0] for _ in pairs], [_[1] for _ in pairs])
+
+    def __len__(self):
+        return len(self.offsets) - 1 if self.index is None else len(self.index)
+
+    @property
+    def rows(self):
+        """
+            Indices of the rows of the base data in this dataset.
+        """
+        return np.arange(len(self.offsets) - 1) if self.index is None else self.index
+
+    @property
+    def sentences(self) -> TextView:
+        return TextView(self.buffer, self.offsets, self.index)
+
+    @property
+    def labels(self):
+        return self.all_labels if self.index is None else self.all_labels[self.index]
+
+    def take(self, indices):
+        """
+            Return a new dataset with the given rows (relative to this dataset): no data is copied,
+            only the index array is composed with the current one.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+
+        return CompactDataset(self.buffer, self.offsets, self.all_labels, self.rows[indices])
+
+    def filter(self, mask):
+        """
+            Return a new dataset with the rows for which the boolean mask is True.
+        """
+        return self.take(np.flatnonzero(mask))
+
+    def sentence_lengths(self):
+        """
+            Length in characters of each sentence (see TextView.sentence_lengths).
+        """
+        return self.sentences.sentence_lengths()
+
+
+def benchmark_artifact_sizes(pairs: list=None) -> dict:
+    """
+        Compare the pickled size and load time of the artifacts FinanceNewsFlow used to store (lists of strings,
+        copied at each step) with the compact dataset plus index arrays.
+    """
+    import time
+    import pickle
+
+    if pairs is None:
+        from flow_utils import get_finance_sentences
+        pairs = get_finance_sentences()
+    sentences, labels = [_[0] for _ in pairs], [_[1] for _ in pairs]
+    n_train = int(0.8 * len(pairs))
+    list_artifacts = {
+        'finance_dataset': pairs,
+        'raw_sentences': sentences,
+        'raw_labels': labels,
+        'sentences': sentences,
+        'labels': labels,
+        'X_train': sentences[:n_train],
+        'X_test': sentences[n_train:],
+        'y_train': labels[:n_train],
+        'y_test': labels[n_train:]
+    }
+    dataset = CompactDataset.from_pairs(pairs)
+    rows = np.arange(len(pairs))
+    compact_artifacts = {
+        'dataset': dataset,
+        'valid_index': rows,
+        'train_index': rows[:n_train],
+        'test_index': rows[n_train:]
+    }
+
+    results = {}
+    for name, artifacts in [('lists', list_artifacts), ('compact', compact_artifacts)]:
+        blobs = [pickle.dumps(_, protocol=pickle.HIGHEST_PROTOCOL) for _ in artifacts.values()]
+        start = time.time()
+        for blob in blobs:
+            pickle.loads(blob)
+        results['{}_bytes'.format(name)] = sum(len(_) for _ in blobs)
+        results['{}_load_seconds'.format(name)] = time.time() - start
+    print(results)
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_artifact_sizes()
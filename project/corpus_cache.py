@@ -0,0 +1,285 @@
+"""
+
+    This script collects utilities to tokenize a text corpus once, and re-use it afterwards.
+
+    The LM and word embeddings notebooks re-read and re-tokenize the corpora (`data/shakespeare.txt`,
+    `data/graham.txt`, the HF finance dataset) every time. Here we store a tokenized corpus in a compact
+    integer-id representation:
+
+    * `tokens.npy`: a flat int32 array with the id of every token in the corpus;
+    * `offsets.npy`: an int64 array of length (# sentences + 1), so that sentence i is tokens[offsets[i]:offsets[i + 1]];
+    * `vocabulary.json`: the list of words, i.e. id -> word.
+
+    Arrays are memory-mapped at load time, so loading is (almost) free, and sentences are streamed as
+    views over the token array, with no copy.
+
+    You can run the benchmark from the command line, e.g.:
+
+    python corpus_cache.py ../data/shakespeare.txt ../data/graham.txt
+
+"""
+
+
+import os
+import json
+
+
+# bump this every time the tokenization logic changes, so that old caches are not re-used
+CACHE_VERSION = 1
+# same padding symbols as in the LM notebook
+START_SYMBOL = 'FRE_7773_START'
+STOP_SYMBOL = 'FRE_7773_STOP'
+
+
+def prepare_sentence(sentence: str) -> list:
+    """
+        Same as `prepare_sentence` in the LM notebook: clean up the sentence and split it on white spaces.
+    """
+    from flow_utils import pre_process_sentence
+
+    return pre_process_sentence(sentence).split()
+
+
+def split_text_into_sentences(text: str) -> list:
+    """
+        Same as `get_corpus_from_text_file` in the LM notebook: split on new lines and punctuation (;, .),
+        and remove empty sentences.
+    """
+    return [_ for _ in [s.strip() for s in text.replace(';', '.').split('.')] if _]
+
+
+class TokenizedCorpus(object):
+    """
+    A corpus stored as a flat array of token ids plus the offsets of each sentence.
+    """
+
+    def __init__(self, tokens, offsets, vocabulary: list):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.vocabulary = vocabulary
+        self._word_to_id = None
+
+        return
+
+    @property
+    def word_to_id(self) -> dict:
+        if self._word_to_id is None:
+            self._word_to_id = {w: i for i, w in enumerate(self.vocabulary)}
+
+        return self._word_to_id
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int):
+        """
+            Return the ids of sentence i, as a view over the token array.
+        """
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def token_sentences(self):
+        """
+            Re-iterable stream of sentences as lists of words, i.e. the format expected by the n-gram
+            counter in the LM notebook and by gensim Word2Vec (which iterates over the corpus once per epoch).
+        """
+        return _SentenceStream(self, as_text=False)
+
+    def text_sentences(self):
+        """
+            Re-iterable stream of sentences as strings, i.e. the format expected by scikit vectorizers.
+        """
+        return _SentenceStream(self, as_text=True)
+
+    def count_ngrams(self, k: int) -> dict:
+        """
+            Vectorized version of `get_ngram_counter_for_lm` in the LM notebook: pad each sentence with
+            (k - 1) START symbols and one STOP symbol, and count all the n-grams for n in 1..k.
+
+            Returns a Counter over tuples of words, so that it is a drop-in replacement for the notebook one.
+        """
+        import numpy as np
+        from collections import Counter
+
+        start_id, stop_id = len(self.vocabulary), len(self.vocabulary) + 1
+        words = list(self.vocabulary) + [START_SYMBOL, STOP_SYMBOL]
+        lengths = np.diff(self.offsets)
+        padded_lengths = lengths + k
+        padded_ends = np.cumsum(padded_lengths)
+        padded_starts = padded_ends - padded_lengths
+        # build the padded token array in one go: START symbols, then tokens, then STOP
+        padded = np.full(int(padded_ends[-1]) if len(padded_ends) else 0, start_id, dtype=np.int64)
+        token_positions = np.arange(len(self.tokens)) + np.repeat(padded_starts + k - 1 - self.offsets[:-1], lengths)
+        padded[token_positions] = self.tokens
+        padded[padded_ends - 1] = stop_id
+        # sentence id of each position, to avoid n-grams crossing sentence boundaries
+        sentence_ends = np.repeat(padded_ends, padded_lengths)
+        positions = np.arange(len(padded))
+        counter = Counter()
+        for n in range(1, k + 1):
+            valid = positions[positions + n <= sentence_ends]
+            windows = np.stack([padded[valid + i] for i in range(n)], axis=1)
+            ngrams, counts = np.unique(windows, axis=0, return_counts=True)
+            for ngram, count in zip(ngrams.tolist(), counts.tolist()):
+                counter[tuple(words[_] for _ in ngram)] = count
+
+        return counter
+
+    def save(self, folder: str, metadata: dict=None):
+        """
+            Persist the corpus in a folder, together with some metadata to validate the cache later on.
+        """
+        import numpy as np
+
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, 'tokens.npy'), self.tokens)
+        np.save(os.path.join(folder, 'offsets.npy'), self.offsets)
+        with open(os.path.join(folder, 'vocabulary.json'), 'w') as f:
+            json.dump(self.vocabulary, f)
+        # metadata last, so that an interrupted save does not leave a valid-looking cache
+        with open(os.path.join(folder, 'metadata.json'), 'w') as f:
+            json.dump(dict(metadata or {}, version=CACHE_VERSION), f)
+
+        return
+
+    @classmethod
+    def load(cls, folder: str, mmap: bool=True):
+        """
+            Load a corpus saved with `save`: arrays are memory-mapped (read-only) by default.
+        """
+        import numpy as np
+
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(folder, 'vocabulary.json')) as f:
+            vocabulary = json.load(f)
+
+        return cls(np.load(os.path.join(folder, 'tokens.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(folder, 'offsets.npy'), mmap_mode=mmap_mode),
+                   vocabulary)
+
+
+class _SentenceStream(object):
+    """
+    Re-iterable view over a TokenizedCorpus, decoding ids to words on the fly.
+    """
+
+    def __init__(self, corpus: TokenizedCorpus, as_text: bool):
+        self.corpus = corpus
+        self.as_text = as_text
+
+        return
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def __iter__(self):
+        vocabulary = self.corpus.vocabulary
+        for ids in self.corpus:
+            words = [vocabulary[_] for _ in ids.tolist()]
+            yield ' '.join(words) if self.as_text else words
+
+
+def tokenize_sentences(sentences, tokenizer=prepare_sentence) -> TokenizedCorpus:
+    """
+        Tokenize an iterable of raw sentences into a TokenizedCorpus, skipping empty sentences.
+        Word ids are assigned in order of first appearance.
+    """
+    import numpy as np
+    from array import array
+
+    word_to_id = {}
+    tokens = array('i')
+    offsets = array('q', [0])
+    for sentence in sentences:
+        words = tokenizer(sentence)
+        if not words:
+            continue
+        tokens.extend(word_to_id.setdefault(w, len(word_to_id)) for w in words)
+        offsets.append(len(tokens))
+
+    return TokenizedCorpus(np.frombuffer(tokens, dtype=np.int32).copy(),
+                           np.frombuffer(offsets, dtype=np.int64).copy(),
+                           list(word_to_id))
+
+
+def _is_valid_cache(cache_folder: str, metadata: dict) -> bool:
+    metadata_file = os.path.join(cache_folder, 'metadata.json')
+    if not os.path.exists(metadata_file):
+        return False
+    with open(metadata_file) as f:
+        cached_metadata = json.load(f)
+
+    return cached_metadata == dict(metadata, version=CACHE_VERSION)
+
+
+def corpus_from_text_file(text_file: str, cache_folder: str=None) -> TokenizedCorpus:
+    """
+        Cached version of `get_corpus_from_text_file` in the LM notebook. The cache is re-built when
+        the source file changes (size or modification time) or the tokenization logic changes.
+    """
+    cache_folder = cache_folder or '{}.cache'.format(text_file)
+    stats = os.stat(text_file)
+    metadata = {'source': os.path.abspath(text_file), 'size': stats.st_size, 'mtime': stats.st_mtime}
+    if _is_valid_cache(cache_folder, metadata):
+        return TokenizedCorpus.load(cache_folder)
+
+    with open(text_file, 'r') as file:
+        corpus = tokenize_sentences(split_text_into_sentences(file.read()))
+    corpus.save(cache_folder, metadata)
+
+    return TokenizedCorpus.load(cache_folder)
+
+
+def corpus_from_finance_dataset(cache_folder: str, split: str='sentences_allagree') -> TokenizedCorpus:
+    """
+        Cached version of `get_finance_sentences` in the LM notebook (tokenized financial news).
+    """
+    from flow_utils import get_finance_sentiment_dataset
+
+    metadata = {'source': 'financial_phrasebank', 'split': split}
+    if _is_valid_cache(cache_folder, metadata):
+        return TokenizedCorpus.load(cache_folder)
+
+    dataset = get_finance_sentiment_dataset(split)
+    corpus = tokenize_sentences(_['sentence'] for _ in dataset)
+    corpus.save(cache_folder, metadata)
+
+    return TokenizedCorpus.load(cache_folder)
+
+
+def benchmark_cold_vs_cached(text_files: list) -> list:
+    """
+        Compare cold tokenization (what the notebooks do today) with loading the cached corpus.
+    """
+    import time
+    import shutil
+    import tempfile
+
+    results = []
+    for text_file in text_files:
+        cache_folder = tempfile.mkdtemp()
+        try:
+            start = time.time()
+            with open(text_file, 'r') as file:
+                sentences = [prepare_sentence(s) for s in split_text_into_sentences(file.read())]
+            cold = time.time() - start
+            corpus_from_text_file(text_file, cache_folder)
+            start = time.time()
+            corpus = corpus_from_text_file(text_file, cache_folder)
+            cached = time.time() - start
+            assert list(corpus.token_sentences()) == [_ for _ in sentences if _]
+            results.append({'file': text_file, 'sentences': len(corpus), 'tokens': len(corpus.tokens),
+                            'cold_seconds': cold, 'cached_seconds': cached})
+            print(results[-1])
+        finally:
+            shutil.rmtree(cache_folder)
+
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    benchmark_cold_vs_cached(sys.argv[1:] or ['../data/shakespeare.txt', '../data/graham.txt'])
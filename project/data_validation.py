@@ -0,0 +1 @@
+../mlsys/training/data_validation.py
\ No newline at end of file
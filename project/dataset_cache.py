@@ -0,0 +1,152 @@
+"""
+
+    This script collects an offline access layer for the financial_phrasebank dataset.
+
+    `flow_utils.get_finance_sentiment_dataset` calls `datasets.load_dataset` at every run, which resolves the
+    dataset remotely and materializes a Python dict per row. Here we snapshot the dataset once, already
+    cleaned with `pre_process_sentence`, in the columnar format of columnar.py:
+
+    * `buffer.npy`: all the cleaned sentences as a single utf-8 byte buffer;
+    * `offsets.npy`: int64 offsets, so that sentence i is buffer[offsets[i]:offsets[i + 1]];
+    * `labels.npy`: int8 labels;
+    * `metadata.json`: dataset, split, cache version and size, written last.
+
+    Later loads memory-map the arrays, so they are zero-copy and need no network: flows (and notebooks, through
+    `get_finance_sentences`) start in milliseconds. The cache folder defaults to `financial_phrasebank.cache`
+    next to this file, and can be changed with the FINANCE_DATASET_CACHE env variable.
+
+    Snapshot the dataset (once, with network access) and time the cached load with:
+
+    python dataset_cache.py snapshot
+    python dataset_cache.py benchmark
+
+"""
+
+
+import os
+import json
+
+
+# bump this every time the cleaning logic (or the format) changes, so that old snapshots are re-built
+DATASET_CACHE_VERSION = 1
+DEFAULT_SPLIT = 'sentences_allagree'
+DEFAULT_CACHE_FOLDER = os.environ.get(
+    'FINANCE_DATASET_CACHE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'financial_phrasebank.cache'))
+
+
+def _split_folder(cache_folder: str, split: str) -> str:
+    return os.path.join(cache_folder or DEFAULT_CACHE_FOLDER, split)
+
+
+def _expected_metadata(split: str) -> dict:
+    return {'dataset': 'financial_phrasebank', 'split': split, 'version': DATASET_CACHE_VERSION}
+
+
+def is_snapshot_valid(cache_folder: str=None, split: str=DEFAULT_SPLIT) -> bool:
+    metadata_file = os.path.join(_split_folder(cache_folder, split), 'metadata.json')
+    if not os.path.exists(metadata_file):
+        return False
+    with open(metadata_file) as f:
+        metadata = json.load(f)
+
+    return all(metadata.get(k) == v for k, v in _expected_metadata(split).items())
+
+
+def snapshot_finance_dataset(cache_folder: str=None, split: str=DEFAULT_SPLIT) -> str:
+    """
+        Download the dataset through HF (this is the only function needing the network), clean the
+        sentences and store them as a columnar snapshot. The snapshot is written to a temporary folder
+        first and then renamed, so readers never see a half-written snapshot.
+    """
+    import shutil
+    import numpy as np
+    from flow_utils import get_finance_sentiment_dataset, pre_process_sentence
+    from columnar import CompactDataset
+
+    dataset = get_finance_sentiment_dataset(split)
+    compact = CompactDataset.from_lists([pre_process_sentence(_) for _ in dataset['sentence']], dataset['label'])
+    target_folder = _split_folder(cache_folder, split)
+    tmp_folder = '{}.tmp'.format(target_folder)
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+    np.save(os.path.join(tmp_folder, 'buffer.npy'), compact.buffer)
+    np.save(os.path.join(tmp_folder, 'offsets.npy'), compact.offsets)
+    np.save(os.path.join(tmp_folder, 'labels.npy'), compact.all_labels)
+    with open(os.path.join(tmp_folder, 'metadata.json'), 'w') as f:
+        json.dump(dict(_expected_metadata(split), rows=len(compact), bytes=int(compact.buffer.nbytes)), f)
+    shutil.rmtree(target_folder, ignore_errors=True)
+    os.replace(tmp_folder, target_folder)
+
+    return target_folder
+
+
+def load_finance_dataset(cache_folder: str=None, split: str=DEFAULT_SPLIT, mmap: bool=True, offline: bool=False):
+    """
+        Load the cleaned dataset as a CompactDataset (see columnar.py), memory-mapped by default. If there is
+        no valid snapshot, one is created first, unless offline is True (or HF_DATASETS_OFFLINE=1), in
+        which case we fail with a clear error instead of trying the network.
+    """
+    import numpy as np
+    from columnar import CompactDataset
+
+    if not is_snapshot_valid(cache_folder, split):
+        if offline or os.environ.get('HF_DATASETS_OFFLINE') == '1':
+            raise FileNotFoundError("No valid snapshot of financial_phrasebank ({}) in {}: run "
+                                    "'python dataset_cache.py snapshot' with network access first".format(
+                                        split, cache_folder or DEFAULT_CACHE_FOLDER))
+        snapshot_finance_dataset(cache_folder, split)
+    folder = _split_folder(cache_folder, split)
+    mmap_mode = 'r' if mmap else None
+
+    return CompactDataset(np.load(os.path.join(folder, 'buffer.npy'), mmap_mode=mmap_mode),
+                          np.load(os.path.join(folder, 'offsets.npy'), mmap_mode=mmap_mode),
+                          np.load(os.path.join(folder, 'labels.npy'), mmap_mode=mmap_mode))
+
+
+def iter_finance_batches(batch_size: int=1000, cache_folder: str=None, split: str=DEFAULT_SPLIT, offline: bool=False):
+    """
+        Yield (sentences, labels) batches of cleaned sentences (list of str) and labels (int8 array). Each batch
+        is decoded from the byte buffer in one go, and then split at the offsets.
+    """
+    dataset = load_finance_dataset(cache_folder, split, offline=offline)
+    offsets = dataset.offsets
+    for start in range(0, len(dataset), batch_size):
+        end = min(start + batch_size, len(dataset))
+        first, bounds = int(offsets[start]), offsets[start:end + 1].tolist()
+        raw = dataset.buffer[first:int(offsets[end])].tobytes()
+        sentences = [raw[a - first:b - first].decode('utf-8') for a, b in zip(bounds[:-1], bounds[1:])]
+        yield sentences, dataset.all_labels[start:end]
+
+
+def benchmark_cached_load(cache_folder: str=None, split: str=DEFAULT_SPLIT, repeat: int=10) -> dict:
+    """
+        Time the memory-mapped load and the full batched iteration over the snapshot (no network involved).
+    """
+    import time
+
+    start = time.time()
+    for _ in range(repeat):
+        dataset = load_finance_dataset(cache_folder, split, offline=True)
+    load_seconds = (time.time() - start) / repeat
+    start = time.time()
+    n_rows = sum(len(labels) for _, labels in iter_finance_batches(cache_folder=cache_folder, split=split, offline=True))
+    results = {'rows': n_rows, 'load_seconds': load_seconds, 'iterate_seconds': time.time() - start,
+               'snapshot_bytes': int(dataset.buffer.nbytes + dataset.offsets.nbytes + dataset.all_labels.nbytes)}
+    print(results)
+
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Offline snapshot of the financial_phrasebank dataset')
+    parser.add_argument('command', choices=['snapshot', 'benchmark'])
+    parser.add_argument('--split', default=DEFAULT_SPLIT)
+    parser.add_argument('--cache_folder', default=None)
+    args = parser.parse_args()
+    if args.command == 'snapshot':
+        print("Snapshot saved in {}".format(snapshot_finance_dataset(args.cache_folder, args.split)))
+    else:
+        benchmark_cached_load(args.cache_folder, args.split)
@@ -0,0 +1,294 @@
+"""
+
+    This script collects a nearest-neighbour index for word embeddings, e.g. the word2vec space we
+    train in the word embeddings notebook with `train_word2vec_model`. Gensim answers `most_similar`
+    with a brute-force scan of the vocabulary: that is fine in a notebook, but at serving time
+    (e.g. for synonym expansion) load time and per-query latency matter.
+
+    The index supports:
+
+    * exact search, as blocked matrix products + argpartition;
+    * approximate search, with a random-projection LSH implemented in NumPy (several hash tables,
+      optionally probing also the buckets at Hamming distance 1);
+    * persistence as plain .npy files, which are memory-mapped at load time (no copy, no parsing),
+      next to a json vocabulary;
+    * parallel batch queries, with a thread pool (NumPy releases the GIL on matrix products).
+
+    You can run the recall@k vs QPS benchmark from the command line, e.g.:
+
+    python embedding_index.py 100000
+
+"""
+
+
+import os
+import json
+
+
+class EmbeddingIndex(object):
+    """
+    Cosine similarity index over a word -> vector space.
+    """
+
+    def __init__(self, words: list, vectors, normalize: bool=True):
+        import numpy as np
+
+        self.words = list(words)
+        self.word_to_id = {w: i for i, w in enumerate(self.words)}
+        if normalize:
+            vectors = np.asarray(vectors, dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.maximum(norms, 1e-12)
+        # vectors may be a memory-mapped float16/float32 array when the index is loaded from disk
+        self.vectors = vectors
+        # LSH structures, see build_lsh
+        self.planes = None
+        self.sorted_codes = None
+        self.sorted_ids = None
+
+        return
+
+    @classmethod
+    def from_keyed_vectors(cls, keyed_vectors):
+        """
+            Build the index from gensim KeyedVectors, i.e. what `train_word2vec_model` returns.
+        """
+        return cls(keyed_vectors.index_to_key, keyed_vectors.vectors)
+
+    def __len__(self):
+        return len(self.words)
+
+    def build_lsh(self, n_tables: int=8, n_bits: int=12, seed: int=42):
+        """
+            Random-projection LSH: each table hashes a vector to the signs of its projections over
+            n_bits random hyperplanes. For each table, we store item ids sorted by hash code, so that
+            the bucket of a code is found with a binary search.
+        """
+        import numpy as np
+
+        rng = np.random.default_rng(seed)
+        dim = self.vectors.shape[1]
+        self.planes = rng.standard_normal((n_tables, dim, n_bits)).astype(np.float32)
+        codes = self._hash(self.vectors)
+        self.sorted_ids = np.argsort(codes, axis=1, kind='stable').astype(np.int32)
+        self.sorted_codes = np.take_along_axis(codes, self.sorted_ids, axis=1)
+
+        return self
+
+    def _hash(self, vectors, block_size: int=65536):
+        """
+            Return the (n_tables, n_vectors) array of LSH codes for the given vectors.
+        """
+        import numpy as np
+
+        n_tables, _, n_bits = self.planes.shape
+        powers = (1 << np.arange(n_bits)).astype(np.int64)
+        codes = np.zeros((n_tables, vectors.shape[0]), dtype=np.int64)
+        for start in range(0, vectors.shape[0], block_size):
+            block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+            for t in range(n_tables):
+                codes[t, start:start + block.shape[0]] = ((block @ self.planes[t]) > 0) @ powers
+
+        return codes
+
+    def _as_query_vectors(self, queries):
+        """
+            Queries can be words (looked up in the index) or raw vectors.
+        """
+        import numpy as np
+
+        if len(queries) and isinstance(queries[0], str):
+            return np.asarray(self.vectors[[self.word_to_id[w] for w in queries]], dtype=np.float32)
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+
+        return queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+    def search_exact(self, query_vectors, top_k: int=10, block_size: int=65536) -> tuple:
+        """
+            Exact search: score the queries against one block of the vocabulary at a time, keeping
+            a running top_k.
+        """
+        import numpy as np
+        from similarity_index import top_k_per_row
+
+        best_ids, best_scores = None, None
+        for start in range(0, self.vectors.shape[0], block_size):
+            block = np.asarray(self.vectors[start:start + block_size], dtype=np.float32)
+            ids, scores = top_k_per_row(query_vectors @ block.T, top_k)
+            ids += start
+            if best_ids is not None:
+                ids = np.hstack([best_ids, ids])
+                scores = np.hstack([best_scores, scores])
+                merged, scores = top_k_per_row(scores, top_k)
+                ids = np.take_along_axis(ids, merged, axis=1)
+            best_ids, best_scores = ids, scores
+
+        return best_ids, best_scores
+
+    def search_lsh(self, query_vectors, top_k: int=10, multi_probe: bool=True) -> tuple:
+        """
+            Approximate search: candidates are the items sharing a bucket with the query in at least one
+            table (plus, with multi_probe, the buckets one bit away), and are then scored exactly.
+
+            Missing results (less than top_k candidates) are reported with id -1 and score 0.
+        """
+        import numpy as np
+        from similarity_index import top_k_per_row
+
+        assert self.planes is not None, "Call build_lsh (or load an index with LSH tables) first"
+        n_tables, _, n_bits = self.planes.shape
+        codes = self._hash(query_vectors)
+        flips = [0] + ([1 << b for b in range(n_bits)] if multi_probe else [])
+        all_ids = np.full((query_vectors.shape[0], top_k), -1, dtype=np.int64)
+        all_scores = np.zeros((query_vectors.shape[0], top_k), dtype=np.float32)
+        for q in range(query_vectors.shape[0]):
+            candidates = []
+            for t in range(n_tables):
+                probes = codes[t, q] ^ np.array(flips, dtype=np.int64)
+                starts = np.searchsorted(self.sorted_codes[t], probes, side='left')
+                ends = np.searchsorted(self.sorted_codes[t], probes, side='right')
+                candidates.extend(self.sorted_ids[t, s:e] for s, e in zip(starts, ends) if e > s)
+            if not candidates:
+                continue
+            candidates = np.unique(np.concatenate(candidates))
+            scores = np.asarray(self.vectors[candidates], dtype=np.float32) @ query_vectors[q]
+            ids, top_scores = top_k_per_row(scores[None, :], top_k)
+            all_ids[q, :ids.shape[1]] = candidates[ids[0]]
+            all_scores[q, :ids.shape[1]] = top_scores[0]
+
+        return all_ids, all_scores
+
+    def search(self, queries, top_k: int=10, mode: str='exact', n_jobs: int=1, batch_size: int=256, **kwargs) -> tuple:
+        """
+            Return (ids, scores) of the top_k neighbours for a batch of queries (words or vectors).
+            With n_jobs > 1, batches of queries are answered in parallel by a thread pool.
+            No queries give empty (0, top_k) arrays.
+        """
+        import numpy as np
+        from concurrent.futures import ThreadPoolExecutor
+
+        if mode == 'exact':
+            search_fn = self.search_exact
+        elif mode == 'lsh':
+            search_fn = self.search_lsh
+        else:
+            raise ValueError("Unknown search mode: {}".format(mode))
+        if len(queries) == 0:
+            # exact search never returns more results than words, LSH pads missing ones with -1
+            width = top_k if mode == 'lsh' else min(top_k, len(self))
+            return np.zeros((0, width), dtype=np.int64), np.zeros((0, width), dtype=np.float32)
+        query_vectors = self._as_query_vectors(queries)
+        batches = [query_vectors[i:i + batch_size] for i in range(0, query_vectors.shape[0], batch_size)]
+        if n_jobs == 1 or len(batches) == 1:
+            results = [search_fn(b, top_k=top_k, **kwargs) for b in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(lambda b: search_fn(b, top_k=top_k, **kwargs), batches))
+
+        return np.vstack([r[0] for r in results]), np.vstack([r[1] for r in results])
+
+    def most_similar(self, word: str, top_k: int=10, mode: str='exact') -> list:
+        """
+            Same output as gensim `most_similar`: a list of (word, similarity), excluding the word itself.
+        """
+        ids, scores = self.search([word], top_k=top_k + 1, mode=mode)
+        target_id = self.word_to_id[word]
+
+        return [(self.words[i], float(s)) for i, s in zip(ids[0], scores[0]) if i not in (target_id, -1)][:top_k]
+
+    def save(self, folder: str, dtype: str='float32'):
+        """
+            Persist the index in a folder as .npy files (vectors in float32 or float16) and a json vocabulary.
+        """
+        import numpy as np
+
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, 'vectors.npy'), np.asarray(self.vectors, dtype=dtype))
+        if self.planes is not None:
+            np.save(os.path.join(folder, 'planes.npy'), self.planes)
+            np.save(os.path.join(folder, 'sorted_codes.npy'), self.sorted_codes)
+            np.save(os.path.join(folder, 'sorted_ids.npy'), self.sorted_ids)
+        with open(os.path.join(folder, 'words.json'), 'w') as f:
+            json.dump(self.words, f)
+
+        return
+
+    @classmethod
+    def load(cls, folder: str, mmap: bool=True):
+        """
+            Load an index saved with `save`: with mmap, arrays are memory-mapped and pages are read
+            lazily by the OS, so vectors and LSH tables are not copied. The vocabulary is not: words.json
+            is parsed and the word -> id dictionary built at every load, so load time still grows
+            linearly with the size of the vocabulary.
+        """
+        import numpy as np
+
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(folder, 'words.json')) as f:
+            words = json.load(f)
+        index = cls(words, np.load(os.path.join(folder, 'vectors.npy'), mmap_mode=mmap_mode), normalize=False)
+        if os.path.exists(os.path.join(folder, 'planes.npy')):
+            index.planes = np.load(os.path.join(folder, 'planes.npy'))
+            index.sorted_codes = np.load(os.path.join(folder, 'sorted_codes.npy'), mmap_mode=mmap_mode)
+            index.sorted_ids = np.load(os.path.join(folder, 'sorted_ids.npy'), mmap_mode=mmap_mode)
+
+        return index
+
+
+def recall_at_k(true_ids, found_ids) -> float:
+    """
+        Fraction of the exact top_k neighbours retrieved by an approximate search.
+    """
+    hits = sum(len(set(t) & set(f)) for t, f in zip(true_ids.tolist(), found_ids.tolist()))
+
+    return hits / true_ids.size
+
+
+def benchmark_recall_vs_qps(n_words: int=100000, dim: int=48, n_queries: int=1000, top_k: int=10, n_jobs: int=4) -> list:
+    """
+        Compare recall@k and queries per second of LSH configurations against the exact scan, on a
+        synthetic clustered space of the same dimension as the notebook word2vec model. We also report
+        load time for the persisted index, with and without memory-mapping.
+    """
+    import time
+    import tempfile
+    import numpy as np
+
+    rng = np.random.default_rng(42)
+    centers = rng.standard_normal((n_words // 50, dim))
+    vectors = centers[rng.integers(0, len(centers), n_words)] + 0.5 * rng.standard_normal((n_words, dim))
+    index = EmbeddingIndex(['w{}'.format(i) for i in range(n_words)], vectors)
+    queries = index.vectors[rng.integers(0, n_words, n_queries)]
+
+    results = []
+    start = time.time()
+    exact_ids, _ = index.search(queries, top_k=top_k, mode='exact', n_jobs=n_jobs)
+    results.append({'mode': 'exact', 'recall': 1.0, 'qps': n_queries / (time.time() - start)})
+    for n_tables, n_bits in [(4, 14), (8, 12), (16, 10)]:
+        index.build_lsh(n_tables=n_tables, n_bits=n_bits)
+        start = time.time()
+        lsh_ids, _ = index.search(queries, top_k=top_k, mode='lsh', n_jobs=n_jobs)
+        results.append({
+            'mode': 'lsh-{}x{}'.format(n_tables, n_bits),
+            'recall': recall_at_k(exact_ids, lsh_ids),
+            'qps': n_queries / (time.time() - start)
+        })
+
+    with tempfile.TemporaryDirectory() as folder:
+        for dtype in ['float32', 'float16']:
+            index.save(folder, dtype=dtype)
+            for mmap in [True, False]:
+                start = time.time()
+                EmbeddingIndex.load(folder, mmap=mmap)
+                results.append({'mode': 'load-{}-{}'.format(dtype, 'mmap' if mmap else 'copy'),
+                                'seconds': time.time() - start})
+
+    for r in results:
+        print(r)
+
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    benchmark_recall_vs_qps(n_words=int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,193 @@
+"""
+
+    This script collects feature selection utilities to shrink the serving model.
+
+    The model shipped to my_app.py grows with the vocabulary: the TfidfVectorizer stores a dictionary entry
+    and an idf value per word, and MultinomialNB a (classes x words) matrix. As in the bonus section of the
+    text classification notebook, we can keep only the words most predictive of the target (chi2 or mutual
+    information), after dropping rare words (min_df), and then:
+
+    * rewrite the vectorizer with the selected words only, renumbered 0..k-1, and their idf values;
+    * re-fit naive bayes on the reduced features (fitting is a single pass over the counts).
+
+    Since TF-IDF rows are l2-normalized, the reduced training matrix is just the selected columns of the
+    full matrix, re-normalized: there is no need to vectorize the text again.
+
+    For a list of target vocabulary sizes we report the accuracy / size / latency trade-off curve, and pick
+    the smallest model within an accuracy budget.
+
+"""
+
+
+import time
+import pickle
+import numpy as np
+
+
+def document_frequency(X) -> np.ndarray:
+    """
+        Number of rows (documents) in which each column (word) is non-zero.
+    """
+    return np.bincount(X.tocsr().indices, minlength=X.shape[1])
+
+
+def score_features(X, y, method: str='chi2') -> np.ndarray:
+    """
+        Score each column by its association with the labels: chi2 on the TF-IDF values (as in the notebook),
+        or mutual information on word presence.
+    """
+    if method == 'chi2':
+        from sklearn.feature_selection import chi2
+        scores, _ = chi2(X, y)
+    elif method == 'mutual_info':
+        from sklearn.feature_selection import mutual_info_classif
+        scores = mutual_info_classif((X > 0).astype(np.int8), y, discrete_features=True, random_state=42)
+    else:
+        raise ValueError("Unknown feature selection method: {}".format(method))
+
+    return np.nan_to_num(scores, nan=0.0)
+
+
+def select_features(scores: np.ndarray, doc_freq: np.ndarray, k: int=None, min_df: int=1) -> np.ndarray:
+    """
+        Indices (sorted) of the k best scoring columns, among the ones appearing in at least min_df documents.
+        With k=None, all the columns passing min_df are kept.
+    """
+    candidates = np.flatnonzero(doc_freq >= min_df)
+    if k is not None and k < len(candidates):
+        # argpartition is enough: we only need the top k, not their order
+        candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+
+    return np.sort(candidates)
+
+
+def reduce_matrix(X, selected: np.ndarray):
+    """
+        Columns of the TF-IDF matrix for the selected words, re-normalized: this is exactly what the compact
+        vectorizer would output on the same text.
+    """
+    from sklearn.preprocessing import normalize
+
+    return normalize(X.tocsc()[:, selected].tocsr())
+
+
+def compact_vectorizer(vectorizer, selected: np.ndarray):
+    """
+        A new TfidfVectorizer with the same settings, whose vocabulary is the selected words only, renumbered
+        in the original order, and their idf values.
+    """
+    from sklearn.base import clone
+
+    words = vectorizer.get_feature_names_out() if hasattr(vectorizer, 'get_feature_names_out') else np.array(vectorizer.get_feature_names())
+    compact = clone(vectorizer)
+    compact.set_params(vocabulary={w: i for i, w in enumerate(words[selected].tolist())})
+    compact.idf_ = vectorizer.idf_[selected]
+
+    return compact
+
+
+def build_compact_model(vectorizer, X_train, y_train, k: int=None, method: str='chi2', min_df: int=1,
+                        make_model=None, scores: np.ndarray=None, doc_freq: np.ndarray=None) -> tuple:
+    """
+        Select the features on the training set, and return the compact vectorizer, the model re-fitted on
+        the reduced features and the selected (original) column indices. Scores and document frequencies
+        can be passed in, to avoid re-computing them for each k.
+    """
+    if make_model is None:
+        from flow_utils import get_classification_model
+        make_model = get_classification_model
+    scores = score_features(X_train, y_train, method) if scores is None else scores
+    doc_freq = document_frequency(X_train) if doc_freq is None else doc_freq
+    selected = select_features(scores, doc_freq, k=k, min_df=min_df)
+    model = make_model().fit(reduce_matrix(X_train, selected), y_train)
+
+    return compact_vectorizer(vectorizer, selected), model, selected
+
+
+def measure_serving(vectorizer, model, sentences, repeat: int=3) -> dict:
+    """
+        Size, load time (unpickling) and scoring latency (per sentence, one sentence at a time, as in
+        the app) of a vectorizer + model pair.
+    """
+    blobs = [pickle.dumps(_, protocol=pickle.HIGHEST_PROTOCOL) for _ in (vectorizer, model)]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for blob in blobs:
+            pickle.loads(blob)
+    load_seconds = (time.perf_counter() - start) / repeat
+    start = time.perf_counter()
+    for sentence in sentences:
+        model.predict(vectorizer.transform([sentence]))
+    latency_ms = 1000 * (time.perf_counter() - start) / max(len(sentences), 1)
+
+    return {'bytes': sum(len(_) for _ in blobs), 'load_seconds': load_seconds, 'latency_ms': latency_ms}
+
+
+def trade_off_curve(vectorizer, X_train, y_train, X_test, y_test, test_sentences, vocabulary_sizes: list,
+                    method: str='chi2', min_df: int=1, make_model=None, latency_sample: int=200) -> list:
+    """
+        For each target vocabulary size (None is the full vocabulary, after min_df), build the compact
+        vectorizer + model and report vocabulary size, accuracy on the test set, size, load time and latency.
+    """
+    from sklearn.metrics import accuracy_score
+
+    scores = score_features(X_train, y_train, method)
+    doc_freq = document_frequency(X_train)
+    sample = [test_sentences[_] for _ in range(min(latency_sample, len(test_sentences)))]
+    curve = []
+    for k in [None] + sorted(set(vocabulary_sizes), reverse=True):
+        if k is not None and curve and k >= curve[0]['vocabulary_size']:
+            continue
+        compact, model, selected = build_compact_model(vectorizer, X_train, y_train, k=k, min_df=min_df,
+                                                       make_model=make_model, scores=scores, doc_freq=doc_freq)
+        accuracy = accuracy_score(y_test, model.predict(reduce_matrix(X_test, selected)))
+        point = {'target_size': k, 'vocabulary_size': len(selected), 'accuracy': accuracy}
+        point.update(measure_serving(compact, model, sample))
+        print("vocabulary {:>7}: accuracy {:.4f}, {:>10} bytes, load {:.4f}s, {:.3f} ms / sentence".format(
+            point['vocabulary_size'], accuracy, point['bytes'], point['load_seconds'], point['latency_ms']))
+        curve.append(point)
+
+    return curve
+
+
+def choose_point(curve: list, accuracy_budget: float=0.01) -> dict:
+    """
+        Smallest model whose accuracy is within accuracy_budget of the best point on the curve.
+    """
+    best_accuracy = max(p['accuracy'] for p in curve)
+    eligible = [p for p in curve if p['accuracy'] >= best_accuracy - accuracy_budget]
+
+    return min(eligible, key=lambda p: p['vocabulary_size'])
+
+
+def benchmark_feature_selection(n_sentences: int=20000, vocabulary_sizes: list=None, method: str='chi2') -> list:
+    """
+        Trade-off curve on the financial_phrasebank dataset (or on synthetic Zipf sentences, when it is not
+        available offline, see similarity_index.make_synthetic_corpus).
+    """
+    from sklearn.model_selection import train_test_split
+    from flow_utils import tf_idf_vectorizer
+
+    try:
+        from flow_utils import get_finance_sentences
+        pairs = get_finance_sentences()
+        sentences, labels = [_[0] for _ in pairs], [_[1] for _ in pairs]
+    except Exception as e:
+        from similarity_index import make_synthetic_corpus
+        print("Finance dataset not available ({}), using a synthetic corpus".format(e))
+        sentences = make_synthetic_corpus(n_sentences, vocabulary_size=20000)
+        # labels depend on mid-frequency words only (the majority class of the ids in [20, 2000) mod 3),
+        # so that feature selection has something to find
+        labels = [int(np.argmax(np.bincount([i % 3 for i in (int(w[1:]) for w in s.split()) if 20 <= i < 2000],
+                                            minlength=3))) for s in sentences]
+    X_train, X_test, y_train, y_test = train_test_split(sentences, labels, test_size=0.2, random_state=42)
+    vectorizer, X_train_vectorized, X_test_vectorized = tf_idf_vectorizer(X_train, X_test)
+
+    return trade_off_curve(vectorizer, X_train_vectorized, y_train, X_test_vectorized, y_test, X_test,
+                           vocabulary_sizes or [250, 500, 1000, 2000, 5000], method=method, min_df=2)
+
+
+if __name__ == '__main__':
+    import sys
+
+    benchmark_feature_selection(method=sys.argv[1] if len(sys.argv) > 1 else 'chi2')
@@ -5,9 +5,20 @@
 """
 
 
+import re
+import string
 from datetime import datetime
 
 
+# keep this module light: heavy libraries are imported inside the functions that need them, so that
+# a serving process importing only the text cleaning helpers starts fast (see benchmarks/import_time.py)
+
+
+# punctuation pattern, compiled once: faster than a per-character loop, and than str.translate on
+# non-ascii text (which falls back to a dict lookup per character)
+_PUNCTUATION = re.compile('[{}]'.format(re.escape(string.punctuation)))
+
+
 def get_finance_sentiment_dataset(split: str='sentences_allagree') -> list:
     """
         Load financial dataset from HF: https://huggingface.co/datasets/financial_phrasebank
@@ -22,13 +33,17 @@ def get_finance_sentiment_dataset(split: str='sentences_allagree') -> list:
     return dataset['train']
 
 
-def get_finance_sentences():
+def get_finance_sentences(split: str='sentences_allagree'):
     """
-        Load and clean up sentences from the dataset.
+        Load cleaned up sentences from the dataset, as [sentence, label] pairs. Sentences are read in batches
+        from a local, memory-mapped snapshot, which is created on the first call (see dataset_cache.py).
     """
-    dataset = get_finance_sentiment_dataset()
-    cleaned_dataset = [[pre_process_sentence(_['sentence']), _['label']] for _ in dataset]
-    
+    from dataset_cache import iter_finance_batches
+
+    cleaned_dataset = []
+    for sentences, labels in iter_finance_batches(split=split):
+        cleaned_dataset.extend([s, l] for s, l in zip(sentences, labels.tolist()))
+
     return cleaned_dataset
 
 
@@ -36,18 +51,22 @@ def pre_process_sentence(sentence: str) -> str:
     """
         Given a sentence, return a new one all lower-cased and without punctuation.
     """
-    import string
-    # lower case
-    lower_sentence = sentence.lower()
-    # remove punctuation
-    exclude = set(string.punctuation)
-    return ''.join(ch for ch in lower_sentence if ch not in exclude)
+    # lower case, and remove punctuation
+    return _PUNCTUATION.sub('', sentence.lower())
 
 
-def tf_idf_vectorizer(X_train: list, X_test: list) -> tuple:
+def tf_idf_vectorizer(X_train: list, X_test: list, n_jobs: int=1) -> tuple:
     """
         Given a list of sentences, return a list of vectors based on TF-IDF weighting scheme
+
+        With n_jobs > 1, the sentences are split in shards, fitted and transformed in n_jobs processes
+        (see sharded_tfidf.py): the result is the same.
     """
+    if n_jobs > 1:
+        from sharded_tfidf import sharded_fit_transform, sharded_transform
+        vectorizer, _X_train = sharded_fit_transform(X_train, n_jobs=n_jobs)
+        return vectorizer, _X_train, sharded_transform(vectorizer, X_test, n_jobs=n_jobs)
+
     from sklearn.feature_extraction.text import TfidfVectorizer
 
     vectorizer = TfidfVectorizer(analyzer='word', stop_words='english')
@@ -57,13 +76,34 @@ def tf_idf_vectorizer(X_train: list, X_test: list) -> tuple:
     return  vectorizer, _X_train, _X_test
 
 
-def get_classification_model():
+def hashing_vectorizer(X_train: list, X_test: list) -> tuple:
+    """
+        Same as tf_idf_vectorizer, but with a stateless featurizer (hashed word counts), so that the model
+        can be updated incrementally later on without re-fitting a vocabulary (see online_training.py).
+    """
+    from online_training import get_hashing_vectorizer
+
+    vectorizer = get_hashing_vectorizer()
+
+    return vectorizer, vectorizer.transform(X_train), vectorizer.transform(X_test)
+
+
+def get_classification_model(model_type: str='naive_bayes'):
     """
-        Returns a scikit model with the usual fit / predict interface. For now, we always return naive bayes:
+        Returns a scikit model with the usual fit / predict interface. By default, we return naive bayes:
 
         See: https://scikit-learn.org/stable/modules/generated/sklearn.naive_bayes.MultinomialNB.html#sklearn.naive_bayes.MultinomialNB
 
+        As a fast alternative, 'perceptron' returns the vectorized mini-batch Perceptron in linear_models.py.
+        For dense features (e.g. sentence embeddings, see sentence_embeddings.py), 'logistic_regression'.
     """
+    if model_type == 'perceptron':
+        from linear_models import Perceptron
+        return Perceptron(early_stopping=True)
+    if model_type == 'logistic_regression':
+        from sklearn.linear_model import LogisticRegression
+        return LogisticRegression(max_iter=1000)
+
     from sklearn.naive_bayes import MultinomialNB
     
     return MultinomialNB()
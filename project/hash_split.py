@@ -0,0 +1 @@
+../mlsys/training/hash_split.py
\ No newline at end of file
@@ -0,0 +1 @@
+../mlsys/training/instrumentation.py
\ No newline at end of file
@@ -0,0 +1,293 @@
+"""
+
+    This script collects a vectorized version of the Perceptron we build from scratch in the word
+    embeddings notebook. The notebook version loops over epochs and samples in Python, and calls
+    predict once per row: it is great to understand the algorithm, but too slow on real features.
+
+    The class below keeps the same `predict` / `train` API, but:
+
+    * processes mini-batches with matrix operations (batch_size=1 gives back the classic online update);
+    * accepts dense arrays or sparse matrices, e.g. the TF-IDF features from `flow_utils.tf_idf_vectorizer`;
+    * supports more than two classes (multi-class perceptron update);
+    * supports early stopping on a held-out fraction of the training data;
+    * optionally trains data-parallel over shards, averaging the weights after every epoch.
+
+    It also has the scikit `fit` / `predict` interface, so that it can be returned by `get_classification_model`.
+
+    You can run the benchmark from the command line, e.g.:
+
+    python linear_models.py
+
+"""
+
+
+import numpy as np
+
+
+def _train_shard_epoch(shard_id: int, weights, learning_rate: float, batch_size: int, seed: int):
+    """
+        Train one epoch on one of the shards stored in the worker globals (see _init_shard_worker).
+    """
+    model = Perceptron(batch_size=batch_size)
+    model.classes_ = _SHARDS['classes']
+    model.weights = weights.copy()
+    X, y = _SHARDS['shards'][shard_id]
+    model._run_epoch(X, y, learning_rate, np.random.default_rng(seed))
+
+    return model.weights
+
+
+_SHARDS = {}
+
+
+def _init_shard_worker(shards: list, classes):
+    """
+        Each worker receives the shards once, when the pool is created, not once per epoch.
+    """
+    _SHARDS['shards'] = shards
+    _SHARDS['classes'] = classes
+
+    return
+
+
+class Perceptron(object):
+    """
+    Mini-batch perceptron. With two classes, weights is a vector (bias first), exactly as in the notebook;
+    with more classes, weights is a (n_classes, n_inputs + 1) matrix, one row per class.
+    """
+
+    def __init__(self, no_of_inputs: int=None, batch_size: int=32, early_stopping: bool=False,
+                 validation_fraction: float=0.1, patience: int=5, n_jobs: int=1, random_state: int=42):
+        # initialize the w + bias array: if the input size is not known yet, we do it on train
+        self.weights = np.zeros(no_of_inputs + 1) if no_of_inputs else None
+        self.classes_ = None
+        self.batch_size = batch_size
+        self.early_stopping = early_stopping
+        self.validation_fraction = validation_fraction
+        self.patience = patience
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.epochs_run = 0
+
+        return
+
+    def _scores(self, inputs):
+        if self.weights.ndim == 1:
+            return np.asarray(inputs @ self.weights[1:]).ravel() + self.weights[0]
+
+        return np.asarray(inputs @ self.weights[:, 1:].T) + self.weights[:, 0]
+
+    def _predict_ids(self, inputs):
+        scores = self._scores(inputs)
+        if self.weights.ndim == 1:
+            return (scores > 0).astype(np.int64)
+
+        return np.argmax(scores, axis=1)
+
+    def predict(self, inputs):
+        """
+            Predict a single input (as in the notebook, returns a label) or a batch of inputs (returns an array).
+        """
+        from scipy import sparse
+
+        if not sparse.issparse(inputs):
+            inputs = np.asarray(inputs)
+        is_single = inputs.ndim == 1
+        if is_single:
+            inputs = inputs[np.newaxis, :]
+        ids = self._predict_ids(inputs)
+        labels = self.classes_[ids] if self.classes_ is not None else ids
+
+        return labels[0] if is_single else labels
+
+    def _run_epoch(self, X, y_ids, learning_rate: float, rng) -> int:
+        """
+            One pass over (shuffled) data in mini-batches: predictions for a batch are made with the weights
+            at the start of the batch, and the updates of all the errors in the batch are summed up.
+            Returns the number of training errors.
+        """
+        order = rng.permutation(X.shape[0])
+        errors = 0
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            X_b, y_b = X[batch], y_ids[batch]
+            predicted = self._predict_ids(X_b)
+            wrong = predicted != y_b
+            n_wrong = int(wrong.sum())
+            if not n_wrong:
+                continue
+            errors += n_wrong
+            if self.weights.ndim == 1:
+                # same update as the notebook, (label - prediction) * inputs, for the whole batch at once
+                delta = (y_b - predicted).astype(np.float64)
+                self.weights[1:] += learning_rate * np.asarray(X_b.T @ delta).ravel()
+                self.weights[0] += learning_rate * delta.sum()
+            else:
+                # multi-class update: reward the true class, penalize the predicted one
+                delta = np.zeros((len(batch), self.weights.shape[0]))
+                rows = np.flatnonzero(wrong)
+                delta[rows, y_b[rows]] = 1.0
+                delta[rows, predicted[rows]] = -1.0
+                self.weights[:, 1:] += learning_rate * np.asarray(X_b.T @ delta).T
+                self.weights[:, 0] += learning_rate * delta.sum(axis=0)
+
+        return errors
+
+    def train(self, training_inputs, labels, epochs: int=100, learning_rate: float=0.01):
+        """
+            Train the model, with the same signature as the notebook version.
+        """
+        from scipy import sparse
+
+        X = training_inputs.tocsr() if sparse.issparse(training_inputs) else np.asarray(training_inputs, dtype=np.float64)
+        previous_classes = self.classes_
+        self.classes_, y_ids = np.unique(np.asarray(labels), return_inverse=True)
+        n_inputs = X.shape[1]
+        shape = (n_inputs + 1,) if len(self.classes_) <= 2 else (len(self.classes_), n_inputs + 1)
+        # weights are kept (warm start) only if they are for the same inputs and the same classes
+        same_classes = previous_classes is None or np.array_equal(previous_classes, self.classes_)
+        if self.weights is None or self.weights.shape != shape or not same_classes:
+            self.weights = np.zeros(shape)
+        rng = np.random.default_rng(self.random_state)
+        # hold out some data for early stopping
+        X_val, y_val = None, None
+        if self.early_stopping:
+            order = rng.permutation(X.shape[0])
+            n_val = max(1, int(self.validation_fraction * X.shape[0]))
+            X_val, y_val = X[order[:n_val]], y_ids[order[:n_val]]
+            X, y_ids = X[order[n_val:]], y_ids[order[n_val:]]
+
+        best_accuracy, best_weights, epochs_without_improvement = -1.0, None, 0
+        epoch_fn = self._train_epochs_parallel(X, y_ids, learning_rate) if self.n_jobs > 1 else None
+        self.epochs_run = 0
+        for epoch in range(epochs):
+            errors = epoch_fn(epoch) if epoch_fn else self._run_epoch(X, y_ids, learning_rate, rng)
+            self.epochs_run += 1
+            if self.early_stopping:
+                accuracy = float((self._predict_ids(X_val) == y_val).mean())
+                if accuracy > best_accuracy:
+                    best_accuracy, best_weights, epochs_without_improvement = accuracy, self.weights.copy(), 0
+                else:
+                    epochs_without_improvement += 1
+                if epochs_without_improvement >= self.patience:
+                    break
+            elif errors == 0:
+                # data is separated, nothing left to learn
+                break
+        if epoch_fn:
+            epoch_fn(None)
+        if best_weights is not None:
+            self.weights = best_weights
+
+        return self
+
+    def _train_epochs_parallel(self, X, y_ids, learning_rate: float):
+        """
+            Data-parallel training (iterative parameter mixing): every epoch, each shard is trained starting
+            from the current weights in a separate process, and the resulting weights are averaged.
+            Returns a function running one epoch (call it with None to shut down the pool).
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        shard_ids = np.array_split(np.arange(X.shape[0]), self.n_jobs)
+        shards = [(X[_], y_ids[_]) for _ in shard_ids]
+        executor = ProcessPoolExecutor(max_workers=self.n_jobs,
+                                       initializer=_init_shard_worker,
+                                       initargs=(shards, self.classes_))
+
+        def run_epoch(epoch):
+            if epoch is None:
+                executor.shutdown()
+                return 0
+            futures = [executor.submit(_train_shard_epoch, i, self.weights, learning_rate, self.batch_size,
+                                       self.random_state + epoch * self.n_jobs + i)
+                       for i in range(self.n_jobs)]
+            self.weights = np.mean([f.result() for f in futures], axis=0)
+            # errors are re-computed with the averaged weights
+            return int((self._predict_ids(X) != y_ids).sum())
+
+        return run_epoch
+
+    def fit(self, X, y, epochs: int=100, learning_rate: float=0.01):
+        """
+            Scikit-style alias for train.
+        """
+        return self.train(X, y, epochs=epochs, learning_rate=learning_rate)
+
+
+def _notebook_perceptron(X, y, epochs: int) -> tuple:
+    """
+        The original per-sample loop from the notebook (binary labels, dense rows), as a baseline.
+        Returns the weights and the epochs per second.
+    """
+    import time
+
+    weights = np.zeros(X.shape[1] + 1)
+    start = time.time()
+    for _ in range(epochs):
+        for inputs, label in zip(X, y):
+            prediction = 1 if np.dot(inputs, weights[1:]) + weights[0] > 0 else 0
+            weights[1:] += 0.01 * (label - prediction) * inputs
+            weights[0] += 0.01 * (label - prediction)
+
+    return weights, epochs / (time.time() - start)
+
+
+def benchmark_epochs_per_second(epochs: int=5, use_finance_dataset: bool=True) -> dict:
+    """
+        Measure epochs per second and test accuracy on the finance TF-IDF features (or on a synthetic corpus,
+        whose labels depend on mid-frequency words, to run offline).
+
+        Like for like: the notebook loop needs dense binary inputs, so the baseline and the vectorized
+        Perceptron (online, batch_size=1, and mini-batch) all run the same task, positive vs not positive,
+        on the same dense features, for the same number of epochs. The mini-batch Perceptron is then also
+        run on the sparse features (same task), and on the three-class task with sparse features.
+    """
+    import time
+    from sklearn.metrics import accuracy_score
+    from flow_utils import tf_idf_vectorizer
+
+    if use_finance_dataset:
+        from flow_utils import get_finance_sentences
+        dataset = get_finance_sentences()
+        sentences, labels = [_[0] for _ in dataset], np.array([_[1] for _ in dataset])
+    else:
+        from similarity_index import make_synthetic_corpus
+        sentences = make_synthetic_corpus(5000, vocabulary_size=5000)
+        # as in feature_selection.py: labels depend on mid-frequency words only, so they can be learned
+        labels = np.array([int(np.argmax(np.bincount([i % 3 for i in (int(w[1:]) for w in s.split()) if 20 <= i < 2000],
+                                                     minlength=3))) for s in sentences])
+    split = int(0.8 * len(sentences))
+    _, X_train, X_test = tf_idf_vectorizer(sentences[:split], sentences[split:])
+    y_train, y_test = labels[:split], labels[split:]
+    y_train_binary, y_test_binary = (y_train == 2).astype(int), (y_test == 2).astype(int)
+    X_train_dense, X_test_dense = X_train.toarray(), X_test.toarray()
+
+    results = {}
+    weights, epochs_per_second = _notebook_perceptron(X_train_dense, y_train_binary, epochs)
+    baseline_predictions = (X_test_dense @ weights[1:] + weights[0] > 0).astype(int)
+    results['notebook loop, binary, dense'] = {'epochs_per_second': epochs_per_second,
+                                               'accuracy': accuracy_score(y_test_binary, baseline_predictions)}
+    runs = [
+        ('perceptron batch_size=1, binary, dense', dict(batch_size=1), X_train_dense, X_test_dense, y_train_binary, y_test_binary),
+        ('perceptron batch_size=64, binary, dense', dict(batch_size=64), X_train_dense, X_test_dense, y_train_binary, y_test_binary),
+        ('perceptron batch_size=64, binary, sparse', dict(batch_size=64), X_train, X_test, y_train_binary, y_test_binary),
+        ('perceptron batch_size=64, 3 classes, sparse', dict(batch_size=64), X_train, X_test, y_train, y_test),
+        ('perceptron batch_size=64, 3 classes, sparse, n_jobs=4', dict(batch_size=64, n_jobs=4), X_train, X_test, y_train, y_test)
+    ]
+    for name, params, X_tr, X_te, y_tr, y_te in runs:
+        model = Perceptron(**params)
+        start = time.time()
+        model.train(X_tr, y_tr, epochs=epochs)
+        # epochs actually run: training stops early if the data is separated
+        results[name] = {'epochs_per_second': model.epochs_run / (time.time() - start),
+                         'accuracy': accuracy_score(y_te, model.predict(X_te))}
+    for name, r in results.items():
+        print("{:<55} {:>10.2f} epochs/s   accuracy {:.3f}".format(name, r['epochs_per_second'], r['accuracy']))
+
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    benchmark_epochs_per_second(use_finance_dataset='--synthetic' not in sys.argv)
@@ -0,0 +1,471 @@
+"""
+
+    This script collects a multi-model registry for the Flask app (my_app.py), to evaluate retrained models
+    on live traffic without replacing the current one.
+
+    * Live models split the traffic by weight (A/B): each request goes to one of them, chosen by a hash of
+      a request key (by default the sentence), so the same key always sees the same model.
+    * Shadow models score every request in separate worker processes, at a lower CPU priority, after the
+      answer is computed: the response never waits for them, and they do not compete with the live requests
+      for the GIL. Their predictions are only compared with the one served, and counted.
+    * Models whose vectorizers are the same (same pickled configuration and fitted vocabulary) share one
+      vectorizer instance, and the TF-IDF transform of a request is computed once and re-used across them
+      (across the live models, and across the shadow models in a worker).
+    * Per-model latency histograms and shadow agreement counters go to the metrics registry (/metrics), and
+      a summary per shadow model is logged every log_every comparisons.
+
+    Models are listed in a json file (MODELS_CONFIG in the app, models.json by default), e.g.:
+
+    [{"name": "current", "folder": ".", "weight": 0.9},
+     {"name": "retrained", "folder": "models/retrained", "weight": 0.1},
+     {"name": "candidate", "folder": "models/candidate", "shadow": true}]
+
+    Each folder holds a vectorizer.pkl / model.pkl pair, as dumped by my_flow.py; without a config file, the
+    registry serves the pair in the current folder, as before. Measure the latency added by shadow scoring with:
+
+    python model_registry.py
+
+"""
+
+
+import os
+import json
+import time
+import pickle
+import hashlib
+import logging
+import threading
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait
+from hash_split import hash_fraction, row_key
+from serving_metrics import MetricsRegistry
+
+
+def vectorizer_key(pickled: bytes) -> str:
+    """
+        Fingerprint of a pickled (fitted) vectorizer: vectorizers with the same key transform sentences the
+        same way. We hash the bytes of vectorizer.pkl as they are on disk, as pickling a loaded vectorizer
+        again is not deterministic (the order of its stop word set changes from one load to the next).
+    """
+    return hashlib.blake2b(pickled, digest_size=16).hexdigest()
+
+
+# a loaded vectorizer / model pair: never modified, a reload builds a new one and swaps it in with a
+# single assignment, so a request reading it once never pairs a new vectorizer with an old model
+ModelVersion = namedtuple('ModelVersion', 'vectorizer model vectorizer_key mtimes')
+
+
+class IncompletePair(Exception):
+    """
+    The vectorizer.pkl / model.pkl in a folder do not belong together (yet).
+    """
+    pass
+
+
+def artifact_mtimes(folder: str) -> tuple:
+    return tuple(os.path.getmtime(os.path.join(folder, name)) for name in ['vectorizer.pkl', 'model.pkl'])
+
+
+def load_version(folder: str, check_order: bool=True) -> ModelVersion:
+    """
+        Load the pair in folder. my_flow.py and publish_artifacts (online_training.py) write vectorizer.pkl
+        first, then model.pkl: a vectorizer newer than the model (check_order), or files changing while we
+        read them, mean that a publication is in progress, and we raise IncompletePair (as for pairs with
+        different feature counts).
+    """
+    mtimes = artifact_mtimes(folder)
+    with open(os.path.join(folder, 'vectorizer.pkl'), 'rb') as f:
+        pickled_vectorizer = f.read()
+    vectorizer = pickle.loads(pickled_vectorizer)
+    with open(os.path.join(folder, 'model.pkl'), 'rb') as f:
+        model = pickle.load(f)
+    if (check_order and mtimes[0] > mtimes[1]) or artifact_mtimes(folder) != mtimes:
+        raise IncompletePair("Artifacts in {} are being published".format(folder))
+    n_features = getattr(model, 'n_features_in_', None)
+    if n_features is not None and vectorizer.transform(['']).shape[1] != n_features:
+        raise IncompletePair("Vectorizer and model in {} have different feature counts".format(folder))
+
+    return ModelVersion(vectorizer, model, vectorizer_key(pickled_vectorizer), mtimes)
+
+
+class ServedModel(object):
+    """
+    A named model, from a folder (reloaded when model.pkl changes) or from memory: the current
+    ModelVersion is in `version`, read it once per request.
+    """
+
+    def __init__(self, name: str, folder: str=None, weight: float=1.0, shadow: bool=False,
+                 vectorizer=None, model=None):
+        self.name = name
+        self.folder = folder
+        self.weight = weight
+        self.shadow = shadow
+        # artifacts which could not be loaded: not retried until they change again
+        self.rejected_mtimes = None
+        if folder is not None:
+            self.version = load_version(folder, check_order=False)
+        else:
+            self.version = ModelVersion(vectorizer, model, vectorizer_key(pickle.dumps(vectorizer, protocol=4)), None)
+
+        return
+
+    @property
+    def model(self):
+        return self.version.model
+
+    def current_mtimes(self) -> tuple:
+        """
+            Modification times of the artifacts on disk, None while one of them is missing.
+        """
+        try:
+            return artifact_mtimes(self.folder)
+        except OSError:
+            return None
+
+    def changed(self) -> bool:
+        if self.folder is None:
+            return False
+        mtimes = self.current_mtimes()
+
+        return mtimes is not None and mtimes != self.version.mtimes and mtimes != self.rejected_mtimes
+
+    def load_new_version(self) -> ModelVersion:
+        """
+            The pair now in the folder, or None if it cannot be loaded: the caller keeps the current version.
+        """
+        mtimes = None
+        try:
+            mtimes = artifact_mtimes(self.folder)
+            return load_version(self.folder)
+        except (IncompletePair, pickle.UnpicklingError, EOFError, OSError, ValueError) as e:
+            # a pair being published (e.g. a pickle written in place), or broken for good:
+            # do not retry until the files change again
+            logging.getLogger('model_registry').warning("Not reloading {}: {}".format(self.name, e))
+            self.rejected_mtimes = mtimes if mtimes == self.current_mtimes() else None
+            return None
+
+
+# shadow models in a worker process, set by _init_shadow_worker
+_worker_shadow_models = []
+
+
+def _init_shadow_worker(shadow_models: list, niceness: int):
+    global _worker_shadow_models
+    _worker_shadow_models = shadow_models
+    # live requests in the parent get the CPU first
+    os.nice(niceness)
+
+
+def _score_shadows_in_worker(sentence: str, served_label) -> list:
+    """
+        Score the sentence with every shadow model, reloading the ones which changed on disk:
+        returns (name, agrees with the served label, seconds) per model.
+    """
+    results, features = [], {}
+    for m in _worker_shadow_models:
+        if m.changed():
+            version = m.load_new_version()
+            if version is not None:
+                m.version = version
+        version = m.version
+        start = time.perf_counter()
+        # transform once per vectorizer, across the shadow models
+        if version.vectorizer_key not in features:
+            features[version.vectorizer_key] = version.vectorizer.transform([sentence])
+        label = version.model.predict(features[version.vectorizer_key])[0]
+        results.append((m.name, bool(label == served_label), time.perf_counter() - start))
+
+    return results
+
+
+class ModelRegistry(object):
+    """
+    Live models (A/B by weight) served synchronously, shadow models scored in background processes.
+    """
+
+    def __init__(self, models: list, registry: MetricsRegistry=None, request_log=None, shadow_workers: int=1,
+                 max_pending_shadows: int=64, log_every: int=100, shadow_niceness: int=19):
+        self.models = list(models)
+        if not [m for m in self.models if not m.shadow]:
+            raise ValueError("At least one model must be live (not shadow)")
+        if len(set(m.name for m in self.models)) != len(self.models):
+            raise ValueError("Model names must be unique")
+        self.metrics = registry if registry is not None else MetricsRegistry()
+        # a RateLimitedLogger for the shadow summaries, if given
+        self.request_log = request_log
+        self.log_every = log_every
+        # shadow scoring is dropped, not queued, when the workers fall behind
+        self.max_pending_shadows = max_pending_shadows
+        self._pending = 0
+        self._lock = threading.Lock()
+        # reloads are serialized: concurrent requests noticing the same change load it once
+        self._reload_lock = threading.Lock()
+        self._comparisons = {m.name: 0 for m in self.shadow_models}
+        self._agreements = {m.name: 0 for m in self.shadow_models}
+        # metrics are created once per model, the hot path only looks them up in a dict
+        self._dropped = self.metrics.counter('shadow_dropped_total', 'Shadow scorings dropped, executor behind')
+        self._latencies = {m.name: self.metrics.histogram('model_seconds', 'Vectorize + predict latency per model',
+                                                          labels={'model': m.name, 'role': 'shadow' if m.shadow else 'live'})
+                           for m in self.models}
+        self._requests = {m.name: self.metrics.counter('model_requests_total', 'Requests served per model',
+                                                       labels={'model': m.name}) for m in self.live_models}
+        self._agreement_counters = {(m.name, agree): self.metrics.counter(
+            'shadow_agreement_total', 'Shadow predictions, agreeing or not with the served one',
+            labels={'model': m.name, 'agree': str(agree).lower()}) for m in self.shadow_models for agree in [True, False]}
+        for m, version in zip(self.models, self._share_vectorizers([m.version for m in self.models])):
+            m.version = version
+        self._executor = self._start_shadow_workers(shadow_workers, shadow_niceness) if self.shadow_models else None
+
+        return
+
+    def _start_shadow_workers(self, n_workers: int, niceness: int) -> ProcessPoolExecutor:
+        """
+            Worker processes are forked now, while the app has a single thread, and inherit the loaded
+            shadow models (the app module is not imported again, as it would be with spawn).
+        """
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+        executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=context, initializer=_init_shadow_worker,
+                                       initargs=(self.shadow_models, niceness))
+        # processes are started on demand: one task each, at once, starts them all
+        wait([executor.submit(time.sleep, 0.1) for _ in range(n_workers)])
+
+        return executor
+
+    @classmethod
+    def from_config(cls, path: str='models.json', default_folder: str='.', **kwargs):
+        """
+            Registry from a json list of models (name, folder, weight, shadow), or the single pair in
+            default_folder if there is no config file.
+        """
+        if not os.path.exists(path):
+            return cls([ServedModel('default', default_folder)], **kwargs)
+        with open(path) as f:
+            config = json.load(f)
+
+        return cls([ServedModel(c['name'], c['folder'], float(c.get('weight', 1.0)), bool(c.get('shadow', False)))
+                    for c in config], **kwargs)
+
+    @property
+    def live_models(self) -> list:
+        return [m for m in self.models if not m.shadow]
+
+    @property
+    def shadow_models(self) -> list:
+        return [m for m in self.models if m.shadow]
+
+    @property
+    def primary(self) -> ServedModel:
+        """
+            The live model with the largest weight (e.g. for the majority label of the degraded answers).
+        """
+        return max(self.live_models, key=lambda m: m.weight)
+
+    @staticmethod
+    def _share_vectorizers(versions: list, shared: dict=None) -> list:
+        """
+            Same versions, with one vectorizer instance per key (the first seen, or the one in shared).
+        """
+        shared = dict(shared or {})
+
+        return [v._replace(vectorizer=shared.setdefault(v.vectorizer_key, v.vectorizer)) for v in versions]
+
+    def reload_if_changed(self) -> list:
+        """
+            Reload the models whose artifacts changed on disk, returns their names. New versions are loaded
+            and share their vectorizers with the current ones before being published; a model whose new
+            artifacts cannot be loaded, or do not make a pair, keeps serving its current version.
+        """
+        if not any(m.changed() for m in self.models):
+            return []
+        with self._reload_lock:
+            # another request may have reloaded them while we were waiting for the lock
+            reloaded, versions = [], []
+            for m in self.models:
+                if not m.changed():
+                    continue
+                version = m.load_new_version()
+                if version is not None:
+                    versions.append(version)
+                    reloaded.append(m)
+            current = {m.version.vectorizer_key: m.version.vectorizer for m in self.models if m not in reloaded}
+            for m, version in zip(reloaded, self._share_vectorizers(versions, shared=current)):
+                m.version = version
+
+        return [m.name for m in reloaded]
+
+    def choose(self, key: str) -> ServedModel:
+        """
+            Live model for a request key, with probability proportional to its weight.
+        """
+        live = self.live_models
+        total = sum(m.weight for m in live)
+        threshold = hash_fraction(row_key(key), b'ab') * total
+        cumulative = 0.0
+        for m in live:
+            cumulative += m.weight
+            if threshold < cumulative:
+                return m
+
+        return live[-1]
+
+    def predict(self, sentence: str, key: str=None) -> tuple:
+        """
+            Serve the sentence with the live model chosen for key (defaults to the sentence), and submit the
+            shadow scoring. Returns (label, model name, stage timings).
+        """
+        served = self.choose(key if key is not None else sentence)
+        # read the version once: a concurrent reload swaps it as a whole
+        version = served.version
+        start = time.perf_counter()
+        features = {version.vectorizer_key: version.vectorizer.transform([sentence])}
+        vectorize_seconds = time.perf_counter() - start
+        label = version.model.predict(features[version.vectorizer_key])[0]
+        total = time.perf_counter() - start
+        self._latencies[served.name].observe(total)
+        self._requests[served.name].inc()
+        if self._executor is not None:
+            self._submit_shadows(sentence, label)
+
+        return label, served.name, {'vectorize': vectorize_seconds, 'predict': total - vectorize_seconds}
+
+    def _submit_shadows(self, sentence: str, label):
+        with self._lock:
+            if self._pending >= self.max_pending_shadows:
+                self._dropped.inc()
+                return
+            self._pending += 1
+        # only the sentence and the label go to the worker, which transforms it again
+        self._executor.submit(_score_shadows_in_worker, sentence, label).add_done_callback(self._record_shadows)
+
+        return
+
+    def _record_shadows(self, future):
+        """
+            Count the results of a worker, in the executor thread of the app.
+        """
+        try:
+            for name, agree, seconds in future.result():
+                self._latencies[name].observe(seconds)
+                self._compare(name, agree)
+        except Exception as e:
+            # a broken candidate must not take the app down
+            logging.getLogger('model_registry').exception("Shadow scoring failed: {}".format(e))
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+        return
+
+    def _compare(self, name: str, agree: bool):
+        self._agreement_counters[(name, agree)].inc()
+        with self._lock:
+            self._comparisons[name] += 1
+            self._agreements[name] += int(agree)
+            comparisons = self._comparisons[name]
+        if self.request_log is not None and comparisons % self.log_every == 0:
+            self.request_log.log('shadow_stats', model=name, **self.stats()[name])
+
+        return
+
+    def stats(self) -> dict:
+        """
+            Per model: requests, p50 / p99 latency (ms) and, for shadow models, agreement with the served label.
+        """
+        out = {}
+        for m in self.models:
+            histogram = self._latencies[m.name]
+            _, count, _ = histogram.snapshot()
+            out[m.name] = {'role': 'shadow' if m.shadow else 'live', 'weight': m.weight, 'requests': count,
+                           'p50_ms': 1000 * histogram.quantile(0.5), 'p99_ms': 1000 * histogram.quantile(0.99),
+                           'vectorizer': m.version.vectorizer_key[:8]}
+            if m.shadow:
+                with self._lock:
+                    comparisons, agreements = self._comparisons[m.name], self._agreements[m.name]
+                out[m.name]['agreement'] = agreements / comparisons if comparisons else None
+
+        return out
+
+    def wait_for_shadows(self, timeout: float=10.0):
+        """
+            Wait until the submitted shadow scorings are done (for tests and benchmarks).
+        """
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+        return
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+        return
+
+
+def benchmark_shadow_overhead(n_sentences: int=20000, n_requests: int=2000, concurrency: tuple=(1, 4)) -> list:
+    """
+        Live latency (p50 / p99, ms) and throughput serving naive bayes alone, and with two shadow models
+        (one sharing the vectorizer, one with its own), on a synthetic corpus. Clients send requests back
+        to back, without waiting for the shadows, from 1 and from 4 threads, as in the app; shadows are
+        dropped when the worker falls behind. We report how many were scored and dropped, and the agreement
+        of the scored ones.
+    """
+    import numpy as np
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from flow_utils import tf_idf_vectorizer, get_classification_model
+    from similarity_index import make_synthetic_corpus
+
+    sentences = make_synthetic_corpus(n_sentences, vocabulary_size=20000)
+    labels = np.array([int(hash_fraction(row_key(s.split()[0])) * 3) for s in sentences])
+    vectorizer, X, _ = tf_idf_vectorizer(sentences, sentences[:1])
+    bigram_vectorizer = TfidfVectorizer(ngram_range=(1, 2), min_df=2)
+    X_bigrams = bigram_vectorizer.fit_transform(sentences)
+    primary = ServedModel('naive_bayes', vectorizer=vectorizer, model=get_classification_model().fit(X, labels))
+    shadows = [
+        ServedModel('logistic', shadow=True, vectorizer=vectorizer,
+                    model=get_classification_model('logistic_regression').fit(X, labels)),
+        ServedModel('naive_bayes_bigrams', shadow=True, vectorizer=bigram_vectorizer,
+                    model=get_classification_model().fit(X_bigrams, labels))
+    ]
+    requests = sentences[:n_requests]
+    results = []
+    for n_threads in concurrency:
+        for name, models in [('primary only', [primary]), ('primary + 2 shadows', [primary] + shadows)]:
+            registry = ModelRegistry(models)
+            latencies = [[] for _ in range(n_threads)]
+
+            def client(thread_id: int):
+                for sentence in requests[thread_id::n_threads]:
+                    start = time.perf_counter()
+                    registry.predict(sentence)
+                    latencies[thread_id].append(time.perf_counter() - start)
+
+            threads = [threading.Thread(target=client, args=(_,)) for _ in range(n_threads)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            seconds = time.perf_counter() - start
+            # only to count the shadows scored: the latencies above were taken without waiting
+            registry.wait_for_shadows()
+            registry.close()
+            all_latencies = [l for thread_latencies in latencies for l in thread_latencies]
+            result = {'mode': name, 'threads': n_threads,
+                      'p50_ms': 1000 * float(np.percentile(all_latencies, 50)),
+                      'p99_ms': 1000 * float(np.percentile(all_latencies, 99)),
+                      'requests_per_second': len(all_latencies) / seconds,
+                      'shadows_dropped': registry._dropped.value, 'models': registry.stats()}
+            results.append(result)
+            print("{:<22} {} thread(s)  p50 {:.3f} ms  p99 {:.3f} ms  {:.0f} req/s  {} shadow scorings dropped".format(
+                name, n_threads, result['p50_ms'], result['p99_ms'], result['requests_per_second'],
+                result['shadows_dropped']))
+            for model_name, s in result['models'].items():
+                print("    {:<22} {}".format(model_name, s))
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_shadow_overhead()
@@ -6,18 +6,125 @@
 """
 
 from flask import Flask, render_template, request
-import pickle
+import json
+import os
+import time
+import logging
+import threading
 import numpy as np
+from serving_metrics import MetricsRegistry, RateLimitedLogger, SlowRequestLog
+from admission_control import AdmissionController, DegradedPredictor, Overloaded
+from model_registry import ModelRegistry
 
 
 # We need to initialise the Flask object to run the flask app 
 # By assigning parameters as static folder name,templates folder name
 app = Flask(__name__, static_folder='static', template_folder='templates')
-# We need to load the pickled model file AND the vectorizer to transform the text 
+# labelled feedback is appended here, and folded into the model by online_training.py
+FEEDBACK_FILE = os.environ.get('FEEDBACK_FILE', 'feedback.jsonl')
+feedback_lock = threading.Lock()
+FEEDBACK_LABELS = ['0', '1', '2']
+# in-process metrics, exposed on /metrics: per-thread counters and latency histograms per stage
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+metrics = MetricsRegistry()
+STAGES = ['normalize', 'vectorize', 'predict']
+stage_latency = {s: metrics.histogram('request_stage_seconds', 'Latency of each stage of a prediction request',
+                                      labels={'stage': s}) for s in STAGES}
+request_latency = metrics.histogram('request_seconds', 'Latency of a prediction request')
+requests_total = metrics.counter('requests_total', 'Prediction requests served')
+feedback_total = metrics.counter('feedback_total', 'Feedback records received')
+reloads_total = metrics.counter('model_reloads_total', 'Model reloads after a new model was published')
+# structured logs, at most LOG_MAX_PER_SECOND lines per second, and a sample of the requests slower than SLOW_REQUEST_MS
+request_log = RateLimitedLogger(logging.getLogger('my_app'), float(os.environ.get('LOG_MAX_PER_SECOND', 10)))
+slow_request_log = SlowRequestLog(request_log, float(os.environ.get('SLOW_REQUEST_MS', 50)) / 1000,
+                                  float(os.environ.get('SLOW_REQUEST_SAMPLE_RATE', 0.1)))
+# We need to load the pickled model file AND the vectorizer to transform the text
 # to make a prediction on an unseen data point - note that the script assumes the pickled files are in
-# the samee folder
-vectorizer = pickle.load(open('vectorizer.pkl','rb+'))
-model = pickle.load(open('model.pkl','rb+'))
+# the samee folder, unless MODELS_CONFIG lists several models: live ones split the traffic by weight (A/B),
+# shadow ones are scored in the background and compared with the served prediction (see model_registry.py)
+models = ModelRegistry.from_config(os.environ.get('MODELS_CONFIG', 'models.json'), registry=metrics,
+                                   request_log=request_log, shadow_workers=int(os.environ.get('SHADOW_WORKERS', 1)))
+# admission control: at most MAX_CONCURRENCY predictions at a time, and MAX_QUEUE waiting for at most
+# LATENCY_BUDGET_MS; the others get a degraded answer (cached or majority label), or a 503 if DEGRADED_ANSWERS=0
+admission = AdmissionController(int(os.environ.get('MAX_CONCURRENCY', 4)), int(os.environ.get('MAX_QUEUE', 16)),
+                                float(os.environ.get('LATENCY_BUDGET_MS', 100)) / 1000, registry=metrics)
+DEGRADED_ANSWERS = os.environ.get('DEGRADED_ANSWERS', '1') == '1'
+degraded_predictor = DegradedPredictor(DegradedPredictor.majority_label_of(models.primary.model))
+# one counter per label, created once (for the classes of the models, at start): the hot path is a dict lookup
+prediction_counters = {}
+
+
+def prediction_counter(label):
+  if label not in prediction_counters:
+    prediction_counters[label] = metrics.counter('predictions_total', 'Predictions by label', labels={'label': str(label)})
+  return prediction_counters[label]
+
+
+for label in set(l for m in models.models for l in getattr(m.model, 'classes_', [])):
+  prediction_counter(label)
+
+
+def reload_model_if_changed():
+  # models may be re-published by online_training.py while the app is running: we reload them when
+  # their model.pkl changes on disk
+  for _ in models.reload_if_changed():
+    reloads_total.inc()
+    degraded_predictor.majority_label = DegradedPredictor.majority_label_of(models.primary.model)
+
+
+@app.route('/feedback',methods=['POST'])
+def feedback():
+  # the client sends the sentence and the correct label (0: negative, 1: neutral, 2: positive):
+  # anything else is rejected, so that it never reaches the training data
+  sentence = request.form.get('sl', '').strip()
+  label = request.form.get('label', '').strip()
+  if not sentence or label not in FEEDBACK_LABELS:
+    return "Feedback needs a non-empty sentence (sl) and a label in {}".format(', '.join(FEEDBACK_LABELS)), 400
+  record = {'sentence': sentence, 'label': int(label)}
+  with feedback_lock:
+    with open(FEEDBACK_FILE, 'a') as f:
+      f.write(json.dumps(record) + '\n')
+  feedback_total.inc()
+
+  return "Thanks for your feedback!"
+
+
+@app.route('/metrics',methods=['GET'])
+def metrics_endpoint():
+  # Prometheus text format, for a local scraper
+  return metrics.render_text(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@app.route('/models',methods=['GET'])
+def models_endpoint():
+  # latency per model, and agreement of the shadow models with the served predictions
+  return json.dumps(models.stats()), 200, {'Content-Type': 'application/json'}
+
+
+def predict_sentence(input_sentence: str, key: str=None):
+  timings = {}
+  start = time.perf_counter()
+  # make sure we lower case it
+  final_sentence = input_sentence.lower()
+  timings['normalize'] = time.perf_counter() - start
+  # the A/B model is chosen by key (the sentence by default), shadow models are scored off the request path
+  label, model_name, model_timings = models.predict(final_sentence, key=key)
+  timings.update(model_timings)
+  labels = [label]
+  total = time.perf_counter() - start
+  for stage in STAGES:
+    stage_latency[stage].observe(timings[stage])
+  request_latency.observe(total)
+  requests_total.inc()
+  prediction_counter(labels[0]).inc()
+  # debug (rate-limited, so it does not flood the logs under load)
+  request_log.log('prediction', level=logging.DEBUG, label=str(labels[0]), model=model_name, ms=round(total * 1000, 3))
+  slow_request_log.record(total, timings, label=str(labels[0]), model=model_name, length=len(input_sentence))
+  # cached for the degraded answers
+  degraded_predictor.remember(final_sentence, labels[0])
+
+  return labels[0]
+
 
 @app.route('/',methods=['POST','GET'])
 def main():
@@ -30,16 +137,19 @@ def main():
     # debug
     # print(request.form.keys())
     input_sentence = request.form['sl']
-    # make sure we lower case it
-    final_sentence = input_sentence.lower()
-    # debug
-    # print(final_sentence)
-    vectorized_sentence = vectorizer.transform([final_sentence])
-    labels = model.predict(vectorized_sentence)
-    #  debug
-    print(labels)
+    reload_model_if_changed()
+    # under overload, requests are not queued forever: they get a degraded answer, or a 503
+    fallback = (lambda: degraded_predictor.predict(input_sentence.lower())) if DEGRADED_ANSWERS else None
+    try:
+      # an optional client id keeps the same user on the same A/B model
+      result, outcome = admission.run(lambda: predict_sentence(input_sentence, request.form.get('uid')), fallback=fallback)
+    except Overloaded:
+      return "Server overloaded, please retry", 503
+    if outcome == 'degraded':
+      label, source = result
+      return "Predicted label is {}".format(label), 200, {'X-Degraded-Answer': source}
     # Returning the response to ajax	
-    return "Predicted label is {}".format(labels[0])
+    return "Predicted label is {}".format(result)
     
 if __name__=='__main__':
   # Run the Flask app to run the server
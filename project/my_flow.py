@@ -11,6 +11,7 @@ This script has been created for pedagogical purposes, and it does NOT necessare
 
 from metaflow import FlowSpec, step, Parameter, current
 from datetime import datetime
+from instrumentation import instrument
 
 
 class FinanceNewsFlow(FlowSpec):
@@ -29,7 +30,85 @@ class FinanceNewsFlow(FlowSpec):
         default='/Users/jacopotagliabue/Documents/repos/FREE_7773-1/project'
     )
 
+    # if True, we use a stateless (hashing) featurizer, so that the model can later be updated
+    # incrementally with the feedback logged by the Flask app (see online_training.py)
+    INCREMENTAL = Parameter(
+        name='incremental',
+        help='Use hashed features, to allow incremental re-training of the model',
+        default=False
+    )
+
+    # number of processes used to fit TF-IDF (see sharded_tfidf.py)
+    TFIDF_JOBS = Parameter(
+        name='tfidf_jobs',
+        help='Number of processes to fit and apply the TF-IDF vectorizer',
+        default=1
+    )
+
+    # 'tfidf' (sparse TF-IDF + naive bayes) or 'embeddings' (TF-IDF weighted mean of word vectors + logistic
+    # regression, see sentence_embeddings.py)
+    FEATURIZER = Parameter(
+        name='featurizer',
+        help='Features for the classifier: tfidf or embeddings',
+        default='tfidf'
+    )
+
+    WORD_VECTORS = Parameter(
+        name='word_vectors',
+        help='How to train the word vectors of the embeddings featurizer: word2vec or svd',
+        default='word2vec'
+    )
+
+    # feature selection is opt-in: 'none' serves the full vocabulary, 'chi2' or 'mutual_info' prune it
+    # (see feature_selection.py)
+    FEATURE_SELECTION = Parameter(
+        name='feature_selection',
+        help='Method to select the vocabulary of the served model (none, chi2 or mutual_info)',
+        default='none'
+    )
+
+    VOCABULARY_SIZES = Parameter(
+        name='vocabulary_sizes',
+        help='Comma-separated target vocabulary sizes for the accuracy / size trade-off curve',
+        default='250,500,1000,2000,5000'
+    )
+
+    ACCURACY_BUDGET = Parameter(
+        name='accuracy_budget',
+        help='Max validation accuracy we are willing to lose to serve a smaller model',
+        default=0.01
+    )
+
+    MIN_DF = Parameter(
+        name='min_df',
+        help='Words appearing in fewer training sentences are dropped by feature selection',
+        default=2
+    )
+
+    # 'float16' or 'int8' dump idf weights and model weights for the app in reduced precision (see quantization.py)
+    QUANTIZE = Parameter(
+        name='quantize',
+        help='Precision of the weights dumped for serving: none, float16 or int8',
+        default='none'
+    )
+
+    # if True, failed behavioral tests make the run fail (the model is not dumped for serving); skipped
+    # units (too little data) and errored units (back-translation offline) never do
+    FAIL_ON_BEHAVIORAL_REGRESSION = Parameter(
+        name='fail_on_behavioral_regression',
+        help='Fail the run if any behavioral test unit fails',
+        default=True
+    )
+
+    # back-translation calls an online service: opt-in
+    BACK_TRANSLATION = Parameter(
+        name='back_translation',
+        help='Add the back-translation perturbation to the behavioral tests (needs the network)',
+        default=False
+    )
+
     @step
+    @instrument()
     def start(self):
         """
         Start up and print out some info to make sure everything is ok metaflow-side
@@ -39,111 +118,196 @@ class FinanceNewsFlow(FlowSpec):
         print("run id: {}".format(current.run_id))
         print("username: {}".format(current.username))
         print("Final folder: {}".format(self.FINAL_FOLDER))
+        # check --quantize now, not after training: the model is quantized in the last step
+        from quantization import QUANTIZATION_DTYPES, can_quantize
+        from flow_utils import get_classification_model
+
+        assert self.QUANTIZE in ['none'] + QUANTIZATION_DTYPES, \
+            "--quantize must be one of {}, got {}".format(['none'] + QUANTIZATION_DTYPES, self.QUANTIZE)
+        assert self.QUANTIZE == 'none' or can_quantize(get_classification_model(self.model_type())), \
+            "--quantize {}: the {} model cannot be quantized".format(self.QUANTIZE, self.model_type())
 
         self.next(self.load_data)
 
+    def model_type(self) -> str:
+        """
+        Classifier trained by train_model (see flow_utils.get_classification_model)
+        """
+        # naive bayes needs non-negative counts: dense embeddings go to a logistic regression
+        embeddings = self.FEATURIZER == 'embeddings' and not self.INCREMENTAL
+
+        return 'logistic_regression' if embeddings else 'naive_bayes'
+
     @step
+    @instrument(rows=lambda _, flow: len(flow.dataset), artifacts=['dataset'])
     def load_data(self): 
         """
-        Read the data in using the HF API.
+        Read the data in from a local snapshot of the HF dataset (created on the first run, see dataset_cache.py).
         """
-        from flow_utils import get_finance_sentences
+        from dataset_cache import load_finance_dataset
 
-        # get the dataset and use self to version it
-        self.finance_dataset = get_finance_sentences()
-        # get sentences and labels to simplify downstream vectorization
-        self.raw_sentences = [_[0] for _ in self.finance_dataset]
-        self.raw_labels = [_[1] for _ in self.finance_dataset]
+        # get the dataset and use self to version it: we store it once in a compact, columnar format,
+        # and downstream steps only store indices over it (see columnar.py)
+        self.dataset = load_finance_dataset(mmap=False)
         # debug / info
-        print("Total # of sentences loaded is: {}".format(len(self.finance_dataset)))
+        print("Total # of sentences loaded is: {}".format(len(self.dataset)))
         # go to the next step
         self.next(self.check_dataset)
 
     @step
+    @instrument(rows=lambda _, flow: len(flow.dataset), artifacts=['validation_report', 'valid_index'])
     def check_dataset(self):
         """
         Check data for anomalous data points and weird labels
         """
-        # first, check all sentences are "long enough", > 20 chars, otherwise flag them
-        self.labels = []
-        self.sentences = []
-        for s, l in zip(self.raw_sentences, self.raw_labels):
-            if len(s) < 20:
-                print("====> Sentence '{}' seems too short, ignoring it for now".format(s))
-                continue
-            self.labels.append(l)
-            self.sentences.append(s)
-
-        # make sure # labels and sentences is the same
-        assert len(self.labels) == len(self.sentences)
-        # check we actually have only 3 target classes, as expected 
-        all_labels = set(self.labels)
-        assert len(all_labels) == 3
+        import numpy as np
+        from data_validation import validate, warn_only, ExpectNotNull, ExpectLengthBetween, ExpectCardinality, ExpectDuplicateRateBelow
+
+        # declare our expectations on the data and evaluate them all at once: the report is versioned
+        # with self, and we fail only after having seen all the problems
+        expectations = [
+            ExpectNotNull('sentences'),
+            # sentences should be "long enough", > 20 chars: short ones are dropped below, so we just report them
+            warn_only(ExpectLengthBetween('sentences', min_length=20, mostly=0.99)),
+            # check we actually have only 3 target classes, as expected 
+            ExpectCardinality('labels', n_values=3, allowed_values=[0, 1, 2]),
+            warn_only(ExpectDuplicateRateBelow('sentences', max_rate=0.05))
+        ]
+        self.validation_report = validate([{'sentences': self.dataset.sentences, 'labels': self.dataset.labels}], expectations)
+        print(self.validation_report)
+        assert self.validation_report.success
+        # flag short sentences and keep track of the valid rows only, not of a copy of the data
+        is_too_short = self.dataset.sentence_lengths() < 20
+        for s in self.dataset.filter(is_too_short).sentences:
+            print("====> Sentence '{}' seems too short, ignoring it for now".format(s))
+        self.valid_index = np.flatnonzero(~is_too_short)
+        all_labels = set(np.unique(self.dataset.take(self.valid_index).labels).tolist())
         print("All labels are: {}".format(all_labels))
         # if data is all good, let's go to training
         self.next(self.prepare_train_and_test_dataset)
 
     @step
+    @instrument(rows=lambda _, flow: len(flow.valid_index), artifacts=['train_index', 'test_index'])
     def prepare_train_and_test_dataset(self):
         """
         Train / test split 
 
         TODO: add a Flow parameter to make test_size configurable at each run
         """
-        from sklearn.model_selection import train_test_split
+        from hash_split import hash_split_indices
 
-        self.X_train, self.X_test, self.y_train, self.y_test = train_test_split(
-            self.sentences,
-            self.labels,
-            test_size=0.2, 
-            random_state=42)
+        # we split the indices of the valid rows, so that splits are not copies of the data: each row
+        # goes to test from a hash of its (cleaned) sentence, so the split is the same however the
+        # dataset is ordered or sharded, and duplicated sentences cannot be both in train and test
+        self.train_index, self.test_index = hash_split_indices(
+            self.dataset.take(self.valid_index).sentences,
+            index=self.valid_index,
+            test_size=0.2,
+            salt='42')
 
         # debug / info
-        print("# train sentences: {},  # test: {}".format(len(self.X_train), len(self.X_test)))
+        print("# train sentences: {},  # test: {}".format(len(self.train_index), len(self.test_index)))
 
         self.next(self.prepare_features)
 
     @step
+    @instrument(rows=lambda _, flow: len(flow.valid_index), artifacts=['vectorizer', 'X_train_vectorized', 'X_test_vectorized'])
     def prepare_features(self):
         """
-        Transform our Xs (the sentences) using TF-IDF 
+        Transform our Xs (the sentences) using TF-IDF (or hashed word counts, in incremental mode)
 
         TODO: once we identify TF-IDF hyper-params, train multiple classifier to tune the model! See for example
         the analysis here: https://www.highonscience.com/blog/2021/05/24/ml-model-selection-with-metaflow/
         """
-        from flow_utils import tf_idf_vectorizer
-
-        self.vectorizer, self.X_train_vectorized, self.X_test_vectorized = tf_idf_vectorizer(self.X_train, self.X_test)
+        from flow_utils import tf_idf_vectorizer, hashing_vectorizer
+        from sentence_embeddings import embedding_vectorizer
+
+        X_train = self.dataset.take(self.train_index).sentences
+        X_test = self.dataset.take(self.test_index).sentences
+        if self.INCREMENTAL:
+            self.vectorizer, self.X_train_vectorized, self.X_test_vectorized = hashing_vectorizer(X_train, X_test)
+        elif self.FEATURIZER == 'embeddings':
+            # dense sentence vectors: sparse TF-IDF weights times the word vector matrix, in one product
+            self.vectorizer, self.X_train_vectorized, self.X_test_vectorized = embedding_vectorizer(
+                X_train, X_test, method=self.WORD_VECTORS)
+        else:
+            self.vectorizer, self.X_train_vectorized, self.X_test_vectorized = tf_idf_vectorizer(
+                X_train, X_test, n_jobs=int(self.TFIDF_JOBS))
         # train a model now that we have the features
         self.next(self.train_classifier)
 
     @step
+    @instrument(rows=lambda _, flow: len(flow.train_index), artifacts=['trained_model'])
     def train_classifier(self):
         """
         Get a scikit model and train it on the vectorized text
         """
         from flow_utils import get_classification_model
 
-        model = get_classification_model()
-        model.fit(self.X_train_vectorized, self.y_train)
+        model = get_classification_model(self.model_type())
+        model.fit(self.X_train_vectorized, self.dataset.take(self.train_index).labels)
         # versioned the trained model using self
         self.trained_model = model
-        # go to the testing phase
+        # shrink the model before testing it
+        self.next(self.select_features)
+
+    @step
+    @instrument(rows=lambda _, flow: len(flow.train_index), artifacts=['vectorizer', 'trained_model', 'feature_selection_curve'])
+    def select_features(self):
+        """
+        Shrink the served model: select the vocabulary by chi2 / mutual information and min_df, and rewrite
+        vectorizer and naive bayes with the selected words only (see feature_selection.py).
+
+        The trade-off curve (accuracy / size / latency at each target vocabulary size) is computed on a
+        validation split of the training set, so that the test set is only used to test the chosen model.
+        """
+        from hash_split import hash_split_indices
+        from feature_selection import trade_off_curve, choose_point, build_compact_model, reduce_matrix
+
+        self.feature_selection_curve = []
+        # hashed features (incremental mode) have no vocabulary to prune, and embeddings are dense
+        if self.FEATURE_SELECTION != 'none' and not self.INCREMENTAL and self.FEATURIZER != 'embeddings':
+            y_train = self.dataset.take(self.train_index).labels
+            # a different salt than the train / test split, so that validation is a random subset of train
+            fit_rows, validation_rows = hash_split_indices(self.dataset.take(self.train_index).sentences,
+                                                           test_size=0.2, salt='validation')
+            sizes = [int(_) for _ in str(self.VOCABULARY_SIZES).split(',')]
+            self.feature_selection_curve = trade_off_curve(
+                self.vectorizer,
+                self.X_train_vectorized[fit_rows], y_train[fit_rows],
+                self.X_train_vectorized[validation_rows], y_train[validation_rows],
+                self.dataset.take(self.train_index[validation_rows]).sentences,
+                sizes, method=self.FEATURE_SELECTION, min_df=int(self.MIN_DF))
+            chosen = choose_point(self.feature_selection_curve, accuracy_budget=float(self.ACCURACY_BUDGET))
+            print("Chosen vocabulary size: {} (validation accuracy {:.4f}, {} bytes)".format(
+                chosen['vocabulary_size'], chosen['accuracy'], chosen['bytes']))
+            # re-fit on the whole training set with the chosen size, and re-map the test features
+            self.vectorizer, self.trained_model, selected = build_compact_model(
+                self.vectorizer, self.X_train_vectorized, y_train, k=chosen['target_size'],
+                method=self.FEATURE_SELECTION, min_df=int(self.MIN_DF))
+            self.X_train_vectorized = reduce_matrix(self.X_train_vectorized, selected)
+            self.X_test_vectorized = reduce_matrix(self.X_test_vectorized, selected)
         self.next(self.test_model)
 
     @step 
+    @instrument(rows=lambda _, flow: len(flow.test_index), artifacts=['predicted', 'confusion_matrix', 'report'])
     def test_model(self):
         """
         Test the model on the held out sample
 
-        TODO: add confusion matrix and a plot!
+        TODO: add a plot of the confusion matrix!
 
         TODO: sends a summary of these metrics to Comet to make sure we track them!
         """
-        from flow_utils import evaluate_model_performance
-
-        self.predicted = self.trained_model.predict(self.X_test_vectorized)
-        self.report = evaluate_model_performance(self.y_test, self.predicted)
+        from streaming_metrics import ConfusionMatrixAccumulator, evaluate_in_chunks
+
+        y_test = self.dataset.take(self.test_index).labels
+        # predict chunk by chunk, updating a running confusion matrix: the report is the same as
+        # classification_report, computed from the matrix alone (see streaming_metrics.py)
+        accumulator, self.predicted = evaluate_in_chunks(self.trained_model, self.X_test_vectorized, y_test,
+                                                         ConfusionMatrixAccumulator(n_classes=3), keep_predictions=True)
+        self.confusion_matrix = accumulator.matrix
+        self.report = accumulator.classification_report()
         # print out the report
         print("!!!!! Classification Report !!!!!")
         print(self.report)
@@ -151,60 +315,83 @@ class FinanceNewsFlow(FlowSpec):
         self.next(self.beahvioral_tests)
 
     @step
+    @instrument(artifacts=['behavioral_units'])
     def beahvioral_tests(self):
         """
         As we learned in the course, it is very important to not just test quantitave behavior, but diving 
-        deep into model performances on cases of interest, slices of data, perturbed input.continue
+        deep into model performances on cases of interest, slices of data, perturbed input.
 
-        Note: we don't make the Flow fail here, but just flag when a test does not have the desired result.
-        Other choices are possible of course.
+        The suite is split into independent test units (see behavioral_tests.py), which run in parallel as
+        foreach branches: each branch reads model and test set from the datastore, where they are stored once.
         """
-        from random import randint
-        from flow_utils import test_on_company, test_on_quarterly_info, create_perturbated_sentences
+        from behavioral_tests import get_test_units
 
-        # slice data by quarter
-        self.quarterly_report = test_on_quarterly_info(self.X_test, self.predicted, self.y_test)
-        # print out the report
-        print("\n$$$ Classification Report on Quarterly News Only $$$")
-        print(self.quarterly_report)
-        # report performances on, say, https://en.wikipedia.org/wiki/Comptel
-        self.company_report = test_on_company(self.X_test, self.predicted, self.y_test, target_company='comptel')
-        print("\n$$$ Classification Report on Quarterly News Only $$$")
-        print(self.company_report)
-        # finally, some perturbation tests over 2 randomly sampled cases
-        rnd_index = [randint(0, len(self.X_test)) for _ in range(2)]
-        self.test_sentences = [self.X_test[_] for _ in rnd_index]
-        self.test_predictions = [self.predicted[_] for _ in rnd_index]
-        self.perturbated_test_sentences = create_perturbated_sentences(self.test_sentences)
-        # run  predictions on perturbated inputs and compare the output
-        self.new_Xs = self.vectorizer.transform(self.perturbated_test_sentences)
-        self.new_Ys = self.trained_model.predict(self.new_Xs)
-        print("\n@@@@ Perturbation tests @@@@\n")
-        for original, pert, pred, y in zip(self.test_sentences, self.perturbated_test_sentences, self.test_predictions, self.new_Ys):
-                print("\n\nOriginal: '{}', Perturbated: '{}'\n".format(original, pert))
-                print("Original Y: '{}', Perturbated Y: '{}'\n".format(pred, y))
-                if y != pred:
-                    print("ATTENTION: label changed after perturbation!\n")
-            
+        self.behavioral_units = get_test_units(back_translation=self.BACK_TRANSLATION)
+        self.next(self.run_behavioral_test, foreach='behavioral_units')
+
+    @step
+    @instrument(rows=lambda _, flow: len(flow.test_index), artifacts=['behavioral_result'])
+    def run_behavioral_test(self):
+        """
+        Run one behavioral test unit on the held out sample
+        """
+        from behavioral_tests import get_test_context, run_test_unit
+
+        context = get_test_context(self.vectorizer, self.trained_model, self.dataset.take(self.test_index).sentences,
+                                   self.dataset.take(self.test_index).labels, self.predicted)
+        self.behavioral_result = run_test_unit(self.input, context)
+        print("{}: {}".format(self.input['name'], self.behavioral_result['status'].upper()))
+        self.next(self.join_behavioral_tests)
+
+    @step
+    @instrument(artifacts=['behavioral_results'])
+    def join_behavioral_tests(self, inputs):
+        """
+        Aggregate results and timings of all the units: failed units make the run fail, unless
+        --fail_on_behavioral_regression is False (then they are just flagged). Skipped and errored
+        units are reported only.
+        """
+        from behavioral_tests import summarize_results, failed_units, BehavioralRegression
+
+        self.behavioral_results = [i.behavioral_result for i in inputs]
+        # all branches share the artifacts of the parent step: carry them over to the next steps
+        self.merge_artifacts(inputs, exclude=['behavioral_result'])
+        print("\n@@@@ Behavioral tests @@@@\n")
+        print(summarize_results(self.behavioral_results))
+        failed = failed_units(self.behavioral_results)
+        if failed:
+            print("ATTENTION: behavioral tests failed: {}".format(', '.join(failed)))
+            if self.FAIL_ON_BEHAVIORAL_REGRESSION:
+                raise BehavioralRegression("Behavioral tests failed: {}".format(', '.join(failed)))
         # all is done, dump the model
         self.next(self.dump_for_serving)
 
     @step
+    @instrument()
     def dump_for_serving(self):
         """
         Make sure we pickled the artifacts necessary for the Flask app to work
 
         Hint: is there a better way of doing this than pickling feature prep and model in two files? ;-)
         """
-        import pickle
-        import os
-
-        pickle.dump(self.vectorizer, open(os.path.join(self.FINAL_FOLDER, 'vectorizer.pkl'), 'wb+'))
-        pickle.dump(self.trained_model, open(os.path.join(self.FINAL_FOLDER, 'model.pkl'), 'wb+'))
+        from online_training import publish_artifacts
+
+        vectorizer, model = self.vectorizer, self.trained_model
+        if self.QUANTIZE != 'none':
+            from quantization import quantize_for_serving, parity_report
+            # the quantized pair has the same transform / predict API, so the app does not change;
+            # we check it against the float64 one on the test split before dumping it
+            vectorizer, model = quantize_for_serving(self.vectorizer, self.trained_model, self.QUANTIZE)
+            test_dataset = self.dataset.take(self.test_index)
+            self.quantization_report = parity_report(self.trained_model, model, test_dataset.sentences,
+                                                     test_dataset.labels, self.vectorizer, vectorizer)
+        # through temporary files, vectorizer first: a running app never reads a half-written pickle
+        publish_artifacts(self.FINAL_FOLDER, vectorizer, model)
         # go to the end
         self.next(self.end)
 
     @step
+    @instrument()
     def end(self):
         # all done, just print goodbye
         print("All done at {}!\n See you, space cowboys!".format(datetime.utcnow()))
@@ -0,0 +1,204 @@
+"""
+
+    This script collects an incremental training mode for the sentiment classifier.
+
+    FinanceNewsFlow re-fits the TfidfVectorizer and the MultinomialNB model from scratch at every run.
+    To update the model with new labelled data (e.g. the feedback logged by my_app.py), we can instead:
+
+    * use a stateless featurizer (HashingVectorizer), so that there is no vocabulary to re-fit: new words
+      just hash to their column;
+    * update the naive bayes counts with `partial_fit`, batch by batch;
+    * remember how much of the feedback log has been consumed already, so that history is never reprocessed;
+    * publish the new artifact atomically, in the folder the Flask app reads from.
+
+    Run FinanceNewsFlow with `--incremental True` first, to get a model trained on hashed features, then
+    periodically run:
+
+    python online_training.py fold-in --feedback_file feedback.jsonl --model_folder .
+
+    or, to compare incremental updates with a full re-train:
+
+    python online_training.py benchmark
+
+"""
+
+
+import os
+import json
+import pickle
+import logging
+
+
+# financial_phrasebank labels: negative, neutral, positive
+CLASSES = [0, 1, 2]
+
+
+def get_hashing_vectorizer(n_features: int=2 ** 18):
+    """
+        Stateless vectorizer: same tokenization as `flow_utils.tf_idf_vectorizer`, but columns are hashed
+        words, so nothing needs to be fitted. alternate_sign is off, as naive bayes needs non-negative features.
+    """
+    from sklearn.feature_extraction.text import HashingVectorizer
+
+    return HashingVectorizer(analyzer='word', stop_words='english', n_features=n_features, alternate_sign=False)
+
+
+def partial_fit_in_batches(model, vectorizer, sentences: list, labels: list, batch_size: int=1000):
+    """
+        Update the model with new labelled sentences, one batch at a time.
+    """
+    for start in range(0, len(sentences), batch_size):
+        model.partial_fit(vectorizer.transform(sentences[start:start + batch_size]),
+                          labels[start:start + batch_size],
+                          classes=CLASSES)
+
+    return model
+
+
+def read_new_feedback(feedback_file: str, offset: int=0) -> tuple:
+    """
+        Read the labelled feedback logged by the app (one json per line, with 'sentence' and 'label'),
+        starting from a byte offset: return cleaned sentences, labels and the new offset. Incomplete
+        lines (the app may be writing right now) are left for the next round; malformed lines are logged
+        and skipped, so that one bad record does not block every later fold-in.
+    """
+    from flow_utils import pre_process_sentence
+
+    sentences, labels = [], []
+    if not os.path.exists(feedback_file):
+        return sentences, labels, offset
+    with open(feedback_file, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            try:
+                record = json.loads(line)
+                if record.get('label') not in CLASSES:
+                    continue
+                sentence = pre_process_sentence(record['sentence'])
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                logging.getLogger('online_training').warning(
+                    "Skipping malformed feedback at byte {}: {!r}".format(offset - len(line), e))
+                continue
+            sentences.append(sentence)
+            labels.append(record['label'])
+
+    return sentences, labels, offset
+
+
+def publish_artifacts(model_folder: str, vectorizer, model):
+    """
+        Write the pickles to temporary files first, then rename them: the app never sees a half-written file.
+    """
+    for name, obj in [('vectorizer.pkl', vectorizer), ('model.pkl', model)]:
+        tmp_file = os.path.join(model_folder, '.{}.tmp'.format(name))
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(obj, f)
+        os.replace(tmp_file, os.path.join(model_folder, name))
+
+    return
+
+
+def save_state(state_file: str, state: dict):
+    """
+        Same as publish_artifacts, for the json state: a crash never leaves a truncated offset behind.
+    """
+    tmp_file = os.path.join(os.path.dirname(state_file), '.{}.tmp'.format(os.path.basename(state_file)))
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_file, state_file)
+
+    return
+
+
+def fold_in_feedback(feedback_file: str, model_folder: str, batch_size: int=1000) -> int:
+    """
+        Load the served artifacts, fold in the feedback logged since the last run and publish the new model.
+        Returns the number of new sentences used.
+    """
+    from sklearn.feature_extraction.text import HashingVectorizer
+
+    with open(os.path.join(model_folder, 'vectorizer.pkl'), 'rb') as f:
+        vectorizer = pickle.load(f)
+    with open(os.path.join(model_folder, 'model.pkl'), 'rb') as f:
+        model = pickle.load(f)
+    assert isinstance(vectorizer, HashingVectorizer), "Incremental training needs a model trained with --incremental True"
+    assert hasattr(model, 'partial_fit'), "Quantized models cannot be updated: dump the model with --quantize none"
+    # the offset in the feedback log is stored next to the model, so that history is never reprocessed;
+    # the model carries it too, so a crash after publishing and before saving the state loses nothing
+    state_file = os.path.join(model_folder, 'online_training_state.json')
+    state = json.load(open(state_file)) if os.path.exists(state_file) else {'offset': 0}
+    start_offset = max(state['offset'], getattr(model, 'feedback_offset_', 0))
+    sentences, labels, offset = read_new_feedback(feedback_file, start_offset)
+    if sentences:
+        partial_fit_in_batches(model, vectorizer, sentences, labels, batch_size=batch_size)
+        model.feedback_offset_ = offset
+        publish_artifacts(model_folder, vectorizer, model)
+    save_state(state_file, {'offset': offset})
+    print("Folded in {} new sentences".format(len(sentences)))
+
+    return len(sentences)
+
+
+def benchmark_incremental_vs_full(n_new: int=10000, seed: int=42) -> dict:
+    """
+        Compare the time to absorb n_new labelled sentences incrementally with a full re-train
+        (TF-IDF + naive bayes on all the data), and the accuracy of the two on the held-out split.
+        The finance dataset is small, so "new" sentences are sampled (with replacement) from half of
+        the training split, while the initial model is trained on the other half.
+    """
+    import time
+    import numpy as np
+    from sklearn.model_selection import train_test_split
+    from sklearn.metrics import accuracy_score
+    from flow_utils import get_finance_sentences, tf_idf_vectorizer, get_classification_model
+
+    dataset = get_finance_sentences()
+    X_train, X_test, y_train, y_test = train_test_split([_[0] for _ in dataset], [_[1] for _ in dataset],
+                                                        test_size=0.2, random_state=seed)
+    half = len(X_train) // 2
+    rng = np.random.default_rng(seed)
+    new_ids = rng.integers(half, len(X_train), n_new)
+    X_new, y_new = [X_train[_] for _ in new_ids], [y_train[_] for _ in new_ids]
+    # initial model on hashed features, trained on the first half
+    vectorizer = get_hashing_vectorizer()
+    model = partial_fit_in_batches(get_classification_model(), vectorizer, X_train[:half], y_train[:half])
+
+    start = time.time()
+    partial_fit_in_batches(model, vectorizer, X_new, y_new)
+    incremental_seconds = time.time() - start
+    incremental_accuracy = accuracy_score(y_test, model.predict(vectorizer.transform(X_test)))
+
+    start = time.time()
+    full_vectorizer, X_all, X_test_vectorized = tf_idf_vectorizer(X_train[:half] + X_new, X_test)
+    full_model = get_classification_model().fit(X_all, y_train[:half] + y_new)
+    full_seconds = time.time() - start
+    full_accuracy = accuracy_score(y_test, full_model.predict(X_test_vectorized))
+
+    results = {
+        'incremental_seconds': incremental_seconds,
+        'full_retrain_seconds': full_seconds,
+        'incremental_accuracy': incremental_accuracy,
+        'full_retrain_accuracy': full_accuracy,
+        'accuracy_delta': incremental_accuracy - full_accuracy
+    }
+    print(results)
+
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Incremental training of the sentiment model')
+    parser.add_argument('command', choices=['fold-in', 'benchmark'])
+    parser.add_argument('--feedback_file', default='feedback.jsonl')
+    parser.add_argument('--model_folder', default='.')
+    parser.add_argument('--batch_size', type=int, default=1000)
+    args = parser.parse_args()
+    if args.command == 'fold-in':
+        fold_in_feedback(args.feedback_file, args.model_folder, batch_size=args.batch_size)
+    else:
+        benchmark_incremental_vs_full()
@@ -0,0 +1 @@
+../mlsys/training/quantization.py
\ No newline at end of file
@@ -0,0 +1,397 @@
+"""
+
+    This script collects a small, in-process metrics subsystem for the Flask app (my_app.py).
+
+    * Counters and latency histograms are sharded per thread: each thread only writes its own shard, so the
+      hot path takes no lock; shards are summed up when metrics are read. When a thread exits (e.g. the
+      Flask dev server starts one thread per request), its shard is folded into a base shard, so memory
+      and read time depend on the live threads, not on the requests served.
+    * Histograms use HDR-style log-linear buckets: each power of two (in microseconds) is split in a few
+      linear sub-buckets, so the relative error is bounded (12.5% with 8 sub-buckets) from 1us to hours,
+      with a few hundred integers per thread.
+    * `render_text` exposes all the metrics in the Prometheus text format, so any local scraper can read them.
+    * `RateLimitedLogger` writes structured (json) log lines, dropping (and counting) lines above a rate.
+    * `SlowRequestLog` samples requests slower than a threshold, with their stage timings, to that logger.
+
+    Measure the overhead per request with:
+
+    python serving_metrics.py
+
+"""
+
+
+import json
+import math
+import time
+import random
+import weakref
+import threading
+from contextlib import contextmanager
+
+
+# linear sub-buckets per power of two, and powers of two (in microseconds) covered by histograms
+SUB_BUCKETS = 8
+MAX_EXPONENT = 36
+
+
+def _format_labels(labels: dict, extra: dict=None) -> str:
+    labels = dict(labels or {}, **(extra or {}))
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in sorted(labels.items())) + '}'
+
+
+class _ShardOwner(object):
+    """
+    Lives in the thread-local storage of a thread: it is released when the thread exits.
+    """
+    __slots__ = ['__weakref__']
+
+
+class _PerThreadMetric(object):
+    """
+    Base class: each thread gets its own list of numbers (shard), registered once under a lock, and
+    folded into the base shard when the thread exits.
+    """
+
+    def __init__(self, name: str, help: str, labels: dict, shard_size: int):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self._shard_size = shard_size
+        self._local = threading.local()
+        # shards of the live threads, by id, and the sum of the shards of the threads which exited
+        self._shards = {}
+        self._base = [0] * shard_size
+        self._lock = threading.Lock()
+
+        return
+
+    def _shard(self) -> list:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = [0] * self._shard_size
+            owner = _ShardOwner()
+            with self._lock:
+                self._shards[id(shard)] = shard
+            # the thread-local owner is released when the thread exits: then no one writes the shard anymore
+            weakref.finalize(owner, self._retire, id(shard))
+            self._local.owner, self._local.shard = owner, shard
+
+        return shard
+
+    def _retire(self, shard_id: int):
+        with self._lock:
+            shard = self._shards.pop(shard_id)
+            self._base = [b + v for b, v in zip(self._base, shard)]
+
+        return
+
+    @property
+    def n_shards(self) -> int:
+        with self._lock:
+            return len(self._shards)
+
+    def _merged(self) -> list:
+        with self._lock:
+            shards = [self._base] + list(self._shards.values())
+
+        return [sum(values) for values in zip(*shards)]
+
+
+class Counter(_PerThreadMetric):
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str='', labels: dict=None):
+        super().__init__(name, help, labels, 1)
+
+        return
+
+    def inc(self, amount: int=1):
+        self._shard()[0] += amount
+
+        return
+
+    @property
+    def value(self) -> int:
+        return self._merged()[0]
+
+    def render(self) -> list:
+        return ['{}{} {}'.format(self.name, _format_labels(self.labels), self.value)]
+
+
+class LatencyHistogram(_PerThreadMetric):
+    """
+    Latency histogram with log-linear buckets over microseconds. Bucket i covers the values in
+    (upper_bound(i - 1), upper_bound(i)]; the last two slots of each shard are count and sum (seconds).
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str='', labels: dict=None):
+        self.n_buckets = (MAX_EXPONENT + 1) * SUB_BUCKETS
+        super().__init__(name, help, labels, self.n_buckets + 2)
+
+        return
+
+    @staticmethod
+    def bucket_index(seconds: float) -> int:
+        micros = seconds * 1e6
+        if micros < 1:
+            return 0
+        # micros = mantissa * 2 ** exponent, with mantissa in [0.5, 1)
+        mantissa, exponent = math.frexp(micros)
+
+        return min(exponent * SUB_BUCKETS + int((mantissa * 2 - 1) * SUB_BUCKETS), (MAX_EXPONENT + 1) * SUB_BUCKETS - 1)
+
+    @staticmethod
+    def upper_bound(index: int) -> float:
+        """
+            Upper bound (in seconds) of the bucket.
+        """
+        exponent, sub_bucket = divmod(index, SUB_BUCKETS)
+        if exponent == 0:
+            return 1e-6
+
+        return 2 ** (exponent - 1) * (1 + (sub_bucket + 1) / SUB_BUCKETS) / 1e6
+
+    def observe(self, seconds: float):
+        shard = self._shard()
+        shard[self.bucket_index(seconds)] += 1
+        shard[-2] += 1
+        shard[-1] += seconds
+
+        return
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        yield
+        self.observe(time.perf_counter() - start)
+
+    def snapshot(self) -> tuple:
+        merged = self._merged()
+
+        return merged[:self.n_buckets], merged[-2], merged[-1]
+
+    def quantile(self, q: float) -> float:
+        """
+            Approximate quantile (upper bound of the bucket containing it), in seconds.
+        """
+        buckets, count, _ = self.snapshot()
+        if not count:
+            return 0.0
+        rank, cumulative = q * count, 0
+        for i, c in enumerate(buckets):
+            cumulative += c
+            if cumulative >= rank and c:
+                return self.upper_bound(i)
+
+        return self.upper_bound(self.n_buckets - 1)
+
+    def render(self) -> list:
+        """
+            Cumulative buckets up to the highest non-empty one, plus +Inf, sum and count.
+        """
+        buckets, count, total = self.snapshot()
+        lines = []
+        cumulative = 0
+        last = max([i for i, c in enumerate(buckets) if c], default=-1)
+        for i in range(last + 1):
+            cumulative += buckets[i]
+            if buckets[i]:
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(self.labels, {'le': '{:.6g}'.format(self.upper_bound(i))}), cumulative))
+        lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.labels, {'le': '+Inf'}), count))
+        lines.append('{}_sum{} {}'.format(self.name, _format_labels(self.labels), total))
+        lines.append('{}_count{} {}'.format(self.name, _format_labels(self.labels), count))
+
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    Metrics by (name, labels): get-or-create them once (e.g. at import time), then update them on the hot path.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+        return
+
+    def _get(self, metric_class, name: str, help: str, labels: dict):
+        key = (name, tuple(sorted((labels or {}).items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, metric_class(name, help, labels))
+
+        return metric
+
+    def counter(self, name: str, help: str='', labels: dict=None) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name: str, help: str='', labels: dict=None) -> LatencyHistogram:
+        return self._get(LatencyHistogram, name, help, labels)
+
+    def render_text(self) -> str:
+        """
+            All the metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines, seen = [], set()
+        for metric in sorted(metrics, key=lambda m: m.name):
+            if metric.name not in seen:
+                seen.add(metric.name)
+                lines.append('# HELP {} {}'.format(metric.name, metric.help))
+                lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+class RateLimitedLogger(object):
+    """
+    Structured (one json per line) logging, with a token bucket allowing at most max_per_second lines
+    (and bursts of the same size): dropped lines are counted, and reported in the next line logged.
+    """
+
+    def __init__(self, logger, max_per_second: float=10.0):
+        self.logger = logger
+        self.max_per_second = max_per_second
+        self._tokens = max_per_second
+        self._last = time.monotonic()
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+        return
+
+    def log(self, event: str, level: int=20, **fields) -> bool:
+        # disabled levels (e.g. debug in production) cost neither a token nor the lock
+        if not self.logger.isEnabledFor(level):
+            return False
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.max_per_second, self._tokens + (now - self._last) * self.max_per_second)
+            self._last = now
+            if self._tokens < 1:
+                self._suppressed += 1
+                return False
+            self._tokens -= 1
+            suppressed, self._suppressed = self._suppressed, 0
+        if suppressed:
+            fields['suppressed'] = suppressed
+        self.logger.log(level, json.dumps(dict(event=event, ts=time.time(), **fields)))
+
+        return True
+
+
+class SlowRequestLog(object):
+    """
+    Log a sample (sample_rate) of the requests slower than threshold_seconds, with their stage timings.
+    """
+
+    def __init__(self, logger: RateLimitedLogger, threshold_seconds: float=0.05, sample_rate: float=1.0):
+        self.logger = logger
+        self.threshold_seconds = threshold_seconds
+        self.sample_rate = sample_rate
+
+        return
+
+    def record(self, total_seconds: float, stages: dict, **fields) -> bool:
+        if total_seconds < self.threshold_seconds or random.random() >= self.sample_rate:
+            return False
+
+        return self.logger.log('slow_request', level=30, total_ms=round(total_seconds * 1000, 3),
+                               stages_ms={k: round(v * 1000, 3) for k, v in stages.items()}, **fields)
+
+
+def benchmark_overhead(n_requests: int=200000, n_threads: int=4) -> dict:
+    """
+        Overhead per request of the app instrumentation (3 timed stages, 2 counters, the slow request check),
+        single thread and with concurrent threads.
+    """
+    import logging
+
+    registry = MetricsRegistry()
+    stages = {s: registry.histogram('stage_seconds', labels={'stage': s}) for s in ['normalize', 'vectorize', 'predict']}
+    requests_total = registry.counter('requests_total')
+    predictions = registry.counter('predictions_total', labels={'label': '1'})
+    slow_log = SlowRequestLog(RateLimitedLogger(logging.getLogger('benchmark')), threshold_seconds=1.0)
+
+    def instrumented(n: int):
+        for _ in range(n):
+            timings = {}
+            for name, histogram in stages.items():
+                start = time.perf_counter()
+                timings[name] = time.perf_counter() - start
+                histogram.observe(timings[name])
+            requests_total.inc()
+            predictions.inc()
+            slow_log.record(sum(timings.values()), timings)
+
+    def baseline(n: int):
+        for _ in range(n):
+            for _ in stages:
+                start = time.perf_counter()
+                time.perf_counter() - start
+
+    results = {}
+    for name, func in [('baseline', baseline), ('instrumented', instrumented)]:
+        start = time.perf_counter()
+        func(n_requests)
+        results['{}_us_per_request'.format(name)] = 1e6 * (time.perf_counter() - start) / n_requests
+        threads = [threading.Thread(target=func, args=(n_requests // n_threads,)) for _ in range(n_threads)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        results['{}_{}_threads_us_per_request'.format(name, n_threads)] = 1e6 * (time.perf_counter() - start) / n_requests
+    results['overhead_us_per_request'] = results['instrumented_us_per_request'] - results['baseline_us_per_request']
+    assert requests_total.value == 2 * n_requests - n_requests % n_threads
+    print(results)
+
+    return results
+
+
+def check_short_lived_threads(n_requests: int=300, concurrency: int=8) -> dict:
+    """
+        One short-lived thread per request, as with the Flask dev server, concurrency threads at a time: no
+        update is lost, and the shards of the threads which exited are folded into the base shard, so their
+        number is bounded by the live threads, not by the requests served.
+    """
+    registry = MetricsRegistry()
+    counter = registry.counter('requests_total')
+    histogram = registry.histogram('request_seconds')
+    seen_shards = []
+
+    def request():
+        counter.inc()
+        histogram.observe(0.001)
+        seen_shards.append(max(counter.n_shards, histogram.n_shards))
+
+    for _ in range(n_requests // concurrency):
+        threads = [threading.Thread(target=request) for _ in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    n_served = concurrency * (n_requests // concurrency)
+    results = {'requests': n_served, 'max_live_shards': max(seen_shards), 'shards_after': counter.n_shards + histogram.n_shards,
+               'requests_total': counter.value, 'observations': histogram.snapshot()[1]}
+    assert results['requests_total'] == results['observations'] == n_served
+    assert results['max_live_shards'] <= concurrency, "Shards of exited threads were not folded"
+    assert results['shards_after'] == 0, "Shards of exited threads were not folded"
+    print(results)
+
+    return results
+
+
+if __name__ == '__main__':
+    check_short_lived_threads()
+    benchmark_overhead()
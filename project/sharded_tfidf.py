@@ -0,0 +1,214 @@
+"""
+
+    This script collects a sharded, multi-process version of the TF-IDF fit in `flow_utils.tf_idf_vectorizer`.
+
+    `TfidfVectorizer.fit_transform` runs on a single core, over the whole training list. Here we:
+
+    * split the sentences in contiguous shards, and let worker processes tokenize each shard once,
+      returning its partial vocabulary and the term counts as a CSR block;
+    * merge the partial vocabularies into the global one (sorted, as scikit does), re-map the columns of
+      each block, and compute the IDF vector from the document frequencies,
+      idf = ln((1 + n) / (1 + df)) + 1 (scikit default, smooth_idf=True);
+    * set them on a TfidfVectorizer with the same settings, so that the result is equivalent to
+      `TfidfVectorizer(analyzer='word', stop_words='english').fit(X_train)`, and can be pickled for the app;
+    * stack the CSR blocks into the final matrix, and apply idf weights and l2 normalization in place.
+
+    The test set can be transformed in parallel too, with `sharded_transform`.
+
+    You can run the scaling benchmark (1 to N processes) from the command line, e.g.:
+
+    python sharded_tfidf.py 200000
+
+"""
+
+
+import numpy as np
+
+
+def get_vectorizer_params() -> dict:
+    """
+        Same settings as in flow_utils.tf_idf_vectorizer.
+    """
+    return {'analyzer': 'word', 'stop_words': 'english'}
+
+
+def _shard_bounds(n_rows: int, n_shards: int) -> list:
+    bounds = np.linspace(0, n_rows, n_shards + 1).astype(int).tolist()
+
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def count_shard(sentences: list, params: dict) -> tuple:
+    """
+        Tokenize a shard once: return its partial vocabulary (sorted terms) and the term counts of each
+        sentence, as a CSR matrix whose columns are the local term ids.
+    """
+    from scipy.sparse import csr_matrix
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    counter = CountVectorizer(**params)
+    try:
+        counts = counter.fit_transform(sentences)
+    except ValueError:
+        # a shard with stop words only: the global vocabulary may still be non-empty
+        return [], csr_matrix((len(sentences), 0), dtype=np.int64)
+
+    return sorted(counter.vocabulary_, key=counter.vocabulary_.get), counts
+
+
+def _count_shard(args):
+    return count_shard(*args)
+
+
+def merge_vocabularies(partials: list) -> tuple:
+    """
+        Merge the partial vocabularies of the shards into a sorted global vocabulary (term -> column), and
+        re-map the columns of each shard to the global ids. Returns the vocabulary, the document frequency
+        of each column and the re-mapped count blocks.
+    """
+    from scipy.sparse import csr_matrix
+
+    vocabulary = {t: i for i, t in enumerate(sorted(set(t for terms, _ in partials for t in terms)))}
+    doc_freq = np.zeros(len(vocabulary), dtype=np.int64)
+    blocks = []
+    for terms, counts in partials:
+        global_ids = np.array([vocabulary[t] for t in terms], dtype=np.int64)
+        # both local and global vocabularies are sorted, so the re-mapped columns stay sorted in each row
+        block = csr_matrix((counts.data, global_ids[counts.indices], counts.indptr),
+                           shape=(counts.shape[0], len(vocabulary)))
+        doc_freq += np.bincount(block.indices, minlength=len(vocabulary))
+        blocks.append(block)
+
+    return vocabulary, doc_freq, blocks
+
+
+def build_vectorizer(vocabulary: dict, doc_freq: np.ndarray, n_docs: int, params: dict):
+    """
+        A TfidfVectorizer in the same state as after fit: learned vocabulary and smoothed idf.
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    if not vocabulary:
+        raise ValueError("empty vocabulary; perhaps the documents only contain stop words")
+    vectorizer = TfidfVectorizer(**params)
+    vectorizer.vocabulary_ = vocabulary
+    vectorizer.fixed_vocabulary_ = False
+    vectorizer.stop_words_ = set()
+    # the vocabulary must be set first: the idf_ setter checks their lengths match
+    vectorizer.idf_ = np.log((1 + n_docs) / (1 + doc_freq)) + 1
+
+    return vectorizer
+
+
+def stack_csr_blocks(blocks: list, dtype=None):
+    """
+        Stack CSR blocks (same number of columns) vertically: the output arrays are allocated once,
+        and each block is copied in place (casting the values to dtype, if given).
+    """
+    from scipy.sparse import csr_matrix
+
+    n_rows = sum(b.shape[0] for b in blocks)
+    nnz = sum(b.nnz for b in blocks)
+    data = np.empty(nnz, dtype=dtype or blocks[0].dtype)
+    indices = np.empty(nnz, dtype=np.int64 if nnz > np.iinfo(np.int32).max else np.int32)
+    indptr = np.empty(n_rows + 1, dtype=indices.dtype)
+    indptr[0] = 0
+    row, offset = 0, 0
+    for b in blocks:
+        data[offset:offset + b.nnz] = b.data
+        indices[offset:offset + b.nnz] = b.indices
+        indptr[row + 1:row + b.shape[0] + 1] = b.indptr[1:] + offset
+        row += b.shape[0]
+        offset += b.nnz
+
+    return csr_matrix((data, indices, indptr), shape=(n_rows, blocks[0].shape[1]))
+
+
+# the fitted vectorizer of the current worker process, set once by the pool initializer
+_worker_vectorizer = None
+
+
+def _init_worker(vectorizer):
+    global _worker_vectorizer
+    _worker_vectorizer = vectorizer
+
+    return
+
+
+def _transform_shard(sentences: list):
+    return _worker_vectorizer.transform(sentences)
+
+
+def sharded_fit_transform(sentences, n_jobs: int=2, n_shards: int=None, params: dict=None) -> tuple:
+    """
+        Fit the vectorizer on the sentences with n_jobs processes, and return it with the transformed
+        (CSR) matrix. Sentences can be any sequence supporting len and integer indexing (e.g. a TextView).
+        Each sentence is tokenized only once: workers return raw counts, which are re-mapped to the global
+        vocabulary, stacked and weighted (tf * idf, l2-normalized rows) with vectorized NumPy.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from sklearn.preprocessing import normalize
+
+    params = params or get_vectorizer_params()
+    shards = [[sentences[i] for i in range(start, end)] for start, end in _shard_bounds(len(sentences), n_shards or n_jobs)]
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        partials = list(executor.map(_count_shard, [(shard, params) for shard in shards]))
+    vocabulary, doc_freq, blocks = merge_vocabularies(partials)
+    vectorizer = build_vectorizer(vocabulary, doc_freq, len(sentences), params)
+    X = stack_csr_blocks(blocks, dtype=np.float64)
+    X.data *= vectorizer.idf_[X.indices]
+
+    return vectorizer, normalize(X, copy=False)
+
+
+def sharded_transform(vectorizer, sentences, n_jobs: int=2):
+    """
+        Transform the sentences with a fitted vectorizer, shard by shard, in n_jobs processes.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    shards = [[sentences[i] for i in range(start, end)] for start, end in _shard_bounds(len(sentences), n_jobs)]
+    if not shards:
+        return vectorizer.transform([])
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(vectorizer,)) as executor:
+        return stack_csr_blocks(list(executor.map(_transform_shard, shards)))
+
+
+def benchmark_scaling(n_docs: int=200000, max_jobs: int=None) -> list:
+    """
+        Time the sharded fit + transform from 1 to max_jobs processes (powers of two), against the single
+        process TfidfVectorizer, checking that vocabulary, idf and matrices match.
+    """
+    import os
+    import time
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from similarity_index import make_synthetic_corpus
+
+    # synthetic words mixed with real (stop) words, so that the stop word list matters
+    sentences = ['the {} and {}'.format(s, s[:20]) for s in make_synthetic_corpus(n_docs)]
+    start = time.time()
+    baseline = TfidfVectorizer(**get_vectorizer_params())
+    X_baseline = baseline.fit_transform(sentences)
+    baseline_seconds = time.time() - start
+    print("single process TfidfVectorizer: {:.2f}s".format(baseline_seconds))
+    results = []
+    jobs = 1
+    while jobs <= (max_jobs or os.cpu_count()):
+        start = time.time()
+        vectorizer, X = sharded_fit_transform(sentences, n_jobs=jobs)
+        seconds = time.time() - start
+        assert vectorizer.vocabulary_ == baseline.vocabulary_
+        assert np.allclose(vectorizer.idf_, baseline.idf_)
+        assert abs(X - X_baseline).max() < 1e-12
+        results.append({'n_jobs': jobs, 'seconds': seconds, 'speedup': baseline_seconds / seconds})
+        print(results[-1])
+        jobs *= 2
+
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+
+    benchmark_scaling(int(sys.argv[1]) if len(sys.argv) > 1 else 200000,
+                      int(sys.argv[2]) if len(sys.argv) > 2 else None)
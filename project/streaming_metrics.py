@@ -0,0 +1 @@
+../mlsys/training/streaming_metrics.py
\ No newline at end of file